@@ -1,35 +1,470 @@
-from trie_structure import Trie
+import os
+import time
+import threading
+from trie_structure import Trie, bind_formula
+from radix_trie import RadixTrie
+from read_write_lock import ReadWriteLock
+from mmap_trie import MappedTrie, OverlayTrie
+from bulk_load import ascending, read_items
+from aggregates import compile_aggregate, evaluate_columns, field, partial_aggregate
+from persistence import SnapshotStore, WriteAheadLog
+
+# trie implementations a server can store its data in
+ENGINES = {
+    'trie': Trie, # one node per key character
+    'radix': RadixTrie, # path compressed, one node per branching point
+}
 
 class KVServer:
-    def __init__(self):
-        self.root = Trie()
+    def __init__(
+        self,
+        engine: str = 'trie',
+        tombstone_retention: float = 60.0,
+        data_dir: str = None,
+        commit_delay: float = 0.0,
+        snapshot_format: str = 'jsonl',
+        merkle=None,
+        keypaths=None,
+        indexes=None,
+        cache=None
+    ):
+        if snapshot_format == 'mmap' and data_dir is None:
+            raise ValueError('The mmap snapshot format needs a data directory')
+        self.engine = engine
+        self.tombstone_retention = tombstone_retention
+        self.snapshot_format = snapshot_format
+        # with mmap snapshots the trie only holds the writes since the last snapshot,
+        # every other key is read from the mapped snapshot file
+        self.root = self.new_trie()
+        # a single store is shared by every connection of the server process,
+        # GET and QUERY run concurrently while PUT and DELETE take exclusive access
+        self.lock = ReadWriteLock()
+        # without a data directory the store lives only in memory
+        self.wal = None
+        self.snapshots = None
+        self.snapshot_sequence = 0 # WAL sequence number covered by the latest snapshot
+        self.snapshot_lock = threading.Lock()
+        # Merkle trees over the keys shared with every peer, kept up to date by apply once built
+        self.merkle = None
+        # flattened keypaths of the keys under some prefixes, kept up to date by apply once built
+        self.keypaths = None
+        # sorted secondary indexes of numeric fields for FIND, kept up to date by apply once built
+        self.indexes = None
+        # encoded GET and QUERY responses, a key's entries are dropped by apply when it is written
+        self.cache = None
+        if data_dir is not None:
+            os.makedirs(data_dir, exist_ok=True)
+            self.snapshots = SnapshotStore(data_dir, snapshot_format)
+            last_sequence = self.recover(data_dir)
+            self.wal = WriteAheadLog(data_dir, last_sequence, commit_delay)
+        if merkle is not None:
+            merkle.rebuild(self.root.scan(versions=True))
+            self.merkle = merkle
+        if keypaths is not None:
+            keypaths.rebuild(self.root.scan())
+            self.keypaths = keypaths
+        if indexes is not None:
+            indexes.rebuild(self.root.scan())
+            self.indexes = indexes
+        self.cache = cache
+
+    def new_trie(self, base=None):
+        """
+        Return an empty trie of the configured engine, layered over base in mmap mode
+        """
+        trie = ENGINES[self.engine](self.tombstone_retention)
+        if self.snapshot_format == 'mmap':
+            return OverlayTrie(trie, base)
+        return trie
+
+    def recover(self, data_dir):
+        """
+        Load the latest snapshot and replay the WAL records written after it
+        :return: the sequence number of the last record recovered
+        """
+        started = time.perf_counter()
+        last_sequence = 0
+        latest = self.snapshots.latest()
+        if latest is not None:
+            last_sequence, path = latest
+            if path.endswith('.trie'):
+                base = MappedTrie(path)
+                if self.snapshot_format == 'mmap':
+                    self.root.base = base # served in place, nothing to load
+                else:
+                    self.root.load_sorted(base.scan(versions=True))
+                    base.close()
+            else:
+                # snapshots are written in key order, so the trie is built bottom-up
+                self.root.load_sorted(SnapshotStore.load(path))
+        self.snapshot_sequence = last_sequence
+
+        replayed = 0
+        for record in WriteAheadLog.replay(data_dir, last_sequence):
+            self.apply(record[1:])
+            last_sequence = record[0]
+            replayed += 1
+
+        print(
+            f'[Server]: Recovered {self.root.stats()["keys"]} keys from snapshot {self.snapshot_sequence} '
+            f'and {replayed} WAL records in {time.perf_counter() - started:.2f}s'
+        )
+        return last_sequence
+
+    def apply(self, record, trie=None):
+        """
+        Apply one WAL record, without its sequence number, to the trie
+        """
+        trie = self.root if trie is None else trie
+        if record[0] == 'put':
+            trie.put(*record[1:])
+        elif record[0] == 'delete':
+            trie.delete(*record[1:])
+        if self.merkle is not None and trie is self.root:
+            self.merkle.apply(record, trie)
+        if self.keypaths is not None and trie is self.root:
+            self.keypaths.apply(record, trie)
+        if self.indexes is not None and trie is self.root:
+            self.indexes.apply(record, trie)
+        if self.cache is not None and trie is self.root:
+            self.cache.apply(record, trie)
+
+    def write(self, records):
+        """
+        Log the records, apply them to the trie and return once they are durable.
+        Logging and applying happen under the write lock so the log order is the trie order,
+        the wait for fsync happens after the lock is released so other writers join the same fsync
+        """
+        with self.lock.write_locked():
+            if self.wal is not None:
+                sequence = self.wal.append(records)
+            for record in records:
+                self.apply(record)
+
+        if self.wal is not None:
+            self.wal.wait_durable(sequence)
 
-    def put_request(self, key, value):
+    def put_request(self, key, value, version=None):
         """
-        insert the key-value pair into the trie
+        insert the key-value pair into the trie.
+        Writes without a version from the client are versioned with the server clock
         """
-        self.root.put(key, value)
+        self.write([['put', key, value, version or time.time_ns()]])
+
+    def put_many_request(self, items, version=None):
+        """
+        Insert a batch of key-value pairs while holding the write lock only once
+        """
+        version = version or time.time_ns()
+        self.write([['put', key, value, version] for key, value in items])
 
     def get_request(self, key):
         """
         Retrieve the value associated with the key from the trie
         """
-        return self.root.get(key)
+        with self.lock.read_locked():
+            return self.root.get(key)
+
+    def get_versioned_request(self, key):
+        """
+        Retrieve the value associated with the key and the version of the key,
+        replicas that disagree are reconciled by keeping the answer with the newest version
+        """
+        with self.lock.read_locked():
+            return self.root.get(key), self.root.version(key)
 
-    def delete_request(self, key):
+    def delete_request(self, key, version=None):
         """
         Delete the key and its associated value from the trie
         """
-        self.root.delete(key)
+        self.write([['delete', key, version or time.time_ns()]])
+
+    def query(self, keypath):
+        """
+        Return the value at the keypath, from the keypath index when it covers the key.
+        The caller holds the read lock
+        """
+        if self.keypaths is not None:
+            indexed, value = self.keypaths.lookup(keypath)
+            if indexed:
+                return value
+        return self.root.query(keypath)
 
     def query_request(self, keypath):
         """
         Retrieve the value or subkey associated with the keypath from the trie
         """
-        return self.root.query(keypath)
+        with self.lock.read_locked():
+            return self.query(keypath)
+
+    def query_versioned_request(self, keypath):
+        """
+        Retrieve the value of the keypath and the version of its top-level key
+        """
+        with self.lock.read_locked():
+            return self.query(keypath), self.root.version(keypath.split('.')[0])
+
+    def scan_request(self, prefix, limit, start_after=None, versions=False):
+        """
+        Return up to limit (key, value) pairs, or (key, value, version) with versions,
+        that start with prefix and sort after start_after.
+        Large scans are read one page at a time so the read lock is never held for long
+        """
+        with self.lock.read_locked():
+            return list(self.root.scan(prefix, limit, start_after, versions))
+
+    def find_request(self, path, low, high, limit=None, keep=None):
+        """
+        Return the (number, key) pairs whose indexed field lies between low and high, in ascending order,
+        at most limit of them and only the keys keep accepts when it is given
+        """
+        if self.indexes is None:
+            raise ValueError('The server was started without field indexes')
+        with self.lock.read_locked():
+            return self.indexes.find(path, low, high, limit, keep)
+
+    def compute_request(self, formula, evaluate=None):
+        """
+        Parse the formula and retrieve any required values from the key-value store.
+        With evaluate the formula and its bindings are handed to it, e.g. to run on a process pool
+        """
+        # the variables are bound under the read lock,
+        # the arithmetic runs after the lock is released
+        with self.lock.read_locked():
+            try:
+                compiled_expression, bindings = bind_formula(formula, self.query)
+            except ValueError as error:
+                return str(error)
+
+        if evaluate is not None:
+            return evaluate(formula, bindings)
+        return compiled_expression.evaluate(bindings)
+
+    def aggregate_request(self, formula, keep=None, page_size=10000):
+        """
+        Evaluate an aggregate COMPUTE over every key of its prefix, only the keys keep accepts when it is given.
+        The bound fields are gathered into one column per variable a page at a time under short read locks,
+        then the expression runs once over the whole columns instead of once per key
+        :return: the aggregate and the partial aggregate of this store (see aggregates.partial_aggregate)
+        """
+        aggregate, compiled_expression, prefix, bindings = compile_aggregate(' '.join(formula.split()))
+        columns = {variable: [] for variable, _ in bindings}
+        rows = 0
+        cursor = None
+        while True:
+            items = self.scan_request(prefix, page_size, cursor)
+            for key, value in items:
+                if keep is not None and not keep(key):
+                    continue
+                row = [field(value, path) for _, path in bindings]
+                if None in row:
+                    continue # records without every field are left out of the aggregate
+                for (variable, _), number in zip(bindings, row):
+                    columns[variable].append(float(number))
+                rows += 1
+            if len(items) < page_size:
+                break
+            cursor = items[-1][0]
+
+        return aggregate, partial_aggregate(aggregate, evaluate_columns(compiled_expression, columns, rows))
+
+    def compact_request(self, limit=1000):
+        """
+        Unlink a bounded number of expired tombstones, holding the write lock only for that batch.
+        A cached answer about an unlinked key would still report it as deleted, it is invalidated
+        """
+        with self.lock.write_locked():
+            return self.root.compact(limit, self.cache.invalidate if self.cache is not None else None)
+
+    def snapshot_request(self, page_size=10000):
+        """
+        Write a compacted snapshot of the trie and drop the WAL segments it covers.
+        The trie is copied one page at a time under short read locks, so writers keep going
+        while the snapshot is written. The copy may already contain writes logged after the
+        boundary, replaying them again on recovery gives the same result
+        :return: the WAL sequence number covered by the snapshot
+        """
+        if self.wal is None:
+            return None
+
+        with self.snapshot_lock:
+            return self.write_snapshot(page_size)
+
+    def write_snapshot(self, page_size):
+        boundary = self.wal.rotate()
+        if boundary == self.snapshot_sequence:
+            return boundary # nothing was written since the last snapshot
+
+        def pages():
+            cursor = None
+            while True:
+                items = self.scan_request('', page_size, cursor, versions=True)
+                yield from items
+                if len(items) < page_size:
+                    return
+                cursor = items[-1][0]
+
+        path = self.snapshots.write(boundary, pages())
+        if self.snapshot_format == 'mmap':
+            self.swap_base(path, boundary)
+        self.wal.remove_segments(boundary)
+        self.snapshots.remove_older(boundary)
+        self.snapshot_sequence = boundary
+        return boundary
+
+    def load_request(self, path, keep=None):
+        """
+        Populate an empty store from a key file sorted by key (see bulk_load.read_items),
+        only with the keys keep accepts when it is given.
+        The trie is built bottom-up in one pass instead of one PUT per key. A durable store
+        writes the pairs straight into a snapshot instead of the WAL, then serves it
+        :return: the number of keys loaded
+        """
+        with self.snapshot_lock, self.lock.write_locked():
+            if next(self.root.scan('', 1), None) is not None:
+                raise ValueError('LOAD needs an empty store')
+
+            items = ascending(read_items(path))
+            if keep is not None:
+                items = (item for item in items if keep(item[0]))
+            if self.wal is None:
+                root = self.new_trie()
+                root.load_sorted(items)
+            else:
+                boundary = self.wal.rotate()
+                snapshot_path = self.snapshots.write(boundary, items)
+                if self.snapshot_format == 'mmap':
+                    root = self.new_trie(MappedTrie(snapshot_path))
+                else:
+                    root = self.new_trie()
+                    root.load_sorted(SnapshotStore.load(snapshot_path))
+                self.wal.remove_segments(boundary)
+                self.snapshots.remove_older(boundary)
+                self.snapshot_sequence = boundary
+
+            previous_base = getattr(self.root, 'base', None)
+            self.root = root
+            if self.merkle is not None:
+                self.merkle.rebuild(root.scan(versions=True))
+            if self.keypaths is not None:
+                self.keypaths.rebuild(root.scan())
+            if self.indexes is not None:
+                self.indexes.rebuild(root.scan())
+            if self.cache is not None:
+                self.cache.clear()
+        if previous_base is not None:
+            previous_base.close()
+        return root.stats()['keys']
+
+    def swap_base(self, path, boundary):
+        """
+        Serve the new mapped snapshot and restart the overlay from the writes logged after it.
+        The overlay is rebuilt from the WAL under the write lock, so no write is lost between
+        the end of the snapshot and the swap, and the old overlay and mapping are released
+        """
+        base = MappedTrie(path)
+        with self.lock.write_locked():
+            self.wal.flush()
+            root = self.new_trie(base)
+            for record in WriteAheadLog.replay(self.wal.directory, boundary):
+                self.apply(record[1:], root)
+            previous_base = self.root.base
+            self.root = root
+        if previous_base is not None:
+            previous_base.close()
+
+    def merkle_request(self, peer, level, indexes):
+        """
+        Return the hashes of the given nodes of one level of the Merkle tree shared with peer
+        """
+        with self.lock.read_locked():
+            return self.merkle.hashes(peer, level, indexes)
+
+    def digest_request(self, peer, buckets):
+        """
+        Return the (key, version) pairs of the live keys in the buckets that peer owns as well
+        """
+        with self.lock.read_locked():
+            return self.merkle.digest(peer, buckets)
+
+    def bucket_records_request(self, peer, buckets):
+        """
+        Return the put records of the live keys in the buckets that peer owns as well
+        """
+        with self.lock.read_locked():
+            return [
+                ['put', key, self.root.get(key), version]
+                for key, version in self.merkle.digest(peer, buckets)
+            ]
+
+    def fetch_request(self, keys):
+        """
+        Return the current record of every key this store has a version for,
+        a put with the value of a live key or a delete for a deleted one
+        """
+        records = []
+        with self.lock.read_locked():
+            for key in keys:
+                version = self.merkle.version(key)
+                if version is not None:
+                    records.append(['put', key, self.root.get(key), version])
+                elif self.root.version(key):
+                    records.append(['delete', key, self.root.version(key)])
+        return records
+
+    def sync_request(self, records):
+        """
+        Apply the records a peer repairs this store with
+        :return: the current record of every key where this store holds a newer version than the peer sent
+        """
+        for record in records:
+            if record[0] not in ('put', 'delete') or len(record) != (4 if record[0] == 'put' else 3):
+                raise ValueError(f'Invalid record {record!r}')
+        self.write(records)
+        newer = self.fetch_request([record[1] for record in records])
+        sent = {record[1]: record[-1] for record in records}
+        return [record for record in newer if record[-1] > sent[record[1]]]
+
+    def forget_request(self, peer):
+        """
+        Take a peer that is lost for good off the ring of the Merkle index.
+        The trees are rebuilt under the write lock so no write slips between the old and the new owners
+        """
+        with self.lock.write_locked():
+            self.merkle.forget(peer, self.root.scan(versions=True))
+
+    def reshard_request(self, ring):
+        """
+        Switch the Merkle index to the ring of a finished membership change
+        """
+        with self.lock.write_locked():
+            self.merkle.set_ring(ring, self.root.scan(versions=True))
+
+    def close(self):
+        """
+        Flush and close the WAL
+        """
+        if self.wal is not None:
+            self.wal.close()
 
-    def compute_request(self, formula):
+    def stats_request(self):
         """
-        Parse the formula and retrieve any required values from the key-value store
+        Return the key, node, tombstone and reclaimed memory counters of the trie
+        and the WAL position when the store is durable
         """
-        return self.root.compute(formula)
+        with self.lock.read_locked():
+            stats = self.root.stats()
+        if self.wal is not None:
+            stats['wal_sequence'] = self.wal.sequence
+            stats['snapshot_sequence'] = self.snapshot_sequence
+        if self.merkle is not None:
+            stats['merkle_keys'] = len(self.merkle)
+        if self.keypaths is not None:
+            with self.lock.read_locked():
+                stats.update(self.keypaths.stats())
+        if self.indexes is not None:
+            with self.lock.read_locked():
+                stats.update(self.indexes.stats())
+        if self.cache is not None:
+            stats.update(self.cache.stats())
+        return stats
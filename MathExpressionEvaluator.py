@@ -1,7 +1,80 @@
+import re
 import math 
+import operator
 from decimal import Decimal
 import typing as tp
 
+# numbers, names (functions and variables), operators and parentheses
+TOKEN = re.compile(r'\s*(\d+(?:\.\d+)?|[A-Za-z_]\w*|[-+*/^()])')
+
+# arithmetic used by compiled expressions, operands are always Decimal
+OPERATIONS = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+    '^': operator.pow,
+}
+FUNCTIONS = {
+    'sin': math.sin,
+    'cos': math.cos,
+    'tan': math.tan,
+    'log': math.log10,
+    'log10': math.log10,
+}
+
+# instruction kinds of a compiled expression
+CONSTANT, VARIABLE, OPERATION, FUNCTION = range(4)
+
+
+class CompiledExpression:
+    """
+    An expression parsed once into a reverse polish program.
+    Evaluating it only binds the variable values and runs a stack loop.
+    It is immutable and keeps no state between evaluations, so one instance
+    is shared by every request and can be pickled to a worker process
+    """
+    __slots__ = ('program', 'variables')
+
+    def __init__(self, program: tp.Iterable[tp.Tuple[int, tp.Any]], variables: tp.Iterable[str]) -> None:
+        # (instruction kind, payload) pairs in reverse polish order
+        object.__setattr__(self, 'program', tuple(program))
+        # names that must be bound to evaluate the expression
+        object.__setattr__(self, 'variables', frozenset(variables))
+
+    def __setattr__(self, name: str, value: tp.Any) -> None:
+        raise AttributeError('CompiledExpression is immutable')
+
+    def __reduce__(self):
+        return CompiledExpression, (self.program, self.variables)
+
+    def evaluate(self, bindings: tp.Dict[str, tp.Any]) -> tp.Any:
+        """
+        Run the program with the numbers bound to its variables, the arithmetic is done on Decimals
+        """
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        for kind, payload in self.program:
+            if kind == CONSTANT:
+                push(payload)
+            elif kind == VARIABLE:
+                push(Decimal(bindings[payload]))
+            elif kind == OPERATION:
+                operand2 = pop()
+                push(payload(pop(), operand2))
+            else:
+                # Decimal(float) is exact, so an operand taken from it is the one the float gave
+                push(Decimal(payload(pop())))
+        result = pop()
+        # a function applied last answers with its float and a lone variable with its bound value, as they always did
+        kind, payload = self.program[-1]
+        if kind == FUNCTION:
+            return float(result)
+        if kind == VARIABLE:
+            return bindings[payload]
+        return result
+
 class MathExpressionEvaluator:
     
     @staticmethod
@@ -88,7 +161,7 @@ class MathExpressionEvaluator:
             return math.cos(operand)
         elif function == 'tan':
             return math.tan(operand)
-        elif function == 'log':
+        elif function in ('log', 'log10'):
             return math.log10(operand)
     
         return 'Invalid function!'
@@ -105,14 +178,16 @@ class MathExpressionEvaluator:
         output_queue = []
         operator_stack = []
 
-        while characters:
-            character = characters.pop(0)
+        for character in characters:
             if self.is_int(character):
                 output_queue.append(character)
             elif self.is_float(character):
                 output_queue.append(character)
             elif self.is_function(character, functions):
                 operator_stack.append(character)
+            elif character.isidentifier():
+                # a variable is an operand, its value is bound when the expression is evaluated
+                output_queue.append(character)
             elif self.is_operator(character, operators):
                 # While the operator stack is not empty 
                 # and the last element is an operator with greater precedence
@@ -184,3 +259,63 @@ class MathExpressionEvaluator:
 
         # The final result is the last element in the stack
         return stack.pop()
+
+    @staticmethod
+    def tokenize(expression: str) -> tp.List[str]:
+        """
+        Split an expression into numbers, names, operators and parentheses
+        """
+        tokens = []
+        position = 0
+        expression = expression.rstrip()
+        while position < len(expression):
+            match = TOKEN.match(expression, position)
+            if not match:
+                raise ValueError(f'Unexpected character {expression[position]!r} in expression')
+            tokens.append(match.group(1))
+            position = match.end()
+        return tokens
+
+    def compile(
+        self,
+        expression: str,
+        operators: dict,
+        functions: dict,
+        left_associative_operators: tp.List[str]
+    ) -> CompiledExpression:
+        """
+        Parse the expression once into a CompiledExpression
+        """
+        evaluated_expression = self.evaluate_expression(
+            self.tokenize(expression),
+            operators,
+            functions,
+            left_associative_operators
+        )
+
+        program = []
+        variables = set()
+        depth = 0 # stack depth reached by the program, checked so a malformed expression fails here
+        for character in evaluated_expression:
+            if self.is_operator(character, operators):
+                program.append((OPERATION, OPERATIONS[character]))
+                depth -= 1
+            elif self.is_function(character, functions):
+                program.append((FUNCTION, FUNCTIONS[character]))
+            elif character.isidentifier():
+                # before the numbers, so a variable named nan or inf is not taken for a constant
+                program.append((VARIABLE, character))
+                variables.add(character)
+                depth += 1
+            elif self.is_float(character):
+                program.append((CONSTANT, Decimal(character)))
+                depth += 1
+            else:
+                raise ValueError(f'Unbalanced parentheses in {expression!r}')
+            if depth < 1:
+                raise ValueError(f'Missing operand in {expression!r}')
+
+        if depth != 1:
+            raise ValueError(f'Missing operator in {expression!r}')
+
+        return CompiledExpression(program, variables)
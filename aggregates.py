@@ -0,0 +1,300 @@
+import re
+import math
+import bisect
+import numbers
+import functools
+import typing as tp
+from MathExpressionEvaluator import CONSTANT, VARIABLE, OPERATION, CompiledExpression, MathExpressionEvaluator
+from trie_structure import FUNCTIONS, LEFT_ASSOCIATIVE_OPERATORS, OPERATORS
+
+try:
+    import numpy
+except ImportError: # the columns are evaluated with list comprehensions instead
+    numpy = None
+
+# COMPUTE <aggregate>(<expression>) OVER <prefix> WHERE <variable> = FIELD <path> [AND ...],
+# the aggregate is SUM, AVG, MIN, MAX, COUNT or a percentile such as P50 or P99.9
+AGGREGATE = re.compile(
+    r'compute\s+(?P<aggregate>sum|avg|min|max|count|p\d{1,2}(?:\.\d+)?)\s*\((?P<expression>.+)\)'
+    r'\s+over\s+(?P<prefix>\S+)\s+where\s+(?P<bindings>.+)',
+    re.IGNORECASE
+)
+FIELD_BINDING = re.compile(r'(?P<variable>\w+)\s*=\s*field\s+(?P<path>\S+)', re.IGNORECASE)
+BINDING_SEPARATOR = re.compile(r'\s+and\s+', re.IGNORECASE)
+
+# the numpy ufunc of every function a formula can call
+NUMPY_FUNCTIONS = {
+    math.sin: 'sin',
+    math.cos: 'cos',
+    math.tan: 'tan',
+    math.log10: 'log10',
+}
+
+Partial = tp.Dict[str, tp.Any]
+
+
+def is_aggregate(formula: str) -> bool:
+    return AGGREGATE.fullmatch(' '.join(formula.split())) is not None
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_aggregate(formula: str) -> tp.Tuple[str, CompiledExpression, str, tp.Tuple[tp.Tuple[str, tp.Tuple[str, ...]], ...]]:
+    """
+    Parse a whitespace normalized aggregate COMPUTE into its aggregate, the compiled expression,
+    the key prefix ('' for OVER *) and the (variable, field path) bindings
+    """
+    formula_match = AGGREGATE.fullmatch(formula)
+    if not formula_match:
+        raise ValueError("Invalid aggregate formula")
+
+    bindings = []
+    for binding in BINDING_SEPARATOR.split(formula_match.group('bindings')):
+        binding_match = FIELD_BINDING.fullmatch(binding)
+        if not binding_match:
+            raise ValueError("Invalid field binding")
+        if any(variable == binding_match.group('variable') for variable, _ in bindings):
+            raise ValueError(f"Variable {binding_match.group('variable')} is bound twice")
+        bindings.append((binding_match.group('variable'), tuple(binding_match.group('path').split('.'))))
+
+    try:
+        compiled_expression = MathExpressionEvaluator().compile(
+            formula_match.group('expression'),
+            OPERATORS,
+            FUNCTIONS,
+            LEFT_ASSOCIATIVE_OPERATORS
+        )
+    except (ValueError, KeyError):
+        raise ValueError("Invalid computation formula")
+
+    missing = compiled_expression.variables - {variable for variable, _ in bindings}
+    if missing:
+        raise ValueError(f"Variable {', '.join(sorted(missing))} has no value")
+
+    prefix = formula_match.group('prefix')
+    return formula_match.group('aggregate').upper(), compiled_expression, '' if prefix == '*' else prefix, tuple(bindings)
+
+
+def field(value: tp.Any, path: tp.Tuple[str, ...]) -> tp.Optional[numbers.Number]:
+    """
+    Return the number at path inside a stored value, None when the path is missing or not a number
+    """
+    for name in path:
+        if not isinstance(value, dict) or name not in value:
+            return None
+        value = value[name]
+    if not isinstance(value, numbers.Number) or isinstance(value, bool):
+        return None
+    return value
+
+
+def safe(operation: tp.Callable[..., tp.Any]) -> tp.Callable[..., float]:
+    """
+    Wrap an operation so a division by zero, an overflow or a complex result gives NaN, as it does with numpy
+    """
+    def apply(*operands: float) -> float:
+        try:
+            result = operation(*operands)
+        except (ZeroDivisionError, OverflowError, ValueError):
+            return math.nan
+        return result if isinstance(result, float) else float(result) if isinstance(result, int) else math.nan
+
+    return apply
+
+
+def evaluate_columns(compiled_expression: CompiledExpression, columns: tp.Dict[str, tp.List[float]], rows: int) -> tp.List[float]:
+    """
+    Evaluate the expression for every row in one pass over its program, each instruction
+    applied to whole columns at once: as numpy arrays when numpy is installed, as lists otherwise.
+    Rows the expression is not defined for give NaN
+    """
+    stack: tp.List[tp.Any] = []
+    push = stack.append
+    pop = stack.pop
+    if numpy is not None:
+        with numpy.errstate(all='ignore'):
+            for kind, payload in compiled_expression.program:
+                if kind == CONSTANT:
+                    push(float(payload))
+                elif kind == VARIABLE:
+                    push(numpy.asarray(columns[payload], dtype=numpy.float64))
+                elif kind == OPERATION:
+                    operand2 = pop()
+                    operand1 = pop()
+                    # constants become numpy scalars so they follow errstate as well
+                    if not isinstance(operand1, numpy.ndarray):
+                        operand1 = numpy.float64(operand1)
+                    push(payload(operand1, operand2))
+                else:
+                    push(getattr(numpy, NUMPY_FUNCTIONS[payload])(pop()))
+            return numpy.broadcast_to(numpy.asarray(pop(), dtype=numpy.float64), (rows,)).tolist()
+
+    for kind, payload in compiled_expression.program:
+        if kind == CONSTANT:
+            push(float(payload))
+        elif kind == VARIABLE:
+            push(columns[payload])
+        elif kind == OPERATION:
+            operation = safe(payload)
+            operand2 = pop()
+            operand1 = pop()
+            if isinstance(operand1, list) and isinstance(operand2, list):
+                push([operation(a, b) for a, b in zip(operand1, operand2)])
+            elif isinstance(operand1, list):
+                push([operation(a, operand2) for a in operand1])
+            elif isinstance(operand2, list):
+                push([operation(operand1, b) for b in operand2])
+            else:
+                push(operation(operand1, operand2))
+        else:
+            function = safe(payload)
+            operand = pop()
+            push([function(a) for a in operand] if isinstance(operand, list) else function(operand))
+    result = pop()
+    return result if isinstance(result, list) else [result] * rows
+
+
+class Sketch:
+    """
+    Mergeable quantile sketch in the style of DDSketch. A value x > 0 falls into bucket
+    ceil(log(x) / log(gamma)) with gamma = (1 + accuracy) / (1 - accuracy), negative values into
+    the same buckets of -x, so any quantile is answered within the relative accuracy and two
+    sketches merge by adding their bucket counts, whatever servers they were built on
+    """
+
+    def __init__(self, accuracy: float = 0.01) -> None:
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive: tp.Dict[int, int] = {}
+        self.negative: tp.Dict[int, int] = {}
+        self.zero = 0
+        self.count = 0
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        if value > 0:
+            bucket = math.ceil(math.log(value) / self.log_gamma)
+            self.positive[bucket] = self.positive.get(bucket, 0) + 1
+        elif value < 0:
+            bucket = math.ceil(math.log(-value) / self.log_gamma)
+            self.negative[bucket] = self.negative.get(bucket, 0) + 1
+        else:
+            self.zero += 1
+
+    def merge(self, other: 'Sketch') -> None:
+        for buckets, other_buckets in ((self.positive, other.positive), (self.negative, other.negative)):
+            for bucket, count in other_buckets.items():
+                buckets[bucket] = buckets.get(bucket, 0) + count
+        self.zero += other.zero
+        self.count += other.count
+
+    def value(self, bucket: int) -> float:
+        # the point of the bucket with the same relative distance to both of its bounds
+        return 2 * self.gamma ** bucket / (self.gamma + 1)
+
+    def quantile(self, fraction: float) -> tp.Optional[float]:
+        if not self.count:
+            return None
+        rank = fraction * (self.count - 1)
+        seen = 0
+        for bucket in sorted(self.negative, reverse=True):
+            seen += self.negative[bucket]
+            if seen > rank:
+                return -self.value(bucket)
+        seen += self.zero
+        if seen > rank:
+            return 0.0
+        for bucket in sorted(self.positive):
+            seen += self.positive[bucket]
+            if seen > rank:
+                return self.value(bucket)
+        return self.value(max(self.positive))
+
+    def to_json(self) -> tp.Dict[str, tp.Any]:
+        return {
+            'accuracy': self.accuracy,
+            'positive': {str(bucket): count for bucket, count in self.positive.items()},
+            'negative': {str(bucket): count for bucket, count in self.negative.items()},
+            'zero': self.zero,
+        }
+
+    @classmethod
+    def from_json(cls, data: tp.Dict[str, tp.Any]) -> 'Sketch':
+        sketch = cls(data['accuracy'])
+        sketch.positive = {int(bucket): count for bucket, count in data['positive'].items()}
+        sketch.negative = {int(bucket): count for bucket, count in data['negative'].items()}
+        sketch.zero = data['zero']
+        sketch.count = sum(sketch.positive.values()) + sum(sketch.negative.values()) + sketch.zero
+        return sketch
+
+
+def partial_aggregate(aggregate: str, values: tp.Iterable[float]) -> Partial:
+    """
+    Reduce the values of one server to the partial aggregate the client merges with the other servers,
+    with a quantile sketch for percentiles. NaN and infinite values are left out
+    """
+    finite = [value for value in values if math.isfinite(value)]
+    partial: Partial = {
+        'count': len(finite),
+        'sum': math.fsum(finite),
+        'min': min(finite, default=None),
+        'max': max(finite, default=None),
+    }
+    if aggregate.startswith('P'):
+        sketch = Sketch()
+        for value in finite:
+            sketch.add(value)
+        partial['sketch'] = sketch.to_json()
+    return partial
+
+
+def merge_partials(partials: tp.List[Partial]) -> Partial:
+    merged: Partial = {'count': 0, 'sum': 0.0, 'min': None, 'max': None}
+    sketch = None
+    for partial in partials:
+        merged['count'] += partial['count']
+        merged['sum'] += partial['sum']
+        for name, pick in (('min', min), ('max', max)):
+            if partial[name] is not None:
+                merged[name] = partial[name] if merged[name] is None else pick(merged[name], partial[name])
+        if 'sketch' in partial:
+            if sketch is None:
+                sketch = Sketch.from_json(partial['sketch'])
+            else:
+                sketch.merge(Sketch.from_json(partial['sketch']))
+    if sketch is not None:
+        merged['sketch'] = sketch.to_json()
+    return merged
+
+
+def finish(aggregate: str, partial: Partial) -> tp.Optional[float]:
+    """
+    Return the value of the aggregate from a partial aggregate, None when no record had the fields
+    """
+    if aggregate == 'COUNT':
+        return partial['count']
+    if not partial['count']:
+        return None
+    if aggregate == 'SUM':
+        return partial['sum']
+    if aggregate == 'AVG':
+        return partial['sum'] / partial['count']
+    if aggregate in ('MIN', 'MAX'):
+        return partial[aggregate.lower()]
+    return Sketch.from_json(partial['sketch']).quantile(float(aggregate[1:]) / 100)
+
+
+class HashRanges:
+    """
+    Half open [start, end) ranges of the ring hash a server aggregates the keys of,
+    so keys stored on several replicas are counted by one of them only
+    """
+
+    def __init__(self, ranges: tp.Iterable[tp.Sequence[int]]) -> None:
+        ordered = sorted(ranges)
+        self.starts = [start for start, _ in ordered]
+        self.ends = [end for _, end in ordered]
+
+    def __contains__(self, position: int) -> bool:
+        index = bisect.bisect_right(self.starts, position) - 1
+        return index >= 0 and position < self.ends[index]
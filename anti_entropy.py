@@ -0,0 +1,252 @@
+import json
+import socket
+import hashlib
+import typing as tp
+from hash_ring import HashRing, ring_hash
+from wire_protocol import HEADER, FramedConnection
+
+# a WAL record without its sequence number, ['put', key, value, version] or ['delete', key, version]
+Record = tp.List[tp.Any]
+
+
+def entry_hash(key: str, version: int) -> int:
+    """
+    Hash one live key together with its version, so replicas holding different versions differ
+    """
+    return int.from_bytes(hashlib.blake2b(f'{key}\0{version}'.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class MerkleTree:
+    """
+    Binary hash tree over 2**depth buckets of the key hash space.
+    A bucket hashes to the XOR of the hashes of its entries and every inner node to the XOR
+    of its two children, so adding or removing an entry updates one node per level in place
+    """
+
+    def __init__(self, depth: int) -> None:
+        self.depth = depth
+        self.levels = [[0] * (1 << level) for level in range(depth + 1)] # levels[0] is the root
+
+    def toggle(self, bucket: int, digest: int) -> None:
+        """
+        Add an entry to the bucket, or remove it again since XOR is its own inverse
+        """
+        for level in range(self.depth, -1, -1):
+            self.levels[level][bucket] ^= digest
+            bucket >>= 1
+
+
+class MerkleIndex:
+    """
+    The live keys of one server grouped into buckets by the top bits of their ring hash,
+    with one MerkleTree per peer over the keys both servers own on the ring.
+    Every write updates the trees in place, so two replicas find the buckets they disagree on
+    by comparing a few levels of their trees and only those buckets are exchanged
+    """
+
+    def __init__(self, name: str, ring: HashRing, k: int, depth: int = 12) -> None:
+        if name not in ring:
+            raise ValueError(f'{name} is not one of the servers on the ring')
+        self.name = name
+        self.ring = ring
+        self.k = k
+        self.depth = depth
+        self.buckets: tp.List[tp.Dict[str, int]] = [{} for _ in range(1 << depth)] # key -> version
+        self.trees = {peer: MerkleTree(depth) for peer in ring.nodes if peer != name}
+
+    def bucket(self, key: str) -> int:
+        return ring_hash(key) >> (64 - self.depth)
+
+    def shared_peers(self, key: str) -> tp.List[str]:
+        """
+        Return the other servers that own the key together with this one
+        """
+        owners = self.ring.owners(key, self.k)
+        if self.name not in owners:
+            return []
+        return [owner for owner in owners if owner != self.name]
+
+    def toggle(self, key: str, version: int, bucket: int) -> None:
+        digest = entry_hash(key, version)
+        for peer in self.shared_peers(key):
+            self.trees[peer].toggle(bucket, digest)
+
+    def put(self, key: str, version: int) -> None:
+        bucket = self.bucket(key)
+        entries = self.buckets[bucket]
+        previous = entries.get(key)
+        if previous is not None:
+            self.toggle(key, previous, bucket)
+        entries[key] = version
+        self.toggle(key, version, bucket)
+
+    def discard(self, key: str) -> None:
+        bucket = self.bucket(key)
+        version = self.buckets[bucket].pop(key, None)
+        if version is not None:
+            self.toggle(key, version, bucket)
+
+    def apply(self, record: Record, trie: tp.Any) -> None:
+        """
+        Follow one record the trie has just been given. Writes the trie ignored because it
+        holds a newer version, live or deleted, leave the index as it is
+        """
+        if record[0] == 'put':
+            _, key, _, version = record
+            if trie.version(key) == version:
+                self.put(key, version)
+        elif record[0] == 'delete':
+            _, key, version = record
+            if self.version(key) is not None and version >= self.version(key):
+                self.discard(key)
+
+    def rebuild(self, items: tp.Iterable[tp.Sequence[tp.Any]]) -> None:
+        """
+        Index the (key, value, version) items of a whole store
+        """
+        for entries in self.buckets:
+            entries.clear()
+        self.trees = {peer: MerkleTree(self.depth) for peer in self.trees}
+        for key, _, version in items:
+            self.put(key, version)
+
+    def forget(self, peer: str, items: tp.Iterable[tp.Sequence[tp.Any]]) -> None:
+        """
+        Take a peer off the ring for good and index the (key, value, version) items of the store again,
+        since the keys it owned now belong to other servers
+        """
+        self.ring.remove(peer)
+        self.set_ring(self.ring, items)
+
+    def set_ring(self, ring: HashRing, items: tp.Iterable[tp.Sequence[tp.Any]]) -> None:
+        """
+        Switch to the ring of a membership change, with one tree per server on it, and index the items again
+        """
+        self.ring = ring
+        self.trees = {peer: MerkleTree(self.depth) for peer in ring.nodes if peer != self.name}
+        self.rebuild(items)
+
+    def version(self, key: str) -> tp.Optional[int]:
+        """
+        Return the version of a live key, None when the key is not live
+        """
+        return self.buckets[self.bucket(key)].get(key)
+
+    def hashes(self, peer: str, level: int, indexes: tp.Iterable[int]) -> tp.List[int]:
+        tree = self.trees.get(peer)
+        if tree is None:
+            raise ValueError(f'{peer} is not a peer of {self.name}')
+        return [tree.levels[level][index] for index in indexes]
+
+    def digest(self, peer: str, buckets: tp.Iterable[int]) -> tp.List[tp.Tuple[str, int]]:
+        """
+        Return the (key, version) pairs of the buckets that peer owns as well
+        """
+        return [
+            (key, version)
+            for bucket in buckets
+            for key, version in self.buckets[bucket].items()
+            if peer in self.shared_peers(key)
+        ]
+
+    def __len__(self) -> int:
+        return sum(len(entries) for entries in self.buckets)
+
+
+def repair(store: tp.Any, connection: FramedConnection, peer: str, step: int = 4) -> tp.Dict[str, int]:
+    """
+    Bring this store and one peer to the same state for the keys they both own.
+    The Merkle trees are compared from the root down, step levels per round trip and only
+    under nodes that differ. The keys of the differing buckets are then compared by version:
+    newer records are sent to the peer, newer records of the peer are fetched, and the peer
+    answers with its own newer state for any record it had to ignore
+    :param store: the KVServer of this process
+    :return: the round trips, bytes on the wire, differing buckets and records moved each way
+    """
+    index = store.merkle
+    stats = {'messages': 0, 'bytes': 0, 'buckets': 0, 'pushed': 0, 'pulled': 0}
+
+    def request(text: str, payload: tp.Any) -> tp.Any:
+        body = json.dumps(payload).encode('utf-8')
+        connection.send(text, body)
+        frame = connection.recv()
+        if frame is None:
+            raise OSError(f'{peer} closed the connection')
+        response, response_body = frame
+        stats['messages'] += 1
+        stats['bytes'] += 2 * HEADER.size + len(text) + len(body) + len(response) + len(response_body)
+        if response != 'OK':
+            raise ValueError(f'{peer} answered {response}')
+        return json.loads(response_body)
+
+    level, indexes = 0, [0]
+    while True:
+        theirs = request(f'MERKLE {index.name} {level}', indexes)
+        ours = store.merkle_request(peer, level, indexes)
+        differing = [node for node, mine, other in zip(indexes, ours, theirs) if mine != other]
+        if level == index.depth or not differing:
+            break
+        next_level = min(index.depth, level + step)
+        shift = next_level - level
+        indexes = [child for node in differing for child in range(node << shift, (node + 1) << shift)]
+        level = next_level
+
+    stats['buckets'] = len(differing)
+    if not differing:
+        return stats
+
+    # a bucket this store holds nothing of in common with the peer hashes to 0,
+    # its records are fetched at once instead of listing their versions first
+    ours = store.merkle_request(peer, index.depth, differing)
+    empty = [bucket for bucket, digest in zip(differing, ours) if not digest]
+    listed = [bucket for bucket, digest in zip(differing, ours) if digest]
+    response = request(f'DIGEST {index.name}', {'versions': listed, 'records': empty})
+    push: tp.List[Record] = []
+    pull: tp.List[str] = []
+    if response['records']:
+        stats['pulled'] += len(response['records'])
+        # records older than a delete this store still remembers are sent back as that delete
+        push.extend(store.sync_request(response['records']))
+
+    theirs = dict(response['versions'])
+    ours = dict(store.digest_request(peer, listed))
+    keys = [key for key in ours.keys() | theirs.keys() if ours.get(key) != theirs.get(key)]
+    # our current state of each key includes deletes, which the digests leave out
+    current = {record[1]: record for record in store.fetch_request(keys)}
+
+    for key in keys:
+        record = current.get(key)
+        their_version = theirs.get(key, 0)
+        if record is not None and record[-1] > their_version:
+            push.append(record)
+        elif their_version > (record[-1] if record is not None else 0):
+            pull.append(key)
+
+    if pull:
+        records = request('FETCH', pull)
+        store.write(records)
+        stats['pulled'] += len(records)
+    if push:
+        newer = request('SYNC', push)
+        stats['pushed'] += len(push)
+        if newer:
+            store.write(newer)
+            stats['pulled'] += len(newer)
+    return stats
+
+
+def repair_with(store: tp.Any, peer: str, timeout: float = 30.0) -> tp.Dict[str, int]:
+    """
+    Open a connection to the peer named "ip:port" and run one repair over it
+    """
+    host, port = peer.rsplit(':', 1)
+    connection = FramedConnection(socket.create_connection((host, int(port)), timeout=timeout))
+    try:
+        return repair(store, connection, peer)
+    finally:
+        try:
+            connection.send('exit')
+            connection.recv()
+        except OSError:
+            pass
+        connection.close()
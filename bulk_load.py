@@ -0,0 +1,99 @@
+import os
+import json
+import heapq
+import tempfile
+import typing as tp
+from mmap_trie import MappedTrie
+from persistence import SNAPSHOT_PREFIX
+
+# (key, value) or (key, value, version)
+Item = tp.Tuple[tp.Any, ...]
+
+
+def read_items(path: str) -> tp.Iterator[Item]:
+    """
+    Yield the (key, value) or (key, value, version) items of a key file in file order.
+    A key file is either a mapped trie file (.trie) or JSON lines, each line a document
+    such as {"key": value, ...} as the client sends them or a [key, value, version] item as in
+    a jsonl snapshot, whose {"sequence": n} header line is skipped
+    """
+    if path.endswith('.trie'):
+        base = MappedTrie(path)
+        try:
+            yield from base.scan(versions=True)
+        finally:
+            base.close()
+        return
+
+    with open(path, 'rb') as f:
+        if os.path.basename(path).startswith(SNAPSHOT_PREFIX):
+            f.readline() # the snapshot header
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as error:
+                raise ValueError(f'Line {line_number} of {path} is not valid JSON: {error}')
+            if isinstance(record, dict):
+                yield from record.items()
+            elif isinstance(record, list) and len(record) in (2, 3) and isinstance(record[0], str):
+                yield tuple(record)
+            else:
+                raise ValueError(f'Line {line_number} of {path} is neither a document nor a [key, value] item')
+
+
+def ascending(items: tp.Iterable[Item]) -> tp.Iterator[Item]:
+    """
+    Pass the items through, failing as soon as a key is smaller than the key before it.
+    Repeated keys are allowed, whoever consumes the items keeps the last value
+    """
+    previous_key = None
+    for item in items:
+        key = item[0]
+        if previous_key is not None and key < previous_key:
+            raise ValueError(f'Keys must be in ascending order, {key!r} came after {previous_key!r}')
+        previous_key = key
+        yield item
+
+
+def sort_items(items: tp.Iterable[Item], run_size: int = 100000) -> tp.Iterator[Item]:
+    """
+    External merge sort: sort the items run_size at a time into temporary files
+    and merge the runs, so inputs larger than memory can be sorted.
+    Items with the same key keep their input order
+    """
+    with tempfile.TemporaryDirectory(prefix='kv-sort-') as directory:
+        runs = []
+        run: tp.List[Item] = []
+
+        def write_run() -> None:
+            run.sort(key=lambda item: item[0])
+            path = os.path.join(directory, f'run-{len(runs):06d}.jsonl')
+            with open(path, 'wb') as f:
+                for item in run:
+                    f.write(json.dumps(item).encode('utf-8') + b'\n')
+            runs.append(path)
+            run.clear()
+
+        for item in items:
+            run.append(item)
+            if len(run) >= run_size:
+                write_run()
+
+        # a single run never leaves memory
+        if not runs:
+            run.sort(key=lambda item: item[0])
+            yield from run
+            return
+        if run:
+            write_run()
+
+        def read_run(path: str) -> tp.Iterator[Item]:
+            with open(path, 'rb') as f:
+                for line in f:
+                    yield tuple(json.loads(line))
+
+        # on equal keys heapq.merge prefers the earlier run, which holds the earlier items
+        yield from heapq.merge(*(read_run(path) for path in runs), key=lambda item: item[0])
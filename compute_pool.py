@@ -0,0 +1,81 @@
+import os
+import time
+import threading
+import typing as tp
+import multiprocessing
+from decimal import Decimal
+from concurrent.futures import ProcessPoolExecutor
+from trie_structure import compile_formula
+
+
+class ComputeBusy(Exception):
+    """
+    Raised when every process of the compute pool is busy and its queue is full
+    """
+
+
+def watch_server(server_pid: int) -> None:
+    """
+    Exit a pool process once the server that started it is gone, also when the server was killed
+    before it could shut the pool down
+    """
+    def watch() -> None:
+        while os.getppid() == server_pid:
+            time.sleep(1.0)
+        os._exit(0)
+
+    threading.Thread(target=watch, daemon=True).start()
+
+
+def evaluate(formula: str, bindings: tp.Dict[str, Decimal]) -> tp.Any:
+    """
+    Evaluate a bound COMPUTE formula in a process of the pool. Every process keeps its own
+    formula cache, so only the formula text and the variable values cross the process boundary
+    """
+    compiled_expression, _ = compile_formula(' '.join(formula.split()))
+    return compiled_expression.evaluate(bindings)
+
+
+class ComputePool:
+    """
+    Bounded process pool that evaluates COMPUTE formulas off the connection threads, so the
+    arithmetic of a burst of heavy formulas never holds the interpreter lock the reads need.
+    The variables are bound in the server beforehand, only the formula and the values of its
+    variables are sent. At most processes + queue_depth formulas are admitted at once,
+    one more is refused at once with ComputeBusy instead of waiting behind the others
+    """
+
+    def __init__(self, processes: int, queue_depth: int) -> None:
+        # spawned rather than forked, a fork would copy the locks the server threads hold
+        self.executor = ProcessPoolExecutor(
+            processes,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=watch_server,
+            initargs=(os.getpid(),)
+        )
+        self.slots = threading.BoundedSemaphore(processes + queue_depth)
+        self.lock = threading.Lock()
+        self.admitted = 0 # formulas evaluated by the pool since the server started
+        self.rejected = 0 # formulas refused because the pool was saturated
+
+    def evaluate(self, formula: str, bindings: tp.Dict[str, Decimal]) -> tp.Any:
+        """
+        Evaluate a bound formula on the pool and wait for its result
+        """
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            raise ComputeBusy('Every compute process is busy')
+        try:
+            with self.lock:
+                self.admitted += 1
+            return self.executor.submit(evaluate, formula, bindings).result()
+        finally:
+            self.slots.release()
+
+    def stats(self) -> tp.Dict[str, int]:
+        with self.lock:
+            return {'compute_admitted': self.admitted, 'compute_rejected': self.rejected}
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,162 @@
+import time
+import asyncio
+import typing as tp
+from wire_protocol import AsyncFramedConnection, Frame, ProtocolError, encode_frame, read_frame
+
+
+class ServerPool:
+    """
+    Connections to one server, opened on demand and reused across requests.
+    A failed request closes its connection and marks the server down. While it is down,
+    reconnect attempts are spaced out with exponential backoff until one succeeds
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        max_connections: int = 4,
+        min_backoff: float = 0.5,
+        max_backoff: float = 30.0
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.name = f'{host}:{port}'
+        self.slots = asyncio.Semaphore(max_connections) # connections lent out at the same time
+        self.idle: tp.List[AsyncFramedConnection] = []
+        # the pings have a connection of their own, so they never wait for a slot behind long requests
+        self.heartbeat: tp.Optional[AsyncFramedConnection] = None
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.healthy = True
+        self.failures = 0 # failed attempts since the server was last up
+        self.retry_at = 0.0 # monotonic time of the next reconnect attempt while down
+        self.down_since = 0.0 # monotonic time the server was last found down
+
+    async def acquire(self) -> AsyncFramedConnection:
+        await self.slots.acquire()
+        if self.idle:
+            return self.idle.pop()
+        try:
+            return await AsyncFramedConnection.open(self.host, self.port)
+        except OSError:
+            self.slots.release()
+            self.mark_down()
+            raise
+
+    def release(self, connection: AsyncFramedConnection, reusable: bool = True) -> None:
+        if reusable:
+            self.idle.append(connection)
+        else:
+            connection.close()
+        self.slots.release()
+
+    async def request(self, text: str, body: bytes = b'') -> Frame:
+        """
+        Send one request on a pooled connection and return its response
+        """
+        connection = await self.acquire()
+        try:
+            frame = await connection.request(text, body)
+        except (OSError, ProtocolError):
+            self.release(connection, reusable=False)
+            self.mark_down()
+            raise
+        except BaseException:
+            # cancelled half way, the response may still arrive on this connection
+            self.release(connection, reusable=False)
+            raise
+
+        if frame is None:
+            self.release(connection, reusable=False)
+            self.mark_down()
+            raise OSError(f'{self.name} closed the connection')
+        self.release(connection)
+        return frame
+
+    async def stream(self, text: str) -> tp.AsyncIterator[Frame]:
+        """
+        Send one request and yield its response frames up to the first one that is not a CHUNK
+        """
+        connection = await self.acquire()
+        finished = False
+        try:
+            connection.writer.write(encode_frame(text))
+            await connection.writer.drain()
+            while True:
+                frame = await read_frame(connection.reader)
+                if frame is None:
+                    self.mark_down()
+                    raise OSError(f'{self.name} closed the connection')
+                yield frame
+                if frame[0] != 'CHUNK':
+                    finished = True
+                    return
+        except (OSError, ProtocolError):
+            self.mark_down()
+            raise
+        finally:
+            # a stream left half read would hand the next request the rest of it
+            self.release(connection, reusable=finished)
+
+    async def check(self, timeout: float) -> bool:
+        """
+        Ping the server, while it is down only once its backoff has passed
+        :return: whether the server answered
+        """
+        if not self.healthy and time.monotonic() < self.retry_at:
+            return False
+        # taken out while in use, a concurrent check opens a connection of its own
+        connection, self.heartbeat = self.heartbeat, None
+        try:
+            if connection is None:
+                connection = await asyncio.wait_for(AsyncFramedConnection.open(self.host, self.port), timeout)
+            frame = await asyncio.wait_for(connection.request('ping'), timeout)
+        except (OSError, ProtocolError, asyncio.TimeoutError):
+            # a ping cut off by the timeout may still be answered on this connection
+            if connection is not None:
+                connection.close()
+            self.mark_down()
+            return False
+        except BaseException:
+            if connection is not None:
+                connection.close()
+            raise
+        if frame is None or frame[0].lower() != 'pong':
+            connection.close()
+            self.mark_down()
+            return False
+        if self.heartbeat is None:
+            self.heartbeat = connection
+        else:
+            connection.close()
+        self.mark_up()
+        return True
+
+    def mark_down(self) -> None:
+        if self.healthy:
+            print(f'[Client]: {self.name} is down')
+            self.down_since = time.monotonic()
+        self.healthy = False
+        self.failures += 1
+        backoff = min(self.max_backoff, self.min_backoff * 2 ** (self.failures - 1))
+        self.retry_at = time.monotonic() + backoff
+        # connections opened before the failure are most likely broken too
+        while self.idle:
+            self.idle.pop().close()
+        if self.heartbeat is not None:
+            self.heartbeat.close()
+            self.heartbeat = None
+
+    def mark_up(self) -> None:
+        if not self.healthy:
+            print(f'[Client]: {self.name} is up again')
+        self.healthy = True
+        self.failures = 0
+
+    def close(self) -> None:
+        while self.idle:
+            self.idle.pop().close()
+        if self.heartbeat is not None:
+            self.heartbeat.close()
+            self.heartbeat = None
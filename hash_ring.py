@@ -0,0 +1,103 @@
+import bisect
+import hashlib
+import typing as tp
+
+RING_SIZE = 2 ** 64 # ring_hash positions are 64 bit
+
+
+def ring_hash(value: str) -> int:
+    """
+    Map a string to a 64 bit position on the ring
+    """
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """
+    Consistent hash ring with virtual nodes.
+    Every node is hashed onto the ring at virtual_nodes positions and a key belongs to the
+    first distinct nodes found walking clockwise from the key's own position. Adding or
+    removing a node only moves the keys next to its positions, and the many positions
+    per node spread the keys evenly
+    """
+
+    def __init__(self, nodes: tp.Iterable[str] = (), virtual_nodes: int = 128) -> None:
+        self.virtual_nodes = virtual_nodes
+        self.nodes: tp.Set[str] = set()
+        self.positions: tp.List[int] = [] # sorted ring positions
+        self.position_nodes: tp.List[str] = [] # the node at each position
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node: str) -> None:
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for replica in range(self.virtual_nodes):
+            position = ring_hash(f'{node}#{replica}')
+            index = bisect.bisect(self.positions, position)
+            self.positions.insert(index, position)
+            self.position_nodes.insert(index, node)
+
+    def remove(self, node: str) -> None:
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        kept = [
+            (position, owner)
+            for position, owner in zip(self.positions, self.position_nodes)
+            if owner != node
+        ]
+        self.positions = [position for position, _ in kept]
+        self.position_nodes = [owner for _, owner in kept]
+
+    def owners(self, key: str, count: int) -> tp.List[str]:
+        """
+        Return the count nodes that hold the key, its primary first.
+        Fewer are returned when the ring has fewer nodes
+        """
+        return self.walk(bisect.bisect(self.positions, ring_hash(key)), count)
+
+    def walk(self, index: int, count: int) -> tp.List[str]:
+        """
+        Return the first count distinct nodes clockwise from the position at index
+        """
+        count = min(count, len(self.nodes))
+        owners: tp.List[str] = []
+        if not count:
+            return owners
+
+        size = len(self.positions)
+        while len(owners) < count:
+            node = self.position_nodes[index % size]
+            if node not in owners:
+                owners.append(node)
+            index += 1
+        return owners
+
+    def primary_ranges(self, count: int, usable: tp.Container[str]) -> tp.Dict[str, tp.List[tp.Tuple[int, int]]]:
+        """
+        Split the ring into [start, end) hash ranges and give each to the first usable node of its
+        count owners, so every key held by a usable node belongs to exactly one of them.
+        Ranges none of whose owners is usable are left out
+        """
+        ranges: tp.Dict[str, tp.List[tp.Tuple[int, int]]] = {}
+        start = 0
+        # the keys before the position at index are held by the owners walked from index,
+        # the keys after the last position wrap around to the first
+        for index, end in enumerate(self.positions + [RING_SIZE]):
+            node = next((owner for owner in self.walk(index, count) if owner in usable), None)
+            if node is not None and start < end:
+                node_ranges = ranges.setdefault(node, [])
+                if node_ranges and node_ranges[-1][1] == start:
+                    node_ranges[-1] = (node_ranges[-1][0], end)
+                else:
+                    node_ranges.append((start, end))
+            start = end
+        return ranges
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def __contains__(self, node: str) -> bool:
+        return node in self.nodes
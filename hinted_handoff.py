@@ -0,0 +1,142 @@
+import os
+import json
+import socket
+import itertools
+import threading
+import typing as tp
+from anti_entropy import Record
+from persistence import sync_directory
+from wire_protocol import FramedConnection
+
+HINTS_FILE = 'hints.jsonl'
+
+
+def parse_records(body: bytes) -> tp.List[Record]:
+    """
+    Parse a body of one JSON record per line, failing on anything that is not a put or delete record
+    """
+    records = []
+    for line in body.splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if (
+            not isinstance(record, list)
+            or record[0] not in ('put', 'delete')
+            or len(record) != (4 if record[0] == 'put' else 3)
+        ):
+            raise ValueError(f'Invalid record {record!r}')
+        records.append(record)
+    return records
+
+
+def ping(target: str, timeout: float = 2.0) -> bool:
+    """
+    Return whether the server named "ip:port" answers a ping
+    """
+    host, port = target.rsplit(':', 1)
+    try:
+        connection = FramedConnection(socket.create_connection((host, int(port)), timeout=timeout))
+    except OSError:
+        return False
+    try:
+        connection.send('ping')
+        frame = connection.recv()
+        connection.send('exit')
+        connection.recv()
+        return frame is not None and frame[0].lower() == 'pong'
+    except OSError:
+        return False
+    finally:
+        connection.close()
+
+
+def deliver(target: str, records: tp.List[Record], timeout: float = 5.0) -> None:
+    """
+    Send records to the server named "ip:port" with the commands any server understands,
+    puts of one version as an MPUT and every delete as its own DELETE
+    """
+    host, port = target.rsplit(':', 1)
+    connection = FramedConnection(socket.create_connection((host, int(port)), timeout=timeout))
+    try:
+        for kind, group in itertools.groupby(records, key=lambda record: (record[0], record[-1])):
+            operation, version = kind
+            if operation == 'put':
+                body = b'\n'.join(json.dumps({key: value}).encode('utf-8') for _, key, value, _ in group)
+                requests = [(f'MPUT {version}', body)]
+            else:
+                requests = [(f'DELETE {key} {version}', b'') for _, key, _ in group]
+            for text, body in requests:
+                connection.send(text, body)
+                frame = connection.recv()
+                if frame is None:
+                    raise OSError(f'{target} closed the connection')
+                if not frame[0].startswith('OK'):
+                    raise OSError(f'{target} answered {frame[0]}')
+        connection.send('exit')
+        connection.recv()
+    finally:
+        connection.close()
+
+
+class HintStore:
+    """
+    Writes kept for servers that were down when they were sent, handed off once they are back.
+    With a directory the hints are appended to a file and fsynced before they are acknowledged,
+    so they survive a restart of the server that holds them
+    """
+
+    def __init__(self, directory: tp.Optional[str] = None) -> None:
+        self.path = os.path.join(directory, HINTS_FILE) if directory is not None else None
+        self.lock = threading.Lock()
+        self.hints: tp.Dict[str, tp.List[Record]] = {} # target "ip:port" -> records oldest first
+        if self.path is not None and os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    target, record = json.loads(line)
+                    self.hints.setdefault(target, []).append(record)
+
+    def add(self, target: str, records: tp.List[Record]) -> None:
+        with self.lock:
+            self.hints.setdefault(target, []).extend(records)
+            if self.path is not None:
+                with open(self.path, 'ab') as f:
+                    f.write(b''.join(json.dumps([target, record]).encode('utf-8') + b'\n' for record in records))
+                    f.flush()
+                    os.fsync(f.fileno())
+
+    def targets(self) -> tp.List[str]:
+        with self.lock:
+            return list(self.hints)
+
+    def pending(self, target: str) -> tp.List[Record]:
+        with self.lock:
+            return list(self.hints.get(target, ()))
+
+    def remove(self, target: str, count: int) -> None:
+        """
+        Forget the oldest count hints of target once they were handed off
+        """
+        with self.lock:
+            remaining = self.hints.get(target, [])[count:]
+            if remaining:
+                self.hints[target] = remaining
+            else:
+                self.hints.pop(target, None)
+            if self.path is not None:
+                self.rewrite()
+
+    def rewrite(self) -> None:
+        temporary = self.path + '.tmp'
+        with open(temporary, 'wb') as f:
+            for target, records in self.hints.items():
+                for record in records:
+                    f.write(json.dumps([target, record]).encode('utf-8') + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+        sync_directory(os.path.dirname(self.path))
+
+    def __len__(self) -> int:
+        with self.lock:
+            return sum(len(records) for records in self.hints.values())
@@ -0,0 +1,108 @@
+import sys
+import typing as tp
+
+Record = tp.List[tp.Any]
+
+
+class KeypathIndex:
+    """
+    Flattened view of the nested values of the keys under the indexed prefixes.
+    Every keypath of such a key, e.g. `key.sub.sub2`, maps straight to the value at that path,
+    so a QUERY is one dictionary lookup instead of a trie walk and a walk down the nested dicts.
+    The entries refer to the values stored in the trie, so only the keypaths themselves cost memory,
+    unless the trie decodes a new copy of a value on every read, as a mapped snapshot does:
+    with copies the index holds those copies and their memory is counted as well.
+    The index follows every record the store applies, a key is indexed again from the trie after each
+    """
+
+    def __init__(self, prefixes: tp.Iterable[str], copies: bool = False) -> None:
+        self.prefixes = tuple(prefixes) # '' indexes every key
+        self.copies = copies # whether the indexed values are copies the index alone holds
+        self.paths: tp.Dict[str, tp.Any] = {} # keypath -> value at that path
+        self.key_paths: tp.Dict[str, tp.List[str]] = {} # top-level key -> its indexed keypaths
+        self.path_bytes = 0 # memory of the keypath strings and of the per-key lists, and of the copied values
+
+    def covers(self, key: str) -> bool:
+        # a QUERY can not address a key with a dot, and its keypaths would collide with those of its prefix
+        return '.' not in key and key.startswith(self.prefixes)
+
+    def flatten(self, key: str, value: tp.Any) -> tp.Iterator[tp.Tuple[str, tp.Any]]:
+        """
+        Yield the (keypath, value) pair of every nested path of a value, the paths inside lists excluded.
+        A name with a dot can not be reached by a QUERY and is not indexed
+        """
+        stack = [(key, value)]
+        while stack:
+            path, value = stack.pop()
+            if not isinstance(value, dict):
+                continue
+            for name, child in value.items():
+                if not isinstance(name, str) or '.' in name:
+                    continue
+                child_path = f'{path}.{name}'
+                yield child_path, child
+                stack.append((child_path, child))
+
+    def discard(self, key: str) -> None:
+        paths = self.key_paths.pop(key, None)
+        if paths is None:
+            return
+        for path in paths:
+            if path in self.paths:
+                value = self.paths.pop(path)
+                if self.copies:
+                    self.path_bytes -= sys.getsizeof(value)
+            self.path_bytes -= sys.getsizeof(path)
+        self.path_bytes -= sys.getsizeof(paths)
+
+    def put(self, key: str, value: tp.Any) -> None:
+        self.discard(key)
+        paths = []
+        for path, child in self.flatten(key, value):
+            self.paths[path] = child
+            paths.append(path)
+            self.path_bytes += sys.getsizeof(path)
+            if self.copies:
+                # every nested dict is an entry of its own, so the shallow sizes add up to the whole value
+                self.path_bytes += sys.getsizeof(child)
+        if paths:
+            self.key_paths[key] = paths
+            self.path_bytes += sys.getsizeof(paths)
+
+    def apply(self, record: Record, trie: tp.Any) -> None:
+        """
+        Follow one record the trie has just been given. The key is indexed from the trie,
+        so a write the trie ignored for an older version changes nothing
+        """
+        key = record[1]
+        if not self.covers(key):
+            return
+        # a deleted key reads back as a message, not as a dict
+        self.put(key, trie.get(key))
+
+    def rebuild(self, items: tp.Iterable[tp.Sequence[tp.Any]]) -> None:
+        """
+        Index the (key, value) items of a whole store
+        """
+        self.paths = {}
+        self.key_paths = {}
+        self.path_bytes = 0
+        for key, value, *_ in items:
+            if self.covers(key):
+                self.put(key, value)
+
+    def lookup(self, keypath: str) -> tp.Tuple[bool, tp.Any]:
+        """
+        Return whether the index answers for the keypath and the value at it, None when the path is missing.
+        A top-level key alone is left to the trie
+        """
+        key, dot, _ = keypath.partition('.')
+        if not dot or not self.covers(key):
+            return False, None
+        return True, self.paths.get(keypath)
+
+    def stats(self) -> tp.Dict[str, int]:
+        return {
+            'keypath_index_paths': len(self.paths),
+            'keypath_index_bytes': sys.getsizeof(self.paths) + sys.getsizeof(self.key_paths) + self.path_bytes,
+        }
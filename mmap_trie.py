@@ -0,0 +1,388 @@
+import os
+import json
+import mmap
+import heapq
+import struct
+import typing as tp
+from trie_structure import Trie
+
+# File layout, all integers little-endian:
+#   header: magic, format version, WAL sequence number covered, root node offset, number of keys
+#   nodes, children always before their parent:
+#     label length (u32), label bytes, has value (u8), [version (u64), value length (u32), JSON value bytes],
+#     child count (u16), child count x (first label byte (u8), child node offset (u64)) sorted by byte
+# Keys are stored as utf-8 bytes, whose byte order is the code point order of the keys.
+# Format version 1 files have no key versions, their keys read as version 0
+MAGIC = b'KVTRIE01'
+FORMAT_VERSION = 2
+HEADER = struct.Struct('<8sIQQQ')
+LENGTH = struct.Struct('<I')
+VERSION = struct.Struct('<Q')
+FLAG = struct.Struct('<B')
+CHILD_COUNT = struct.Struct('<H')
+CHILD = struct.Struct('<BQ')
+
+# value an overlay stores for a key deleted from the mapped base.
+# Unlike a tombstone it is never compacted away, so the base value cannot reappear
+REMOVED = object()
+
+# (label, (version, JSON value) or None, child table entries)
+PendingNode = tp.Tuple[bytes, tp.Optional[tp.Tuple[int, bytes]], tp.List[tp.Tuple[int, int]]]
+
+
+class MappedTrieWriter:
+    """
+    Build a mapped trie file in one pass over keys in ascending order.
+    Nodes are written bottom-up: a node is written once the next key leaves its subtree,
+    and a node without a value and with a single child is folded into that child's edge
+    """
+
+    def __init__(self, path: str, sequence: int = 0) -> None:
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, FORMAT_VERSION, sequence, 0, 0))
+        self.sequence = sequence
+        self.key_count = 0
+        # one frame per byte of the current key: [edge byte, (version, JSON value) or None, finished children]
+        self.stack: tp.List[tp.List[tp.Any]] = [[b'', None, []]]
+        self.previous_key: tp.Optional[bytes] = None
+
+    def write_node(
+        self,
+        label: bytes,
+        value: tp.Optional[tp.Tuple[int, bytes]],
+        children: tp.List[tp.Tuple[int, int]]
+    ) -> int:
+        offset = self.file.tell()
+        parts = [LENGTH.pack(len(label)), label]
+        if value is None:
+            parts.append(FLAG.pack(0))
+        else:
+            version, encoded_value = value
+            parts.extend((FLAG.pack(1), VERSION.pack(version), LENGTH.pack(len(encoded_value)), encoded_value))
+        parts.append(CHILD_COUNT.pack(len(children)))
+        parts.extend(CHILD.pack(first_byte, child_offset) for first_byte, child_offset in children)
+        self.file.write(b''.join(parts))
+        return offset
+
+    def finish_frame(self, frame: tp.List[tp.Any]) -> PendingNode:
+        """
+        Turn a frame whose subtree is complete into a node its parent can write or fold
+        """
+        label, value, pending_children = frame
+        if value is None and len(pending_children) == 1:
+            child_label, child_value, child_entries = pending_children[0]
+            return label + child_label, child_value, child_entries
+
+        entries = [
+            (child_label[0], self.write_node(child_label, child_value, child_entries))
+            for child_label, child_value, child_entries in pending_children
+        ]
+        return label, value, entries
+
+    def add(self, key: str, value: tp.Any, version: int = 0) -> None:
+        encoded_key = key.encode('utf-8')
+        previous_key = self.previous_key
+        if previous_key is not None and encoded_key <= previous_key:
+            if encoded_key == previous_key:
+                self.stack[-1][1] = (version, json.dumps(value).encode('utf-8')) # the last value of a key wins
+                return
+            raise ValueError(f'Keys must be added in ascending order, {key!r} came after a larger key')
+
+        common = 0
+        if previous_key is not None:
+            limit = min(len(previous_key), len(encoded_key))
+            while common < limit and previous_key[common] == encoded_key[common]:
+                common += 1
+
+        # close the frames of the previous key below the shared prefix
+        stack = self.stack
+        while len(stack) - 1 > common:
+            frame = stack.pop()
+            stack[-1][2].append(self.finish_frame(frame))
+
+        for position in range(common, len(encoded_key)):
+            stack.append([encoded_key[position:position + 1], None, []])
+        stack[-1][1] = (version, json.dumps(value).encode('utf-8'))
+        self.previous_key = encoded_key
+        self.key_count += 1
+
+    def close(self) -> str:
+        stack = self.stack
+        while len(stack) > 1:
+            frame = stack.pop()
+            stack[-1][2].append(self.finish_frame(frame))
+
+        # the root is never folded into a child
+        _, value, pending_children = stack[0]
+        entries = [
+            (child_label[0], self.write_node(child_label, child_value, child_entries))
+            for child_label, child_value, child_entries in pending_children
+        ]
+        root_offset = self.write_node(b'', value, entries)
+
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, FORMAT_VERSION, self.sequence, root_offset, self.key_count))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        return self.path
+
+
+def write_mapped_trie(path: str, items: tp.Iterable[tp.Sequence[tp.Any]], sequence: int = 0) -> str:
+    """
+    Write the (key, value) or (key, value, version) items, in ascending key order, as a mapped trie file
+    """
+    writer = MappedTrieWriter(path, sequence)
+    try:
+        for item in items:
+            writer.add(*item)
+    except BaseException:
+        writer.file.close()
+        os.remove(path)
+        raise
+    return writer.close()
+
+
+class MappedTrie:
+    """
+    Read-only trie served straight from a memory mapped file.
+    Nothing is deserialized up front: a lookup reads the few nodes on the key's path
+    and decodes only the value it returns, so opening a file of any size is instant
+    and only the pages that are touched become resident
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.format_version, self.sequence, self.root_offset, self.key_count = HEADER.unpack_from(self.map)
+        if magic != MAGIC or not 1 <= self.format_version <= FORMAT_VERSION:
+            raise ValueError(f'{path} is not a mapped trie file')
+
+    def read_node(self, offset: int) -> tp.Tuple[bytes, tp.Optional[tp.Tuple[int, int, int]], int, int]:
+        """
+        Decode a node header
+        :return: its label, the (start, end, version) of its value or None,
+            its child count and the offset of its child table
+        """
+        data = self.map
+        (label_length,) = LENGTH.unpack_from(data, offset)
+        offset += LENGTH.size
+        label = data[offset:offset + label_length]
+        offset += label_length
+        (has_value,) = FLAG.unpack_from(data, offset)
+        offset += FLAG.size
+        value = None
+        if has_value:
+            version = 0
+            if self.format_version >= 2:
+                (version,) = VERSION.unpack_from(data, offset)
+                offset += VERSION.size
+            (value_length,) = LENGTH.unpack_from(data, offset)
+            offset += LENGTH.size
+            value = (offset, offset + value_length, version)
+            offset += value_length
+        (child_count,) = CHILD_COUNT.unpack_from(data, offset)
+        return label, value, child_count, offset + CHILD_COUNT.size
+
+    def find_child(self, table: int, child_count: int, first_byte: int) -> tp.Optional[int]:
+        """
+        Binary search a child table for the child whose label starts with first_byte
+        """
+        low, high = 0, child_count
+        while low < high:
+            middle = (low + high) // 2
+            byte, child_offset = CHILD.unpack_from(self.map, table + middle * CHILD.size)
+            if byte == first_byte:
+                return child_offset
+            if byte < first_byte:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def locate(self, encoded_prefix: bytes, whole_key: bool) -> tp.Optional[tp.Tuple[bytes, int]]:
+        """
+        Follow the encoded key from the root.
+        With whole_key the key must end exactly at a node, otherwise it may end inside an edge
+        :return: the full path of the node reached and its offset
+        """
+        offset = self.root_offset
+        position = 0
+        while position < len(encoded_prefix):
+            _, _, child_count, table = self.read_node(offset)
+            child_offset = self.find_child(table, child_count, encoded_prefix[position])
+            if child_offset is None:
+                return None
+            label = self.read_node(child_offset)[0]
+            if encoded_prefix.startswith(label, position):
+                position += len(label)
+            elif not whole_key and label.startswith(encoded_prefix[position:]):
+                return encoded_prefix[:position] + label, child_offset
+            else:
+                return None
+            offset = child_offset
+        return encoded_prefix, offset
+
+    def contains(self, key: str) -> bool:
+        found = self.locate(key.encode('utf-8'), whole_key=True)
+        return found is not None and self.read_node(found[1])[1] is not None
+
+    def get(self, key: str) -> tp.Any:
+        found = self.locate(key.encode('utf-8'), whole_key=True)
+        if found is None:
+            return None
+        value = self.read_node(found[1])[1]
+        if value is None:
+            return None
+        return json.loads(self.map[value[0]:value[1]])
+
+    def version(self, key: str) -> int:
+        found = self.locate(key.encode('utf-8'), whole_key=True)
+        if found is None:
+            return 0
+        value = self.read_node(found[1])[1]
+        return value[2] if value is not None else 0
+
+    def scan(
+        self,
+        prefix: str = '',
+        limit: tp.Optional[int] = None,
+        start_after: tp.Optional[str] = None,
+        versions: bool = False
+    ) -> tp.Iterator[tp.Tuple[tp.Any, ...]]:
+        """
+        Lazily yield the (key, value) pairs, or (key, value, version) triples with versions,
+        whose key starts with prefix, in key order
+        """
+        found = self.locate(prefix.encode('utf-8'), whole_key=False)
+        if found is None or limit == 0:
+            return
+        cursor = start_after.encode('utf-8') if start_after is not None else None
+
+        count = 0
+        stack = [found]
+        while stack:
+            path, offset = stack.pop()
+            _, value, child_count, table = self.read_node(offset)
+            if value is not None and (cursor is None or path > cursor):
+                key = path.decode('utf-8')
+                decoded_value = json.loads(self.map[value[0]:value[1]])
+                yield (key, decoded_value, value[2]) if versions else (key, decoded_value)
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+
+            # push the children in reverse order so the smallest label is visited first
+            for index in range(child_count - 1, -1, -1):
+                _, child_offset = CHILD.unpack_from(self.map, table + index * CHILD.size)
+                child_path = path + self.read_node(child_offset)[0]
+                # every key below this child sorts before the cursor
+                if cursor is not None and child_path < cursor[:len(child_path)]:
+                    continue
+                stack.append((child_path, child_offset))
+
+    def close(self) -> None:
+        self.map.close()
+
+
+class OverlayTrie(Trie):
+    """
+    A small mutable trie layered over a read-only MappedTrie.
+    Writes go to the overlay, reads check the overlay first and fall back to the base.
+    A key deleted from the base is masked with REMOVED in the overlay
+    """
+
+    def __init__(self, overlay: Trie, base: tp.Optional[MappedTrie] = None) -> None:
+        super().__init__(overlay.tombstone_retention)
+        self.overlay = overlay
+        self.base = base
+        self.shadowed = 0 # base keys with a value or a REMOVED mask in the overlay
+        self.masked = 0 # REMOVED masks in the overlay
+
+    def put(self, key: str, value: tp.Any, version: int = 0) -> None:
+        if version < self.version(key):
+            return # an older version never overwrites a newer one
+        if self.base is not None and self.base.contains(key):
+            node = self.overlay.find_node(key)
+            if node is None or not node.is_leaf or node.is_deleted:
+                self.shadowed += 1
+            elif node.value is REMOVED:
+                self.masked -= 1
+            if value is REMOVED:
+                self.masked += 1
+        self.overlay.put(key, value, version)
+
+    def load_sorted(self, items: tp.Iterable[tp.Tuple[str, tp.Any]]) -> int:
+        return self.overlay.load_sorted(items)
+
+    def get(self, key: str) -> tp.Any:
+        node = self.overlay.find_node(key)
+        if node is not None and node.is_leaf:
+            if node.is_deleted or node.value is REMOVED:
+                return f'Key: {key} has been deleted!'
+            return node.value
+        if self.base is not None:
+            return self.base.get(key)
+        return None
+
+    def delete(self, key: str, version: int = 0) -> None:
+        if self.base is not None and self.base.contains(key):
+            node = self.overlay.find_node(key)
+            if node is None or not node.is_leaf or node.value is not REMOVED:
+                self.put(key, REMOVED, version)
+            return
+        self.overlay.delete(key, version)
+
+    def version(self, key: str) -> int:
+        node = self.overlay.find_node(key)
+        if node is not None and node.is_leaf:
+            return node.version
+        if self.base is not None:
+            return self.base.version(key)
+        return 0
+
+    def scan(
+        self,
+        prefix: str = '',
+        limit: tp.Optional[int] = None,
+        start_after: tp.Optional[str] = None,
+        versions: bool = False
+    ) -> tp.Iterator[tp.Tuple[tp.Any, ...]]:
+        """
+        Merge the key ordered scans of the overlay and the base, the overlay wins on equal keys
+        """
+        if limit == 0:
+            return
+        streams = [
+            ((key, 0, value, version) for key, value, version in self.overlay.scan(prefix, None, start_after, True))
+        ]
+        if self.base is not None:
+            streams.append(
+                (key, 1, value, version) for key, value, version in self.base.scan(prefix, None, start_after, True)
+            )
+
+        count = 0
+        last_key = None
+        for key, _, value, version in heapq.merge(*streams, key=lambda entry: (entry[0], entry[1])):
+            if key == last_key:
+                continue
+            last_key = key
+            if value is REMOVED:
+                continue
+            yield (key, value, version) if versions else (key, value)
+            count += 1
+            if limit is not None and count >= limit:
+                return
+
+    def compact(self, limit: int = 1000, unlinked: tp.Optional[tp.Callable[[str], None]] = None) -> int:
+        return self.overlay.compact(limit, unlinked)
+
+    def stats(self) -> tp.Dict[str, int]:
+        stats = self.overlay.stats()
+        stats['overlay_keys'] = stats['keys']
+        stats['base_keys'] = self.base.key_count if self.base is not None else 0
+        # a key in both layers is counted once, a masked base key not at all
+        stats['keys'] = stats['overlay_keys'] - self.masked + stats['base_keys'] - self.shadowed
+        return stats
@@ -0,0 +1,273 @@
+import os
+import json
+import time
+import threading
+import typing as tp
+from mmap_trie import write_mapped_trie
+
+# A WAL record is [sequence number, 'put', key, value, version] or [sequence number, 'delete', key, version],
+# records written before keys had versions lack the version
+Record = tp.List[tp.Any]
+
+WAL_PREFIX = 'wal-'
+WAL_SUFFIX = '.log'
+SNAPSHOT_PREFIX = 'snapshot-'
+# file suffix of each snapshot format
+SNAPSHOT_SUFFIXES = {
+    'jsonl': '.jsonl', # one JSON [key, value] line per key, loaded into the trie on startup
+    'mmap': '.trie', # mapped trie file served in place, see mmap_trie
+}
+
+
+def sync_directory(path: str) -> None:
+    """
+    fsync a directory so that files created or renamed in it survive a crash
+    """
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def numbered_files(directory: str, prefix: str, *suffixes: str) -> tp.List[tp.Tuple[int, str]]:
+    """
+    Return the (number, path) of the files named <prefix><number><suffix>, lowest number first
+    """
+    files = []
+    for name in os.listdir(directory):
+        for suffix in suffixes:
+            if name.startswith(prefix) and name.endswith(suffix):
+                number = name[len(prefix):-len(suffix)]
+                if number.isdigit():
+                    files.append((int(number), os.path.join(directory, name)))
+    return sorted(files)
+
+
+class WriteAheadLog:
+    """
+    Append-only log of PUT and DELETE records, split into segment files.
+    Records are written as one JSON line each. A background thread fsyncs whatever
+    was appended since its last fsync in one go (group commit), so concurrent writers
+    share a single fsync instead of paying for one each
+    """
+
+    def __init__(self, directory: str, last_sequence: int = 0, commit_delay: float = 0.0) -> None:
+        self.directory = directory
+        self.commit_delay = commit_delay # seconds the flusher waits to let more writers join one fsync
+        self.condition = threading.Condition()
+        self.sync_lock = threading.Lock() # held while an fsync runs, so rotate never closes that file under it
+        self.sequence = last_sequence # sequence number of the last appended record
+        self.durable_sequence = last_sequence # sequence number of the last fsynced record
+        self.closed = False
+        # recovery stops at a torn record, later records must not be appended behind it
+        self.truncate_torn_tail(os.path.join(directory, f'{WAL_PREFIX}{last_sequence + 1:020d}{WAL_SUFFIX}'))
+        self.file = self.open_segment(last_sequence + 1)
+        self.flusher = threading.Thread(target=self.flush_forever, daemon=True)
+        self.flusher.start()
+
+    def open_segment(self, first_sequence: int) -> tp.BinaryIO:
+        path = os.path.join(self.directory, f'{WAL_PREFIX}{first_sequence:020d}{WAL_SUFFIX}')
+        segment = open(path, 'ab')
+        sync_directory(self.directory)
+        return segment
+
+    @staticmethod
+    def truncate_torn_tail(path: str) -> None:
+        """
+        Cut a segment after its last complete record, so the records appended next start on a line of their own
+        """
+        if not os.path.exists(path):
+            return
+        end = 0
+        last_line_ended = True
+        with open(path, 'rb') as segment:
+            for line in segment:
+                try:
+                    json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                end += len(line)
+                last_line_ended = line.endswith(b'\n')
+            size = segment.seek(0, os.SEEK_END)
+
+        if end == size and last_line_ended:
+            return
+        print(f'[Server]: Truncating torn WAL record in {path}')
+        with open(path, 'r+b') as segment:
+            segment.truncate(end)
+            if not last_line_ended:
+                segment.seek(end)
+                segment.write(b'\n') # the record was complete, only its newline was lost
+            segment.flush()
+            os.fsync(segment.fileno())
+
+    def append(self, records: tp.Iterable[tp.List[tp.Any]]) -> int:
+        """
+        Append records (without their sequence number) to the log.
+        :return: the sequence number of the last record, to pass to wait_durable
+        """
+        with self.condition:
+            lines = []
+            for record in records:
+                self.sequence += 1
+                lines.append(json.dumps([self.sequence, *record]).encode('utf-8'))
+            if lines:
+                self.file.write(b'\n'.join(lines) + b'\n')
+                self.condition.notify_all()
+            return self.sequence
+
+    def wait_durable(self, sequence: int) -> None:
+        """
+        Block until every record up to sequence has been fsynced
+        """
+        with self.condition:
+            while self.durable_sequence < sequence and not self.closed:
+                self.condition.wait()
+
+    def flush_forever(self) -> None:
+        while True:
+            with self.condition:
+                while self.durable_sequence == self.sequence and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+
+            if self.commit_delay:
+                time.sleep(self.commit_delay)
+
+            with self.sync_lock:
+                with self.condition:
+                    target = self.sequence
+                    self.file.flush()
+                    descriptor = self.file.fileno()
+                os.fsync(descriptor)
+
+            with self.condition:
+                self.durable_sequence = max(self.durable_sequence, target)
+                self.condition.notify_all()
+
+    def rotate(self) -> int:
+        """
+        Close the current segment and continue in a new one.
+        :return: the sequence number of the last record in the closed segments
+        """
+        with self.sync_lock, self.condition:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            boundary = self.sequence
+            self.durable_sequence = boundary
+            self.file = self.open_segment(boundary + 1)
+            self.condition.notify_all()
+            return boundary
+
+    def remove_segments(self, boundary: int) -> int:
+        """
+        Delete the segments that only hold records up to boundary
+        :return: the number of deleted segments
+        """
+        segments = numbered_files(self.directory, WAL_PREFIX, WAL_SUFFIX)
+        removed = 0
+        # a segment ends right before the next one starts
+        for (first_sequence, path), (next_first_sequence, _) in zip(segments, segments[1:]):
+            if next_first_sequence - 1 <= boundary:
+                os.remove(path)
+                removed += 1
+        return removed
+
+    @staticmethod
+    def replay(directory: str, after_sequence: int) -> tp.Iterator[Record]:
+        """
+        Yield the records with a sequence number above after_sequence, oldest first.
+        A torn line at the end of a segment, left by a crash in the middle of a write, is skipped
+        """
+        for _, path in numbered_files(directory, WAL_PREFIX, WAL_SUFFIX):
+            with open(path, 'rb') as segment:
+                for line in segment:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        print(f'[Server]: Ignoring torn WAL record in {path}')
+                        break
+                    if record[0] > after_sequence:
+                        yield record
+
+    def flush(self) -> None:
+        """
+        Hand buffered records to the operating system so the segment files can be read back
+        """
+        with self.condition:
+            self.file.flush()
+
+    def close(self) -> None:
+        with self.sync_lock, self.condition:
+            if self.closed:
+                return
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.durable_sequence = self.sequence
+            self.file.close()
+            self.closed = True
+            self.condition.notify_all()
+
+
+class SnapshotStore:
+    """
+    Compacted copies of the trie, written either as JSON lines, whose first line records
+    the WAL sequence number the snapshot covers, or as a mapped trie file.
+    A snapshot is written to a temporary file and renamed, so a crash never leaves a partial one
+    """
+
+    def __init__(self, directory: str, snapshot_format: str = 'jsonl') -> None:
+        self.directory = directory
+        self.snapshot_format = snapshot_format
+
+    def latest(self) -> tp.Optional[tp.Tuple[int, str]]:
+        """
+        Return the (sequence number, path) of the newest snapshot of any format
+        """
+        snapshots = numbered_files(self.directory, SNAPSHOT_PREFIX, *SNAPSHOT_SUFFIXES.values())
+        return snapshots[-1] if snapshots else None
+
+    def write(self, sequence: int, items: tp.Iterable[tp.Sequence[tp.Any]]) -> str:
+        """
+        Write the (key, value) or (key, value, version) items, in ascending key order, as a snapshot covering sequence
+        """
+        suffix = SNAPSHOT_SUFFIXES[self.snapshot_format]
+        path = os.path.join(self.directory, f'{SNAPSHOT_PREFIX}{sequence:020d}{suffix}')
+        temporary_path = path + '.tmp'
+        if self.snapshot_format == 'mmap':
+            write_mapped_trie(temporary_path, items, sequence)
+        else:
+            try:
+                with open(temporary_path, 'wb') as snapshot:
+                    snapshot.write(json.dumps({'sequence': sequence}).encode('utf-8') + b'\n')
+                    for item in items:
+                        snapshot.write(json.dumps(item).encode('utf-8') + b'\n')
+                    snapshot.flush()
+                    os.fsync(snapshot.fileno())
+            except BaseException:
+                os.remove(temporary_path)
+                raise
+        os.replace(temporary_path, path)
+        sync_directory(self.directory)
+        return path
+
+    @staticmethod
+    def load(path: str) -> tp.Iterator[tp.Tuple[tp.Any, ...]]:
+        """
+        Yield the (key, value, version) items of a jsonl snapshot, (key, value) for snapshots without versions
+        """
+        with open(path, 'rb') as snapshot:
+            snapshot.readline() # the header
+            for line in snapshot:
+                yield tuple(json.loads(line))
+
+    def remove_older(self, sequence: int) -> None:
+        """
+        Delete every snapshot older than the one covering sequence
+        """
+        for snapshot_sequence, path in numbered_files(self.directory, SNAPSHOT_PREFIX, *SNAPSHOT_SUFFIXES.values()):
+            if snapshot_sequence < sequence:
+                os.remove(path)
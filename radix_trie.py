@@ -0,0 +1,251 @@
+import sys
+import typing as tp
+from trie_structure import Trie, common_prefix_length, gc_paused
+
+
+class RadixNode:
+    # __slots__ keeps every node a fixed size object without a per-instance __dict__
+    __slots__ = ('label', 'children', 'value', 'is_leaf', 'is_deleted', 'version')
+
+    def __init__(self, label: str) -> None:
+        self.label = label # the substring of the key on the edge that leads to this node
+        self.children: tp.Optional[tp.Dict[str, 'RadixNode']] = None # first character of a child label -> child, None while the node has no children
+        self.value = None # the value stored at this node (if any)
+        self.is_leaf = False # whether a key ends at this node
+        self.is_deleted = False # a flag indicating whether the key has been deleted
+        self.version = 0 # version of the last put or delete of the key
+
+
+class RadixTrie(Trie):
+    """
+    Path compressed (radix / PATRICIA) trie with the same API as Trie.
+    Chains of single child nodes collapse into one edge labelled with a substring,
+    so a key costs one node per branching point instead of one node per character
+    """
+
+    def __init__(self, tombstone_retention: float = 60.0) -> None:
+        super().__init__(tombstone_retention)
+        self.root = RadixNode('')
+
+    def put(self, key: str, value: tp.Any, version: int = 0) -> None:
+        current_root = self.root
+        position = 0
+        while position < len(key):
+            if current_root.children is None:
+                current_root.children = {}
+            child = current_root.children.get(key[position])
+
+            # no edge starts with this character, the rest of the key becomes one new edge
+            if child is None:
+                child = RadixNode(key[position:])
+                current_root.children[key[position]] = child
+                current_root = child
+                self.node_count += 1
+                break
+
+            label = child.label
+            if key.startswith(label, position):
+                position += len(label)
+                current_root = child
+                continue
+
+            # the key leaves the edge half way, split the edge at the first differing character
+            common = 1
+            while (
+                common < len(label) and
+                position + common < len(key) and
+                label[common] == key[position + common]
+            ):
+                common += 1
+
+            middle = RadixNode(label[:common])
+            child.label = label[common:]
+            middle.children = {child.label[0]: child}
+            current_root.children[key[position]] = middle
+            current_root = middle
+            position += common
+            self.node_count += 1
+
+        if current_root.is_leaf and version < current_root.version:
+            return # an older version never overwrites a newer one
+        if not current_root.is_leaf or current_root.is_deleted:
+            self.key_count += 1
+        current_root.is_leaf = True
+        current_root.is_deleted = False
+        current_root.value = value
+        current_root.version = version
+
+    def load_sorted(self, items: tp.Iterable[tp.Sequence[tp.Any]]) -> int:
+        """
+        Build an empty radix trie bottom-up from (key, value) or (key, value, version) items in ascending key order.
+        Only the edges of the previous key can be split by the next key, so they stay on a stack
+        with the depth at which each of them ends. When a key repeats the last value wins
+        :return: the number of pairs loaded
+        """
+        if self.node_count != 1:
+            raise ValueError('Only an empty trie can be bulk loaded')
+
+        path: tp.List[tp.Tuple[RadixNode, int]] = [(self.root, 0)] # (node, key length at the end of its label)
+        previous_key = ''
+        loaded = 0
+        with gc_paused():
+            for item in items:
+                key, value = item[0], item[1]
+                if key < previous_key:
+                    raise ValueError(f'Keys must be in ascending order, {key!r} came after {previous_key!r}')
+                common = common_prefix_length(previous_key, key)
+                while path[-1][1] > common:
+                    path.pop()
+                current_root, depth = path[-1]
+
+                # the edge of the previous key below current_root runs past the common prefix, split it
+                if depth < common:
+                    child = current_root.children[key[depth]]
+                    middle = RadixNode(child.label[:common - depth])
+                    child.label = child.label[common - depth:]
+                    middle.children = {child.label[0]: child}
+                    current_root.children[key[depth]] = middle
+                    self.node_count += 1
+                    current_root, depth = middle, common
+                    path.append((middle, common))
+
+                if depth < len(key):
+                    child = RadixNode(key[depth:])
+                    if current_root.children is None:
+                        current_root.children = {}
+                    current_root.children[key[depth]] = child
+                    self.node_count += 1
+                    current_root = child
+                    path.append((child, len(key)))
+
+                if not current_root.is_leaf:
+                    self.key_count += 1
+                current_root.is_leaf = True
+                current_root.value = value
+                current_root.version = item[2] if len(item) > 2 else 0
+                previous_key = key
+                loaded += 1
+        return loaded
+
+    def find_node(self, key: str) -> tp.Optional[RadixNode]:
+        """
+        Return the node at which the key ends, or None if no node ends exactly there
+        """
+        current_root = self.root
+        position = 0
+        length = len(key)
+        while position < length:
+            children = current_root.children
+            if not children:
+                return None
+            current_root = children.get(key[position])
+            if current_root is None:
+                return None
+            label = current_root.label
+            if not key.startswith(label, position):
+                return None
+            position += len(label)
+        return current_root
+
+    def prefix_node(self, prefix: str) -> tp.Optional[tp.Tuple[str, RadixNode]]:
+        """
+        Return the node under which every key starting with the prefix lives, together with its path.
+        The prefix may end in the middle of an edge label
+        """
+        current_root = self.root
+        position = 0
+        while position < len(prefix):
+            children = current_root.children
+            child = children.get(prefix[position]) if children else None
+            if child is None:
+                return None
+            label = child.label
+            if prefix.startswith(label, position):
+                position += len(label)
+                current_root = child
+            elif label.startswith(prefix[position:]):
+                return prefix[:position] + label, child
+            else:
+                return None
+        return prefix, current_root
+
+    def child_edges(self, node: RadixNode) -> tp.Iterable[tp.Tuple[str, RadixNode]]:
+        """
+        Return the (edge label, child) pairs of a node
+        """
+        if not node.children:
+            return ()
+        return [(child.label, child) for child in node.children.values()]
+
+    def get(self, key: str) -> tp.Any:
+        current_root = self.find_node(key)
+        if current_root is None or not current_root.is_leaf:
+            return None
+
+        if not current_root.is_deleted:
+            return current_root.value
+        return f'Key: {key} has been deleted!'
+
+    def node_size(self, node: RadixNode) -> int:
+        """
+        Estimate the memory held by a node, without its value
+        """
+        size = sys.getsizeof(node) + sys.getsizeof(node.label)
+        if node.children:
+            size += sys.getsizeof(node.children)
+        return size
+
+    def merge_with_child(self, node: RadixNode) -> None:
+        """
+        Fold the only child of a node that holds no key into the node itself,
+        so the edge above and the edge below become one edge
+        """
+        (child,) = node.children.values()
+        node.label += child.label
+        node.children = child.children
+        node.value = child.value
+        node.is_leaf = child.is_leaf
+        node.is_deleted = child.is_deleted
+        node.version = child.version
+        self.node_count -= 1
+        self.bytes_reclaimed += sys.getsizeof(child)
+
+    def unlink(self, key: str) -> None:
+        """
+        Remove the key, drop its node if it has no children
+        and merge whatever single child chain the removal leaves behind
+        """
+        current_root = self.root
+        parents: tp.List[RadixNode] = []
+        position = 0
+        while position < len(key):
+            children = current_root.children
+            child = children.get(key[position]) if children else None
+            if child is None or not key.startswith(child.label, position):
+                return # the key is not in the trie
+            parents.append(current_root)
+            position += len(child.label)
+            current_root = child
+
+        self.bytes_reclaimed += sys.getsizeof(current_root.value)
+        current_root.value = None
+        current_root.is_leaf = False
+        current_root.is_deleted = False
+        if not parents:
+            return # the root stays even when it holds no key
+
+        node = current_root
+        if not node.children:
+            parent = parents.pop()
+            del parent.children[node.label[0]]
+            self.node_count -= 1
+            self.bytes_reclaimed += self.node_size(node)
+            if not parent.children:
+                parent.children = None
+            if not parents:
+                return # the parent is the root, which is never merged
+            node = parent
+
+        # a node without a key is only worth keeping while it branches
+        if not node.is_leaf and node.children and len(node.children) == 1:
+            self.merge_with_child(node)
@@ -0,0 +1,66 @@
+import threading
+import typing as tp
+from contextlib import contextmanager
+
+
+class ReadWriteLock:
+    """
+    A lock that lets any number of readers hold it at the same time,
+    while writers get exclusive access.
+    Waiting writers block new readers so a steady stream of GETs cannot starve a PUT.
+    """
+
+    def __init__(self) -> None:
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0 # number of threads currently holding the lock for reading
+        self._writer = False # whether a thread currently holds the lock for writing
+        self._waiting_writers = 0 # number of writers blocked in acquire_write
+
+    def acquire_read(self) -> None:
+        with self._condition:
+            while self._writer or self._waiting_writers:
+                self._condition.wait()
+            self._readers += 1
+
+    def release_read(self) -> None:
+        with self._condition:
+            self._readers -= 1
+            if not self._readers:
+                self._condition.notify_all()
+
+    def acquire_write(self) -> None:
+        with self._condition:
+            self._waiting_writers += 1
+            try:
+                while self._writer or self._readers:
+                    self._condition.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = True
+
+    def release_write(self) -> None:
+        with self._condition:
+            self._writer = False
+            self._condition.notify_all()
+
+    @contextmanager
+    def read_locked(self) -> tp.Iterator[None]:
+        """
+        Hold the lock for reading for the duration of a with block
+        """
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write_locked(self) -> tp.Iterator[None]:
+        """
+        Hold the lock for writing for the duration of a with block
+        """
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
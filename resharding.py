@@ -0,0 +1,200 @@
+import json
+import time
+import socket
+import threading
+import typing as tp
+from hash_ring import HashRing
+from wire_protocol import FramedConnection
+
+
+class RateLimiter:
+    """
+    Token bucket that lets at most rate bytes through per second, with bursts of up to one second
+    """
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def wait(self, amount: int) -> None:
+        """
+        Take amount bytes from the bucket, blocking while it is in debt
+        """
+        if not self.rate:
+            return
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        if self.tokens < 0:
+            time.sleep(-self.tokens / self.rate)
+
+
+def changed_ring(ring: HashRing, operation: str, node: str) -> HashRing:
+    """
+    Return a copy of the ring with node added or removed
+    """
+    changed = HashRing(ring.nodes, ring.virtual_nodes)
+    if operation == 'add':
+        changed.add(node)
+    elif operation == 'remove':
+        changed.remove(node)
+    else:
+        raise ValueError(f'Unknown membership change {operation}')
+    return changed
+
+
+class Migration:
+    """
+    Moves the keys of one server to the owners a membership change gives them, while the
+    server keeps serving. The store is scanned one page at a time under short read locks and
+    every key that gains an owner is sent to it with SYNC, at most rate bytes per second.
+    Each key is sent by one server only: the first of its old owners that stays on the ring.
+    Once every server is done the client finishes the change, the server switches its
+    ring and drops the keys it no longer owns
+    """
+
+    def __init__(
+        self,
+        store: tp.Any,
+        operation: str,
+        node: str,
+        rate: float,
+        page_size: int = 1000,
+        batch_size: int = 500
+    ) -> None:
+        index = store.merkle
+        self.store = store
+        self.operation = operation
+        self.node = node
+        self.name = index.name
+        self.k = index.k
+        self.old_ring = HashRing(index.ring.nodes, index.ring.virtual_nodes)
+        if operation == 'add':
+            self.old_ring.remove(node) # an added server is started with a peers file that lists it already
+        self.new_ring = changed_ring(self.old_ring, operation, node)
+        self.limiter = RateLimiter(rate)
+        self.page_size = page_size
+        self.batch_size = batch_size
+        self.state = 'moving' # moving, moved, cleaning, finished or failed
+        self.error = ''
+        self.scanned = 0 # keys of this server looked at
+        self.moved = 0 # records sent to new owners
+        self.dropped = 0 # keys deleted after the switch because this server no longer owns them
+        self.connections: tp.Dict[str, FramedConnection] = {}
+        self.thread = threading.Thread(target=self.move, daemon=True)
+
+    def targets(self, key: str) -> tp.List[str]:
+        """
+        Return the new owners this server has to send the key to
+        """
+        old_owners = self.old_ring.owners(key, self.k)
+        leaving = self.node if self.operation == 'remove' else None
+        senders = [owner for owner in old_owners if owner != leaving] or old_owners
+        if senders[0] != self.name:
+            return []
+        return [owner for owner in self.new_ring.owners(key, self.k) if owner not in old_owners]
+
+    def pages(self) -> tp.Iterator[tp.List[tp.Tuple[str, tp.Any, int]]]:
+        cursor = None
+        while True:
+            items = self.store.scan_request('', self.page_size, cursor, versions=True)
+            if items:
+                yield items
+            if len(items) < self.page_size:
+                return
+            cursor = items[-1][0]
+
+    def send(self, target: str, keys: tp.List[str]) -> None:
+        # the records are read again right before they are sent, a page may be seconds old by then
+        # and a delete that came in meanwhile has to reach the new owner as a delete
+        records = self.store.fetch_request(keys)
+        if not records:
+            return
+        body = json.dumps(records).encode('utf-8')
+        connection = self.connections.get(target)
+        if connection is None:
+            host, port = target.rsplit(':', 1)
+            connection = FramedConnection(socket.create_connection((host, int(port)), timeout=30))
+            self.connections[target] = connection
+        connection.send('SYNC', body)
+        frame = connection.recv()
+        if frame is None:
+            raise OSError(f'{target} closed the connection')
+        if frame[0] != 'OK':
+            raise OSError(f'{target} answered {frame[0]}')
+        self.moved += len(records)
+        self.limiter.wait(len(body)) # paid after the send, so no records go stale while waiting
+
+    def move(self) -> None:
+        try:
+            batches: tp.Dict[str, tp.List[str]] = {}
+            for items in self.pages():
+                for key, _, _ in items:
+                    self.scanned += 1
+                    for target in self.targets(key):
+                        batch = batches.setdefault(target, [])
+                        batch.append(key)
+                        if len(batch) == self.batch_size:
+                            self.send(target, batch)
+                            batches[target] = []
+            for target, batch in batches.items():
+                if batch:
+                    self.send(target, batch)
+            self.state = 'moved'
+            print(f'[Server]: Moved {self.moved} records for {self.operation.upper()} {self.node}')
+
+        except Exception as error:
+            self.state = 'failed'
+            self.error = str(error)
+            print(f'[Server]: Moving keys for {self.operation.upper()} {self.node} failed:', error)
+
+        finally:
+            self.close()
+
+    def finish(self) -> None:
+        """
+        Switch to the new ring and drop the keys this server no longer owns in the background
+        """
+        if self.state != 'moved':
+            raise ValueError(f'The migration is {self.state}, not moved')
+        self.store.reshard_request(self.new_ring)
+        self.state = 'cleaning'
+        self.thread = threading.Thread(target=self.clean, daemon=True)
+        self.thread.start()
+
+    def clean(self) -> None:
+        for items in self.pages():
+            # deleting at the key's own version removes it without outranking a newer write
+            records = [
+                ['delete', key, version]
+                for key, _, version in items
+                if self.name not in self.new_ring.owners(key, self.k)
+            ]
+            if records:
+                self.store.write(records)
+                self.dropped += len(records)
+        self.state = 'finished'
+        print(f'[Server]: {self.operation.upper()} {self.node} finished, dropped {self.dropped} keys')
+
+    def close(self) -> None:
+        for connection in self.connections.values():
+            try:
+                connection.send('exit')
+                connection.recv()
+            except OSError:
+                pass
+            connection.close()
+        self.connections.clear()
+
+    def status(self) -> tp.Dict[str, tp.Any]:
+        return {
+            'operation': self.operation,
+            'node': self.node,
+            'state': self.state,
+            'error': self.error,
+            'scanned': self.scanned,
+            'moved': self.moved,
+            'dropped': self.dropped,
+        }
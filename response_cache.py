@@ -0,0 +1,119 @@
+import sys
+import threading
+import typing as tp
+from collections import OrderedDict
+
+# bookkeeping of one entry besides its command and frame: the dict slots, the tuple and the key set slot
+ENTRY_OVERHEAD = 200
+
+
+class ResponseCache:
+    """
+    Bounded LRU cache of the encoded response frames of GET and QUERY, keyed by the command text.
+    Every entry belongs to the top-level key it reads, and the store invalidates the entries of a key
+    with every record it applies to it, so a cached answer is never older than the trie.
+
+    A miss hands out a lease for the command, the read fills the entry only while its lease is valid.
+    A write to the key cancels the leases of its commands, so a read that started before the write
+    can not put its answer back after the invalidation
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.entries: tp.OrderedDict[str, tp.Tuple[str, bytes, int]] = OrderedDict() # command -> (key, frame, size), oldest first
+        self.key_commands: tp.Dict[str, tp.Set[str]] = {} # top-level key -> its cached or leased commands
+        self.leases: tp.Dict[str, int] = {} # command -> lease of the read that may fill it
+        self.next_lease = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0 # entries dropped to stay within max_bytes
+        self.invalidations = 0 # entries dropped because their key was written
+
+    def lookup(self, command: str, key: str) -> tp.Tuple[tp.Optional[bytes], int]:
+        """
+        Return the cached frame of the command, or None and the lease to fill it with
+        """
+        with self.lock:
+            entry = self.entries.get(command)
+            if entry is not None:
+                self.entries.move_to_end(command)
+                self.hits += 1
+                return entry[1], 0
+            self.misses += 1
+            self.next_lease += 1
+            self.leases[command] = self.next_lease
+            self.key_commands.setdefault(key, set()).add(command)
+            return None, self.next_lease
+
+    def fill(self, command: str, key: str, lease: int, frame: tp.Optional[bytes]) -> None:
+        """
+        Cache the frame of a read that missed, unless its key was written meanwhile.
+        A None frame, e.g. for an error, only gives the lease back
+        """
+        with self.lock:
+            if self.leases.get(command) != lease:
+                return # the key was written or a newer read of the command holds the lease
+            del self.leases[command]
+            size = sys.getsizeof(command) + len(frame) + ENTRY_OVERHEAD if frame is not None else 0
+            if frame is None or size > self.max_bytes:
+                self.forget(command, key)
+                return
+
+            previous = self.entries.pop(command, None)
+            if previous is not None:
+                self.bytes -= previous[2]
+            self.entries[command] = (key, frame, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                oldest, (oldest_key, _, oldest_size) = self.entries.popitem(last=False)
+                self.bytes -= oldest_size
+                self.evictions += 1
+                self.forget(oldest, oldest_key)
+
+    def forget(self, command: str, key: str) -> None:
+        """
+        Drop a command that is neither cached nor leased any more from the commands of its key
+        """
+        if command in self.entries or command in self.leases:
+            return
+        commands = self.key_commands.get(key)
+        if commands is not None:
+            commands.discard(command)
+            if not commands:
+                del self.key_commands[key]
+
+    def invalidate(self, key: str) -> None:
+        with self.lock:
+            for command in self.key_commands.pop(key, ()):
+                self.leases.pop(command, None)
+                entry = self.entries.pop(command, None)
+                if entry is not None:
+                    self.bytes -= entry[2]
+                    self.invalidations += 1
+
+    def apply(self, record: tp.List[tp.Any], trie: tp.Any) -> None:
+        """
+        Follow one record the store has just applied
+        """
+        self.invalidate(record[1])
+
+    def clear(self) -> None:
+        with self.lock:
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+            self.key_commands.clear()
+            self.leases.clear()
+            self.bytes = 0
+
+    def stats(self) -> tp.Dict[str, int]:
+        with self.lock:
+            return {
+                'cache_entries': len(self.entries),
+                'cache_bytes': self.bytes,
+                'cache_hits': self.hits,
+                'cache_misses': self.misses,
+                'cache_evictions': self.evictions,
+                'cache_invalidations': self.invalidations,
+            }
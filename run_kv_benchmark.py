@@ -0,0 +1,899 @@
+import gc
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import string
+import tracemalloc
+import argparse
+import tempfile
+import threading
+import subprocess
+import typing as tp
+import multiprocessing
+import aggregates
+from KVServer import ENGINES, KVServer
+from keypath_index import KeypathIndex
+from secondary_index import FieldIndexes
+from hash_ring import HashRing
+from persistence import SnapshotStore
+from trie_structure import Trie, compile_formula
+from MathExpressionEvaluator import MathExpressionEvaluator
+from wire_protocol import FramedConnection
+
+
+def free_port() -> int:
+    """
+    Ask the operating system for a port nobody is listening on
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def start_server(port: int, *extra_args: str) -> subprocess.Popen:
+    """
+    Start run_kv_server.py in a child process and wait until it accepts connections
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run_kv_server.py')
+    process = subprocess.Popen(
+        [sys.executable, script, '-a', '127.0.0.1', '-p', str(port), *extra_args],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise OSError(f'Server on port {port} did not start')
+
+
+def connect(port: int) -> FramedConnection:
+    return FramedConnection(socket.create_connection(('127.0.0.1', port)))
+
+
+def request(connection: FramedConnection, command: str, body: bytes = b'') -> str:
+    connection.send(command, body)
+    response, _ = connection.recv()
+    return response
+
+
+def preload(port: int, keys: int) -> None:
+    """
+    PUT `keys` small records into the server
+    """
+    connection = connect(port)
+    for index in range(keys):
+        record = {f'key{index}': {'name': f'person{index}', 'age': index % 90}}
+        request(connection, 'PUT', json.dumps(record).encode('utf-8'))
+    request(connection, 'exit')
+    connection.close()
+
+
+def read_worker(port: int, keys: int, duration: float, write_ratio: float, results) -> None:
+    """
+    Issue GET (and optionally PUT) requests on one connection until the duration expires
+    """
+    connection = connect(port)
+    operations = 0
+    deadline = time.perf_counter() + duration
+    write_every = int(1 / write_ratio) if write_ratio else 0
+    while time.perf_counter() < deadline:
+        index = operations % keys
+        if write_every and operations % write_every == 0:
+            record = {f'key{index}': {'age': operations}}
+            request(connection, 'PUT', json.dumps(record).encode('utf-8'))
+        else:
+            request(connection, f'GET key{index}')
+        operations += 1
+    request(connection, 'exit')
+    connection.close()
+    results.put(operations)
+
+
+def run_clients(port: int, clients: int, keys: int, duration: float, write_ratio: float) -> int:
+    results = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(
+            target=read_worker,
+            args=(port, keys, duration, write_ratio, results)
+        )
+        for _ in range(clients)
+    ]
+    for worker in workers:
+        worker.start()
+    total = sum(results.get() for _ in workers)
+    for worker in workers:
+        worker.join()
+    return total
+
+
+def skewed_worker(port: int, keys: int, hot: int, duration: float, write_ratio: float, results) -> None:
+    """
+    Issue GET and QUERY requests, nine in ten of them for the hot keys, and optionally PUT,
+    on one connection until the duration expires
+    """
+    generator = random.Random(os.getpid())
+    connection = connect(port)
+    operations = 0
+    deadline = time.perf_counter() + duration
+    write_every = int(1 / write_ratio) if write_ratio else 0
+    while time.perf_counter() < deadline:
+        index = generator.randrange(hot) if generator.random() < 0.9 else generator.randrange(keys)
+        if write_every and operations % write_every == 0:
+            record = {f'key{index}': {'name': f'person{index}', 'age': operations % 90}}
+            request(connection, 'PUT', json.dumps(record).encode('utf-8'))
+        elif operations % 2:
+            request(connection, f'QUERY key{index}.age')
+        else:
+            request(connection, f'GET key{index}')
+        operations += 1
+    request(connection, 'exit')
+    connection.close()
+    results.put(operations)
+
+
+def cache_benchmark(args) -> None:
+    """
+    Throughput of skewed GET and QUERY traffic without and with the response cache
+    """
+    print(f'{"cache bytes":>12} {"ops/sec":>10} {"hit rate":>9}')
+    for cache_bytes in args.cache_bytes:
+        port = free_port()
+        server = start_server(port, '--cache-bytes', str(cache_bytes))
+        try:
+            preload(port, args.keys)
+            results = multiprocessing.Queue()
+            workers = [
+                multiprocessing.Process(
+                    target=skewed_worker,
+                    args=(port, args.keys, args.hot, args.duration, args.write_ratio, results)
+                )
+                for _ in range(args.clients)
+            ]
+            for worker in workers:
+                worker.start()
+            operations = sum(results.get() for _ in workers)
+            for worker in workers:
+                worker.join()
+            connection = connect(port)
+            stats = json.loads(request(connection, 'STATS'))
+            request(connection, 'exit')
+            connection.close()
+        finally:
+            server.terminate()
+            server.wait()
+        lookups = stats.get('cache_hits', 0) + stats.get('cache_misses', 0)
+        hit_rate = stats.get('cache_hits', 0) / lookups if lookups else 0.0
+        print(f'{cache_bytes:>12} {operations / args.duration:>10.0f} {hit_rate:>9.1%}')
+
+
+def lock_worker(store: KVServer, keys: int, duration: float, write_ratio: float, results: tp.List[tp.Tuple[int, float, float]]) -> None:
+    """
+    Read (and optionally write) the store in-process until the duration expires, timing the wait
+    for the read lock apart from the time the lock is held
+    """
+    operations = 0
+    waited = held = 0.0
+    deadline = time.perf_counter() + duration
+    write_every = int(1 / write_ratio) if write_ratio else 0
+    while time.perf_counter() < deadline:
+        index = operations % keys
+        if write_every and operations % write_every == 0:
+            store.put_request(f'key{index}', {'age': operations})
+        else:
+            started = time.perf_counter()
+            with store.lock.read_locked():
+                acquired = time.perf_counter()
+                store.root.get(f'key{index}')
+            held += time.perf_counter() - acquired
+            waited += acquired - started
+        operations += 1
+    results.append((operations, waited, held))
+
+
+def store_benchmark(args) -> None:
+    """
+    Measure throughput of a single shared store as the number of connections rises,
+    then the read lock itself with the same number of threads reading the store in-process.
+    The connection threads take turns on one interpreter lock, so neither throughput scales with
+    the clients. The wait for the read lock and the time it is held grow with the threads as well,
+    since a thread can lose the interpreter lock halfway through either
+    """
+    port = free_port()
+    server = start_server(port)
+    try:
+        preload(port, args.keys)
+        print(f'{"clients":>8} {"ops/sec":>12} {"per client":>12}')
+        for clients in args.clients:
+            operations = run_clients(port, clients, args.keys, args.duration, args.write_ratio)
+            throughput = operations / args.duration
+            print(f'{clients:>8} {throughput:>12.0f} {throughput / clients:>12.0f}')
+    finally:
+        server.terminate()
+        server.wait()
+
+    store = KVServer()
+    for index in range(args.keys):
+        store.put_request(f'key{index}', {'name': f'person{index}', 'age': index % 90})
+    print(f'\n{"threads":>8} {"ops/sec":>12} {"lock wait us":>13} {"lock held us":>13}')
+    for clients in args.clients:
+        results: tp.List[tp.Tuple[int, float, float]] = []
+        threads = [
+            threading.Thread(target=lock_worker, args=(store, args.keys, args.duration, args.write_ratio, results))
+            for _ in range(clients)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        operations = sum(result[0] for result in results)
+        reads = operations - (operations // int(1 / args.write_ratio) if args.write_ratio else 0)
+        waited = sum(result[1] for result in results) / max(reads, 1) * 1e6
+        held = sum(result[2] for result in results) / max(reads, 1) * 1e6
+        print(f'{clients:>8} {operations / args.duration:>12.0f} {waited:>13.2f} {held:>13.2f}')
+
+
+def workers_benchmark(args) -> None:
+    """
+    Measure GET/PUT throughput of one server as the number of worker processes rises.
+    Every worker takes connections on the shared port and forwards the keys it does not own
+    """
+    print(f'{"workers":>8} {"clients":>8} {"ops/sec":>12} {"speedup":>8}')
+    baseline = None
+    for workers in args.workers:
+        port = free_port()
+        server = start_server(port, '-w', str(workers))
+        try:
+            preload(port, args.keys)
+            throughput = run_clients(port, args.clients, args.keys, args.duration, args.write_ratio) / args.duration
+        finally:
+            server.terminate()
+            server.wait()
+        baseline = baseline or throughput
+        print(f'{workers:>8} {args.clients:>8} {throughput:>12.0f} {throughput / baseline:>7.2f}x')
+    print(f'[Benchmark]: {os.cpu_count()} cores')
+
+
+def latency_worker(port: int, keys: int, duration: float, results) -> None:
+    """
+    Issue GET requests on one connection and report the latency of every one of them
+    """
+    connection = connect(port)
+    latencies = []
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        request(connection, f'GET key{len(latencies) % keys}')
+        latencies.append(time.perf_counter() - started)
+    request(connection, 'exit')
+    connection.close()
+    results.put(latencies)
+
+
+def compute_worker(port: int, terms: int, duration: float, results) -> None:
+    """
+    Issue heavy COMPUTE requests on one connection and count the answered and the refused ones
+    """
+    formula = (
+        'COMPUTE ' + '+'.join(['x*y/(x+1)^2'] * terms) +
+        ' WHERE x = QUERY key1.age AND y = QUERY key2.age'
+    )
+    connection = connect(port)
+    answered = busy = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        if request(connection, formula) == 'BUSY':
+            busy += 1
+        else:
+            answered += 1
+    request(connection, 'exit')
+    connection.close()
+    results.put((answered, busy))
+
+
+def mixed_benchmark(args) -> None:
+    """
+    GET latency while other connections send heavy COMPUTE formulas,
+    with the formulas evaluated on the connection threads and on compute process pools
+    """
+    print(f'{"processes":>10} {"GET/sec":>10} {"p50 ms":>8} {"p99 ms":>8} {"COMPUTE/sec":>12} {"BUSY/sec":>10}')
+    for processes in args.processes:
+        port = free_port()
+        server = start_server(port, '--compute-processes', str(processes), '--compute-queue', str(args.queue))
+        try:
+            preload(port, args.keys)
+            # the first formula spawns the pool processes
+            connection = connect(port)
+            request(connection, 'COMPUTE x WHERE x = QUERY key1.age')
+            request(connection, 'exit')
+            connection.close()
+            latencies_queue = multiprocessing.Queue()
+            computes_queue = multiprocessing.Queue()
+            workers = [multiprocessing.Process(target=latency_worker, args=(port, args.keys, args.duration, latencies_queue))]
+            workers += [
+                multiprocessing.Process(target=compute_worker, args=(port, args.terms, args.duration, computes_queue))
+                for _ in range(args.compute_clients)
+            ]
+            for worker in workers:
+                worker.start()
+            latencies = sorted(latencies_queue.get())
+            computes = [computes_queue.get() for _ in range(args.compute_clients)]
+            for worker in workers:
+                worker.join()
+        finally:
+            server.terminate()
+            server.wait()
+        answered = sum(count for count, _ in computes)
+        busy = sum(count for _, count in computes)
+        print(
+            f'{processes:>10} {len(latencies) / args.duration:>10.0f} '
+            f'{latencies[len(latencies) // 2] * 1000:>8.2f} {latencies[int(len(latencies) * 0.99)] * 1000:>8.2f} '
+            f'{answered / args.duration:>12.0f} {busy / args.duration:>10.0f}'
+        )
+
+
+def process_status(pid: int) -> tp.Dict[str, str]:
+    """
+    Read the resident memory and thread count of a process from /proc (Linux only)
+    """
+    status = {'VmRSS': '?', 'Threads': '?'}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name in status:
+                    status[name] = value.strip()
+    except OSError:
+        pass
+    return status
+
+
+def server_benchmark(args) -> None:
+    """
+    Compare the threaded and the event loop server engines
+    while many idle connections stay open next to a few busy ones
+    """
+    print(f'{"mode":>10} {"idle":>6} {"clients":>8} {"ops/sec":>12} {"threads":>8} {"rss":>12}')
+    for mode in args.modes:
+        port = free_port()
+        server = start_server(port, '-m', mode)
+        idle_connections = []
+        try:
+            preload(port, args.keys)
+            for _ in range(args.idle):
+                connection = connect(port)
+                request(connection, 'ping')
+                idle_connections.append(connection)
+
+            operations = run_clients(port, args.clients, args.keys, args.duration, 0.0)
+            status = process_status(server.pid)
+            print(
+                f'{mode:>10} {args.idle:>6} {args.clients:>8} {operations / args.duration:>12.0f} '
+                f'{status["Threads"]:>8} {status["VmRSS"]:>12}'
+            )
+        finally:
+            for connection in idle_connections:
+                connection.close()
+            server.terminate()
+            server.wait()
+
+
+def key_sets(count: int, seed: int = 7) -> tp.Dict[str, tp.List[str]]:
+    """
+    Key sets shaped like the keys real deployments store
+    """
+    generator = random.Random(seed)
+    words = [
+        ''.join(generator.choice(string.ascii_lowercase) for _ in range(generator.randint(3, 9)))
+        for _ in range(max(count // 20, 10))
+    ]
+    return {
+        'sequential': [f'user{index:08d}' for index in range(count)],
+        'paths': [
+            f'/api/v1/{generator.choice(words)}/{generator.randrange(count)}/{generator.choice(words)}'
+            for _ in range(count)
+        ],
+        'random': [f'{generator.getrandbits(64):016x}' for _ in range(count)],
+    }
+
+
+def trie_benchmark(args) -> None:
+    """
+    Compare memory, build time and lookup latency of the trie engines
+    """
+    print(f'{"keys":>10} {"engine":>8} {"memory":>12} {"bytes/key":>10} {"build s":>8} {"get ns":>8}')
+    for name, keys in key_sets(args.keys).items():
+        keys = list(dict.fromkeys(keys))
+        lookups = random.Random(3).sample(keys, min(len(keys), args.lookups))
+        for engine in args.engines:
+            gc.collect()
+            tracemalloc.start()
+            started = time.perf_counter()
+            trie = ENGINES[engine]()
+            for index, key in enumerate(keys):
+                trie.put(key, index)
+            build_time = time.perf_counter() - started
+            memory, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            get = trie.get
+            started = time.perf_counter()
+            for key in lookups:
+                get(key)
+            lookup_time = (time.perf_counter() - started) / len(lookups)
+
+            print(
+                f'{name:>10} {engine:>8} {memory / 1024 / 1024:>10.1f}MB {memory / len(keys):>10.0f} '
+                f'{build_time:>8.2f} {lookup_time * 1e9:>8.0f}'
+            )
+            del trie
+
+
+def keypath_benchmark(args) -> None:
+    """
+    QUERY latency and index memory of nested keypaths with and without the keypath index
+    """
+    def document(index: int) -> tp.Dict[str, tp.Any]:
+        value: tp.Any = index
+        for level in reversed(range(args.depth)):
+            value = {f'field{level}': value, f'other{level}': {'name': f'person{index}', 'tags': ['a', 'b']}}
+        return value
+
+    keypath = '.'.join(f'field{level}' for level in range(args.depth))
+    lookups = [f'key{random.Random(index).randrange(args.keys)}.{keypath}' for index in range(args.lookups)]
+    print(f'{"index":>8} {"query ns":>10} {"lookup ns":>10} {"index paths":>12} {"index memory":>14}')
+    for indexed in (False, True):
+        server = KVServer(keypaths=KeypathIndex(['key']) if indexed else None)
+        server.put_many_request([(f'key{index}', document(index)) for index in range(args.keys)])
+        timings = []
+        # the whole request under the read lock, and the lookup alone
+        for query in (server.query_request, server.query):
+            started = time.perf_counter()
+            for path in lookups:
+                query(path)
+            timings.append((time.perf_counter() - started) / len(lookups))
+        stats = server.stats_request()
+        print(
+            f'{"on" if indexed else "off":>8} {timings[0] * 1e9:>10.0f} {timings[1] * 1e9:>10.0f} '
+            f'{stats.get("keypath_index_paths", 0):>12} '
+            f'{stats.get("keypath_index_bytes", 0) / 1024 / 1024:>12.1f}MB'
+        )
+
+
+def find_benchmark(args) -> None:
+    """
+    Keys whose nested field lies in a narrow range, found with a full scan of the values
+    and with the sorted field index
+    """
+    server = KVServer(indexes=FieldIndexes(['person.age']))
+    generator = random.Random(5)
+    server.put_many_request([
+        (f'key{index}', {'person': {'name': f'person{index}', 'age': generator.randrange(100000)}})
+        for index in range(args.keys)
+    ])
+
+    def scan(low: int, high: int) -> int:
+        return sum(
+            1 for _, value in server.scan_request('', None)
+            if low <= value['person']['age'] <= high
+        )
+
+    def find(low: int, high: int) -> int:
+        return len(server.find_request('person.age', low, high))
+
+    print(f'{"mode":>6} {"finds/sec":>10} {"matches":>8}') # matches per FIND on average
+    for name, run in (('scan', scan), ('index', find)):
+        iterations = 3 if name == 'scan' else args.iterations
+        matches = 0
+        started = time.perf_counter()
+        for iteration in range(iterations):
+            low = iteration * 97 % 99000
+            matches += run(low, low + args.width)
+        elapsed = time.perf_counter() - started
+        print(f'{name:>6} {iterations / elapsed:>10.1f} {matches / iterations:>8.0f}')
+
+
+def load_benchmark(args) -> None:
+    """
+    Build time of every engine from sorted keys, one put per key against one bottom-up load_sorted pass
+    """
+    print(f'{"keys":>10} {"engine":>8} {"put s":>8} {"load s":>8} {"speedup":>8}')
+    for name, keys in key_sets(args.keys).items():
+        items = sorted((key, index) for index, key in enumerate(dict.fromkeys(keys)))
+        for engine in args.engines:
+            gc.collect()
+            started = time.perf_counter()
+            trie = ENGINES[engine]()
+            for key, value in items:
+                trie.put(key, value)
+            put_time = time.perf_counter() - started
+            del trie
+
+            gc.collect()
+            started = time.perf_counter()
+            trie = ENGINES[engine]()
+            trie.load_sorted(items)
+            load_time = time.perf_counter() - started
+            del trie
+            print(f'{name:>10} {engine:>8} {put_time:>8.2f} {load_time:>8.2f} {put_time / load_time:>7.1f}x')
+
+
+def ring_benchmark(args) -> None:
+    """
+    Balance of the consistent hash ring and the share of keys that move when a server joins
+    """
+    keys = key_sets(args.keys)['paths']
+    nodes = [f'127.0.0.1:{7000 + index}' for index in range(args.servers)]
+    print(f'{"virtual":>8} {"servers":>8} {"min/mean":>9} {"max/mean":>9} {"moved":>8} {"ideal":>8}')
+    for virtual_nodes in args.virtual_nodes:
+        ring = HashRing(nodes, virtual_nodes)
+        load = dict.fromkeys(nodes, 0)
+        before = {}
+        for key in keys:
+            owners = ring.owners(key, args.k)
+            before[key] = owners
+            for node in owners:
+                load[node] += 1
+
+        ring.add(f'127.0.0.1:{7000 + args.servers}')
+        moved = sum(1 for key in keys if ring.owners(key, args.k) != before[key])
+        mean = len(keys) * min(args.k, len(nodes)) / len(nodes)
+        print(
+            f'{virtual_nodes:>8} {args.servers:>8} {min(load.values()) / mean:>9.2f} {max(load.values()) / mean:>9.2f} '
+            f'{moved / len(keys):>8.1%} {min(args.k, args.servers + 1) / (args.servers + 1):>8.1%}'
+        )
+
+
+def compute_benchmark(args) -> None:
+    """
+    COMPUTE operations per second with the formula interpreted on every call,
+    compiled on every call and compiled once through the formula cache
+    """
+    trie = Trie()
+    trie.put('key1', {'key2': {'key3': 4, 'key4': 8}})
+    trie.put('key8', {'key9': {'key12': {'key13': 7, 'key14': 11}}})
+    formula = 'COMPUTE x+2*(y+3)/(x-1)^2 WHERE x = QUERY key1.key2.key3 AND y = QUERY key8.key9.key12.key14'
+    evaluator = MathExpressionEvaluator()
+
+    def interpreted() -> tp.Any:
+        # tokenize the formula with the values substituted and run the shunting-yard every call
+        computation = 'x+2*(y+3)/(x-1)^2'
+        for variable, keypath in (('x', 'key1.key2.key3'), ('y', 'key8.key9.key12.key14')):
+            computation = computation.replace(variable, str(trie.query(keypath)))
+        evaluated_expression = evaluator.evaluate_expression(
+            evaluator.tokenize(computation),
+            trie.operators,
+            trie.functions,
+            trie.left_associative_operators
+        )
+        return evaluator.compute_expression(evaluated_expression, trie.operators, trie.functions)
+
+    def compiled() -> tp.Any:
+        compile_formula.cache_clear()
+        return trie.compute(formula)
+
+    def cached() -> tp.Any:
+        return trie.compute(formula)
+
+    print(f'{"mode":>12} {"ops/sec":>12} {"result":>30}')
+    for name, run in (('interpreted', interpreted), ('compiled', compiled), ('cached', cached)):
+        result = run()
+        started = time.perf_counter()
+        for _ in range(args.iterations):
+            run()
+        elapsed = time.perf_counter() - started
+        print(f'{name:>12} {args.iterations / elapsed:>12.0f} {str(result):>30}')
+
+
+def aggregate_benchmark(args) -> None:
+    """
+    Sum of an expression over every record, with one COMPUTE per key added up by the client
+    and with one aggregate COMPUTE evaluated column-wise by the server
+    """
+    port = free_port()
+    server = start_server(port, '--compute-processes', '0')
+    try:
+        preload(port, args.keys)
+        connection = connect(port)
+
+        def per_key() -> float:
+            return sum(
+                float(request(connection, f'COMPUTE x * 2 + 1 WHERE x = QUERY key{index}.age'))
+                for index in range(args.keys)
+            )
+
+        def aggregate() -> float:
+            return float(request(connection, 'COMPUTE SUM(x * 2 + 1) OVER key WHERE x = FIELD age'))
+
+        print(f'columns evaluated with {"numpy" if aggregates.numpy is not None else "lists"}')
+        print(f'{"mode":>10} {"seconds":>10} {"keys/sec":>12} {"result":>14}')
+        for name, run in (('per key', per_key), ('aggregate', aggregate)):
+            started = time.perf_counter()
+            result = run()
+            elapsed = time.perf_counter() - started
+            print(f'{name:>10} {elapsed:>10.3f} {args.keys / elapsed:>12.0f} {result:>14.0f}')
+        request(connection, 'exit')
+        connection.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def startup_benchmark(args) -> None:
+    """
+    Cold start time and resident memory of a server recovering a snapshot
+    loaded into the trie (jsonl) or served from a memory-mapped file (mmap)
+    """
+    print(f'{"keys":>10} {"format":>8} {"snapshot":>12} {"startup s":>10} {"rss":>12}')
+    for count in args.keys:
+        items = [(f'user{index:08d}', {'id': index, 'name': f'name{index}'}) for index in range(count)]
+        for snapshot_format in args.formats:
+            data_dir = tempfile.mkdtemp(prefix='kv-startup-')
+            try:
+                path = SnapshotStore(data_dir, snapshot_format).write(1, items)
+                port = free_port()
+                started = time.perf_counter()
+                server = start_server(
+                    port, '-e', args.engine, '--data-dir', data_dir, '--snapshot-format', snapshot_format
+                )
+                try:
+                    # the socket listens before recovery, the first answer comes after it
+                    connection = connect(port)
+                    request(connection, 'ping')
+                    startup_time = time.perf_counter() - started
+                    connection.close()
+                    status = process_status(server.pid)
+                finally:
+                    server.terminate()
+                    server.wait()
+                print(
+                    f'{count:>10} {snapshot_format:>8} {os.path.getsize(path) / 1024 / 1024:>10.1f}MB '
+                    f'{startup_time:>10.2f} {status["VmRSS"]:>12}'
+                )
+            finally:
+                shutil.rmtree(data_dir)
+
+
+def repair_benchmark(args) -> None:
+    """
+    Bytes an anti-entropy repair moves to bring a replica that missed a share of the writes
+    back in step with its peers, against copying every key it owns again
+    """
+    print(
+        f'{"missing":>8} {"keys":>8} {"repair":>12} {"full resync":>12} {"ratio":>8} '
+        f'{"messages":>9} {"seconds":>8}'
+    )
+    for missing in args.missing:
+        ports = [free_port() for _ in range(args.servers)]
+        names = [f'127.0.0.1:{port}' for port in ports]
+        ring = HashRing(names)
+        peers = tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False)
+        peers.write(''.join(f'127.0.0.1 {port}\n' for port in ports))
+        peers.close()
+        servers = [
+            start_server(port, '--peers', peers.name, '-k', str(args.k), '--anti-entropy-interval', '0')
+            for port in ports
+        ]
+        try:
+            # the first server misses a share of its writes
+            lagging = names[0]
+            randomness = random.Random(11)
+            batches: tp.Dict[str, tp.List[bytes]] = {name: [] for name in names}
+            full_resync = 0
+            dropped = 0
+            for index in range(args.keys):
+                key = f'user{index:08d}'
+                record = json.dumps({key: {'id': index, 'name': f'name{index}', 'tags': ['a', 'b']}}).encode('utf-8')
+                for name in ring.owners(key, args.k):
+                    if name == lagging:
+                        full_resync += len(record) + 1
+                        if randomness.random() < missing:
+                            dropped += 1
+                            continue
+                    batches[name].append(record)
+
+            for name, port in zip(names, ports):
+                connection = connect(port)
+                records = batches[name]
+                for start in range(0, len(records), 1000):
+                    request(connection, 'MPUT 1', b'\n'.join(records[start:start + 1000]))
+                request(connection, 'exit')
+                connection.close()
+
+            connection = connect(ports[0])
+            started = time.perf_counter()
+            results = json.loads(request(connection, 'REPAIR'))
+            elapsed = time.perf_counter() - started
+            # a second round must find nothing left to repair
+            again = json.loads(request(connection, 'REPAIR'))
+            request(connection, 'exit')
+            connection.close()
+            if any(stats['buckets'] for stats in again.values()):
+                print(f'[Benchmark]: replicas still differ after a repair at {missing:.1%} missing')
+
+            repair_bytes = sum(stats['bytes'] for stats in results.values())
+            messages = sum(stats['messages'] for stats in results.values())
+            print(
+                f'{missing:>8.1%} {dropped:>8} {repair_bytes / 1024:>10.1f}KB {full_resync / 1024:>10.1f}KB '
+                f'{repair_bytes / full_resync:>8.3f} {messages:>9} {elapsed:>8.2f}'
+            )
+        finally:
+            for server in servers:
+                server.terminate()
+                server.wait()
+            os.remove(peers.name)
+
+
+def run_benchmark_arguments():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    store = subparsers.add_parser(
+        'store',
+        help='multi-client throughput against one shared store'
+    )
+    store.add_argument('--clients', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    store.add_argument('--keys', type=int, default=1000)
+    store.add_argument('--duration', type=float, default=3.0)
+    store.add_argument(
+        '--write-ratio',
+        help='fraction of requests that are PUTs',
+        type=float,
+        default=0.0
+    )
+    store.set_defaults(run=store_benchmark)
+
+    server = subparsers.add_parser(
+        'server',
+        help='threaded against event loop server engine with many idle connections'
+    )
+    server.add_argument('--modes', nargs='+', choices=['threaded', 'async'], default=['threaded', 'async'])
+    server.add_argument('--idle', help='idle connections kept open', type=int, default=1000)
+    server.add_argument('--clients', help='busy connections', type=int, default=4)
+    server.add_argument('--keys', type=int, default=1000)
+    server.add_argument('--duration', type=float, default=3.0)
+    server.set_defaults(run=server_benchmark)
+
+    workers = subparsers.add_parser(
+        'workers',
+        help='throughput of one server with several sharded worker processes'
+    )
+    workers.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    workers.add_argument('--clients', help='busy connections', type=int, default=8)
+    workers.add_argument('--keys', type=int, default=1000)
+    workers.add_argument('--duration', type=float, default=3.0)
+    workers.add_argument(
+        '--write-ratio',
+        help='fraction of requests that are PUTs',
+        type=float,
+        default=0.0
+    )
+    workers.set_defaults(run=workers_benchmark)
+
+    mixed = subparsers.add_parser(
+        'mixed',
+        help='GET latency next to heavy COMPUTE formulas, evaluated on the connection threads or on a process pool'
+    )
+    mixed.add_argument('--processes', help='compute processes, 0 evaluates on the connection threads', type=int, nargs='+', default=[0, 2])
+    mixed.add_argument('--queue', help='formulas that may wait for a compute process', type=int, default=16)
+    mixed.add_argument('--compute-clients', type=int, default=4)
+    mixed.add_argument('--terms', help='terms of every COMPUTE formula', type=int, default=2000)
+    mixed.add_argument('--keys', type=int, default=1000)
+    mixed.add_argument('--duration', type=float, default=3.0)
+    mixed.set_defaults(run=mixed_benchmark)
+
+    trie = subparsers.add_parser(
+        'trie',
+        help='memory and lookup latency of the trie engines on realistic key sets'
+    )
+    trie.add_argument('--engines', nargs='+', choices=sorted(ENGINES), default=sorted(ENGINES))
+    trie.add_argument('--keys', type=int, default=100000)
+    trie.add_argument('--lookups', type=int, default=100000)
+    trie.set_defaults(run=trie_benchmark)
+
+    compute = subparsers.add_parser(
+        'compute',
+        help='COMPUTE operations per second with and without the compiled formula cache'
+    )
+    compute.add_argument('--iterations', type=int, default=20000)
+    compute.set_defaults(run=compute_benchmark)
+
+    aggregate = subparsers.add_parser(
+        'aggregate',
+        help='an aggregate COMPUTE over a key prefix against one COMPUTE per key'
+    )
+    aggregate.add_argument('--keys', type=int, default=20000)
+    aggregate.set_defaults(run=aggregate_benchmark)
+
+    keypath = subparsers.add_parser(
+        'keypath',
+        help='QUERY latency of nested keypaths with and without the keypath index'
+    )
+    keypath.add_argument('--keys', type=int, default=20000)
+    keypath.add_argument('--depth', help='nesting depth of the queried field', type=int, default=4)
+    keypath.add_argument('--lookups', type=int, default=100000)
+    keypath.set_defaults(run=keypath_benchmark)
+
+    find = subparsers.add_parser(
+        'find',
+        help='FIND over a range of a nested numeric field with a full scan and with the field index'
+    )
+    find.add_argument('--keys', type=int, default=100000)
+    find.add_argument('--width', help='width of the searched range, the field is uniform over 0-100000', type=int, default=100)
+    find.add_argument('--iterations', type=int, default=10000)
+    find.set_defaults(run=find_benchmark)
+
+    cache = subparsers.add_parser(
+        'cache',
+        help='throughput of skewed GET and QUERY traffic without and with the response cache'
+    )
+    cache.add_argument('--cache-bytes', help='cache budgets to compare, 0 disables the cache', type=int, nargs='+', default=[0, 1048576])
+    cache.add_argument('--clients', type=int, default=4)
+    cache.add_argument('--keys', type=int, default=5000)
+    cache.add_argument('--hot', help='keys that get nine in ten of the reads', type=int, default=200)
+    cache.add_argument('--duration', type=float, default=3.0)
+    cache.add_argument('--write-ratio', type=float, default=0.01)
+    cache.set_defaults(run=cache_benchmark)
+
+    load = subparsers.add_parser(
+        'load',
+        help='build time of the trie engines with one put per key and with a bottom-up sorted load'
+    )
+    load.add_argument('--engines', nargs='+', choices=sorted(ENGINES), default=sorted(ENGINES))
+    load.add_argument('--keys', type=int, default=100000)
+    load.set_defaults(run=load_benchmark)
+
+    ring = subparsers.add_parser(
+        'ring',
+        help='key balance of the consistent hash ring and keys moved when a server joins'
+    )
+    ring.add_argument('--servers', type=int, default=8)
+    ring.add_argument('-k', type=int, default=2)
+    ring.add_argument('--virtual-nodes', type=int, nargs='+', default=[1, 16, 128, 512])
+    ring.add_argument('--keys', type=int, default=100000)
+    ring.set_defaults(run=ring_benchmark)
+
+    startup = subparsers.add_parser(
+        'startup',
+        help='cold start time and resident memory with jsonl and mmap snapshots'
+    )
+    startup.add_argument('--keys', type=int, nargs='+', default=[10000, 100000, 1000000])
+    startup.add_argument('--formats', nargs='+', choices=['jsonl', 'mmap'], default=['jsonl', 'mmap'])
+    startup.add_argument('--engine', choices=sorted(ENGINES), default='radix')
+    startup.set_defaults(run=startup_benchmark)
+
+    repair = subparsers.add_parser(
+        'repair',
+        help='bytes moved by an anti-entropy repair against a full resync of the lagging replica'
+    )
+    repair.add_argument('--servers', type=int, default=3)
+    repair.add_argument('-k', type=int, default=2)
+    repair.add_argument('--keys', type=int, default=100000)
+    repair.add_argument(
+        '--missing',
+        help='fractions of its writes the lagging replica misses',
+        type=float,
+        nargs='+',
+        default=[0.0, 0.001, 0.01, 0.1, 1.0]
+    )
+    repair.set_defaults(run=repair_benchmark)
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = run_benchmark_arguments()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
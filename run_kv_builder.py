@@ -0,0 +1,77 @@
+import os
+import time
+import argparse
+from bulk_load import ascending, read_items, sort_items
+from persistence import SNAPSHOT_PREFIX, WAL_PREFIX, SnapshotStore
+
+
+def build_snapshot(input_path: str, data_dir: str, snapshot_format: str, sort: bool, run_size: int) -> str:
+    """
+    Write the pairs of a key file as the first snapshot of a new data directory,
+    so a server started with --data-dir on it comes up populated without any PUT
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    for name in os.listdir(data_dir):
+        if name.startswith((SNAPSHOT_PREFIX, WAL_PREFIX)):
+            raise ValueError(f'{data_dir} already holds a store')
+
+    items = read_items(input_path)
+    items = sort_items(items, run_size) if sort else ascending(items)
+    return SnapshotStore(data_dir, snapshot_format).write(0, items)
+
+
+def run_builder_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-i',
+        help='Key file, JSON lines or a mapped trie file, sorted by key unless --sort is given',
+        type=str,
+        required=True
+    )
+    parser.add_argument(
+        '-o',
+        help='Data directory of the server to build',
+        type=str,
+        required=True
+    )
+    parser.add_argument(
+        '--snapshot-format',
+        help='Snapshot format the server will be started with',
+        choices=['jsonl', 'mmap'],
+        default='jsonl'
+    )
+    parser.add_argument(
+        '--sort',
+        help='Sort an unsorted key file with an external merge sort first',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--run-size',
+        help='Pairs sorted in memory at a time by --sort',
+        type=int_type,
+        default=100000
+    )
+    args = parser.parse_args()
+    return args
+
+
+def int_type(arg):
+    if not arg.isdigit():
+        raise argparse.ArgumentTypeError(
+            f'Error: {arg} is not an integer. Please provide an integer as argument!')
+    return int(arg)
+
+
+def main():
+    args = run_builder_arguments()
+    started = time.perf_counter()
+    try:
+        path = build_snapshot(args.i, args.o, args.snapshot_format, args.sort, args.run_size)
+    except (ValueError, OSError) as error:
+        print('[Builder]:', error)
+        raise SystemExit(1)
+    print(f'[Builder]: Wrote {path} in {time.perf_counter() - started:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
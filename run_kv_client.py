@@ -1,10 +1,45 @@
+import re 
 import json 
+import heapq 
 import socket 
-import random 
 import asyncio 
 import typing as tp 
 import argparse 
 import os 
+import time 
+import collections
+import contextlib
+from connection_pool import ServerPool
+from hash_ring import RING_SIZE, HashRing
+from aggregates import compile_aggregate, finish, is_aggregate, merge_partials
+from secondary_index import merge_found, parse_find
+from resharding import changed_ring
+from trie_structure import bind_formula, compile_formula
+from wire_protocol import FramedConnection, ProtocolError, encode_frame, read_frame
+
+
+class LatencyTracker:
+    """
+    Percentiles over a sliding window of the most recent request latencies
+    """
+
+    def __init__(self, window: int = 1000) -> None:
+        self.samples: tp.Deque[float] = collections.deque(maxlen=window)
+        self.count = 0 # requests measured since the client started
+
+    def record(self, seconds: float) -> None:
+        self.samples.append(seconds)
+        self.count += 1
+
+    def percentile(self, percent: float, default: float = 0.0) -> float:
+        """
+        Return the latency below which percent of the window falls, default while the window is empty
+        """
+        if not self.samples:
+            return default
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(len(ordered) * percent / 100))
+        return ordered[index]
 
 
 class Client: 
@@ -12,19 +47,64 @@ class Client:
         self,
         servers_files_path: str,
         server_data: str,
-        k: int
+        k: int,
+        batch_size: int = 1000,
+        pipeline_depth: int = 8,
+        queue_depth: int = 4,
+        progress_interval: float = 5.0,
+        virtual_nodes: int = 128,
+        read_quorum: int = 1,
+        hedge_percentile: float = 95.0,
+        heartbeat_interval: float = 1.0,
+        pool_size: int = 4,
+        max_backoff: float = 30.0,
+        dead_after: float = 600.0
     ) -> None:
         """
         Constructor method for the Client class
         :param servers_files_path: file path of the servers
         :param server_data: data that will be sent to the servers
         :param k: number of servers to connect to
+        :param batch_size: number of records sent in one MPUT
+        :param pipeline_depth: number of MPUT batches in flight per server
+        :param queue_depth: number of batches read ahead of the slowest server
+        :param progress_interval: seconds between two ingest progress reports
+        :param virtual_nodes: positions of every server on the consistent hash ring
+        :param read_quorum: owners that must answer a GET or QUERY, the newest version wins
+        :param hedge_percentile: latency percentile after which a slow read is also sent to another owner, 0 disables hedging
+        :param heartbeat_interval: seconds between two pings of every server
+        :param pool_size: connections kept open to every server
+        :param max_backoff: longest wait in seconds between two reconnect attempts to a server that is down
+        :param dead_after: seconds a server is down before it is taken off the ring, 0 never
         """
         self._servers_with_data = [] 
         self.k = k 
+        self.batch_size = batch_size
+        self.pipeline_depth = pipeline_depth
+        self.queue_depth = queue_depth
+        self.progress_interval = progress_interval
+        self.server_data = server_data
         self.servers_files_path = servers_files_path
-        self.active_servers = self.get_online_servers() 
-        self.data = self.get_data(server_data) 
+        self.members = self.read_server_file() # "ip:port" of every server
+        self.servers = self.get_online_servers() # "ip:port" -> connection, servers that answered only
+        self.active_servers = list(self.servers.values())
+        # every key lives on the k servers that follow it on the ring,
+        # the writes of an owner that is down go to another server as hints
+        self.ring = HashRing(self.members, virtual_nodes)
+        # while servers are added or removed writes go to the owners on both rings, reads stay on the old one
+        self.next_ring: tp.Optional[HashRing] = None
+        self.read_quorum = read_quorum
+        self.hedge_percentile = hedge_percentile
+        self.read_latency = LatencyTracker() # whole reads as the user sees them
+        self.owner_latency = LatencyTracker() # single requests to one owner, sets the hedge delay
+        self.heartbeat_interval = heartbeat_interval
+        self.pool_size = pool_size
+        self.max_backoff = max_backoff
+        self.dead_after = dead_after
+        # commands run on pooled asyncio connections, opened once listen starts its event loop
+        self.pools: tp.Dict[str, ServerPool] = {}
+        # losing hedged requests finish in the background to keep their connection in step
+        self.background_tasks: tp.Set[asyncio.Task] = set()
         asyncio.run(self.put_request()) # run the put_request method asynchronously
 
     @property # this is a decorator that makes servers_with_data a read-only property
@@ -32,173 +112,743 @@ class Client:
         return self._servers_with_data
 
     @servers_with_data.setter
-    def servers_with_data(self, v: tp.List[socket.socket]) -> None:
+    def servers_with_data(self, v: tp.List[FramedConnection]) -> None:
         self._servers_with_data = v
 
-    async def communication(self, server: socket.socket, command: str):
-        server.send(command.encode('utf-8'))
-        response = server.recv(5000).decode('utf-8')
+    async def communication(self, server: FramedConnection, command: str):
+        server.send(command)
+        frame = server.recv()
+        if frame is None:
+            raise OSError('Server closed the connection')
+        response, _ = frame
         print(response)
 
-    async def validate_active_servers(self, servers: tp.List[socket.socket]):
-        active_servers = []
-        for server in servers:
-            try:
-                server.send('ping'.encode('utf-8'))
-                response = server.recv(5000).decode('utf-8')
-                if response.lower() != 'pong':
-                    continue
-                active_servers.append(server)
+    async def scan_stream(self, name: str, command: str) -> tp.AsyncIterator[tp.Tuple[str, tp.Any]]:
+        """
+        Lazily yield the (key, value) pairs one server streams back for a SCAN.
+        Only one chunk per server is held in memory at a time
+        """
+        try:
+            async with contextlib.aclosing(self.pools[name].stream(command)) as frames:
+                async for text, body in frames:
+                    if text != 'CHUNK':
+                        if text != 'END':
+                            print(text)
+                        return
+                    for line in body.splitlines():
+                        key, value = json.loads(line)
+                        yield key, value
+        except (OSError, ProtocolError) as error:
+            print(f'[Client]: SCAN on {name} failed: {error}')
+
+    async def scan(self, names: tp.List[str], command: str):
+        """
+        Send a SCAN to every server and merge their key ordered streams,
+        printing each key once even when several replicas hold it
+        """
+        limit_match = re.search(r'\blimit\s+(\d+)', command, re.IGNORECASE)
+        limit = int(limit_match.group(1)) if limit_match else None
+
+        streams = [self.scan_stream(name, command) for name in names]
+        heap: tp.List[tp.Tuple[str, int, tp.Any]] = []
+
+        async def advance(index: int) -> None:
+            item = await anext(streams[index], None)
+            if item is not None:
+                heapq.heappush(heap, (item[0], index, item[1]))
+
+        # the first chunk of every server is awaited at once, later ones as the merge reaches them
+        await asyncio.gather(*(advance(index) for index in range(len(streams))))
+
+        printed = 0
+        last_key = None
+        while heap:
+            key, index, value = heapq.heappop(heap)
+            if key != last_key:
+                if limit is not None and printed == limit:
+                    break
+                print(f'“{key}” -> {value}')
+                last_key = key
+                printed += 1
+            await advance(index)
+
+        # read every stream to its END frame so the connections go back to their pool
+        for stream in streams:
+            async for _ in stream:
+                pass
+
+        print(f'[Client]: {printed} keys')
+        if limit is not None and printed == limit:
+            print(f'[Client]: next page with AFTER {last_key}')
+
+    def healthy_servers(self, names: tp.Optional[tp.Iterable[str]] = None) -> tp.List[str]:
+        """
+        Return the servers, all of them unless names are given, that the heartbeat last found up
+        """
+        return [name for name in (self.pools if names is None else names) if self.pools[name].healthy]
+
+    async def heartbeat(self) -> None:
+        """
+        Ping every server in the background so commands go straight to the servers known to be up.
+        A server that is down is pinged again once its backoff has passed
+        """
+        while True:
+            await asyncio.gather(*(pool.check(self.heartbeat_interval) for pool in self.pools.values()))
+            for name, pool in self.pools.items():
+                if (
+                    self.dead_after and not pool.healthy and name in self.ring and len(self.ring) > 1
+                    and time.monotonic() - pool.down_since >= self.dead_after
+                ):
+                    # the servers re-replicate its keys to the next servers on the ring as well
+                    self.ring.remove(name)
+                    print(f'[Client]: {name} is down for more than {self.dead_after:.0f}s, taken off the ring')
+            await asyncio.sleep(self.heartbeat_interval)
+
+    def hint_holder(self, key: str, up: tp.Container[str]) -> tp.Optional[str]:
+        """
+        Return the server that keeps the writes of an owner of the key that is down: the first server
+        up after the owners on the ring, or an owner that is up when every server owns the key
+        """
+        preference = self.ring.owners(key, len(self.ring))
+        for name in preference[self.k:] + preference[:self.k]:
+            if name in up:
+                return name
+        return None
+
+    async def broadcast(self, command: str, names: tp.Optional[tp.Iterable[str]] = None) -> None:
+        """
+        Send a command to the servers that are up, all of them unless names are given, and print every response
+        """
+        names = self.healthy_servers(names)
+        if not names:
+            print('[Client]: All servers are down')
+        await asyncio.gather(*(self.send_command(name, command) for name in names))
+
+    async def send_command(self, name: str, command: str, body: bytes = b'') -> None:
+        """
+        Send a command to one server and print its response
+        """
+        try:
+            text, _ = await self.pools[name].request(command, body)
+            print(text)
+        except (OSError, ProtocolError) as error:
+            print(f'[Client]: {name} failed: {error}')
+
+    def write_owners(self, key: str) -> tp.List[str]:
+        """
+        Return the servers a write of the key goes to, the new owners as well during a membership change
+        """
+        owners = self.ring.owners(key, self.k)
+        if self.next_ring is not None:
+            owners += [name for name in self.next_ring.owners(key, self.k) if name not in owners]
+        return owners
+
+    async def change_membership(self, command: str) -> None:
+        """
+        Add a server to the ring or remove one from it while the store keeps serving.
+        Every server moves the keys that gain an owner in the background, the new ring is used
+        for reads once all of them are done
+        """
+        arguments = command.split()
+        if len(arguments) != 2 or arguments[1].count(':') != 1:
+            print('ERROR')
+            return
+        operation, name = arguments[0].lower(), arguments[1]
+        if self.next_ring is not None:
+            print('[Client]: Another server is still being added or removed')
+            return
+        if (operation == 'add') == (name in self.ring):
+            print(f'[Client]: {name} is {"already" if operation == "add" else "not"} on the ring')
+            return
+
+        if operation == 'add':
+            host, port = name.rsplit(':', 1)
+            self.pools[name] = ServerPool(host, int(port), self.pool_size, max_backoff=self.max_backoff)
+            if not await self.pools[name].check(self.heartbeat_interval):
+                print(f'[Client]: {name} does not answer')
+                self.pools.pop(name).close()
+                return
+            self.members.append(name)
+
+        names = self.healthy_servers(self.ring.nodes | {name})
+        responses = await asyncio.gather(*(self.pools[server].request(f'MIGRATE {operation} {name}') for server in names))
+        failed = [server for server, (text, _) in zip(names, responses) if text != 'OK']
+        if failed:
+            # the servers that did start only copy keys, nothing is dropped before the switch
+            print(f'[Client]: {", ".join(failed)} can not start {operation.upper()} {name}, the ring is unchanged')
+            return
+
+        self.next_ring = changed_ring(self.ring, operation, name)
+        print(f'[Client]: {operation.upper()} {name} started, keys move in the background')
+        task = asyncio.create_task(self.follow_migration(operation, name, names))
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    async def follow_migration(self, operation: str, name: str, names: tp.List[str]) -> None:
+        """
+        Wait until every server has moved its keys, then switch all of them and this client to the new ring
+        """
+        try:
+            while True:
+                await asyncio.sleep(1.0)
+                states = {}
+                for server in names:
+                    text, _ = await self.pools[server].request('MIGRATE STATUS')
+                    states[server] = json.loads(text)['state'] if text.startswith('{') else 'failed'
+                if 'failed' in states.values():
+                    failed = [server for server, state in states.items() if state == 'failed']
+                    print(f'[Client]: {operation.upper()} {name} failed on {", ".join(failed)}, the ring is unchanged')
+                    return
+                if all(state == 'moved' for state in states.values()):
+                    break
+
+            await asyncio.gather(*(self.pools[server].request('MIGRATE FINISH') for server in names))
+            self.ring = self.next_ring
+            if operation == 'remove':
+                self.members.remove(name)
+                self.pools.pop(name).close()
+            print(f'[Client]: {operation.upper()} {name} finished, update the servers file to match')
 
-            except:
-                server.close()
+        except (OSError, ProtocolError) as error:
+            print(f'[Client]: {operation.upper()} {name} failed: {error}, the ring is unchanged')
 
-        if not active_servers:
-            print("All server are down, close the connection!")
-            raise OSError()
+        finally:
+            self.next_ring = None
 
-        if len(active_servers) < self.k:
-            print(f"Number of server is less than k:{self.k}")
+    def command_key(self, command: str) -> tp.Optional[str]:
+        """
+        Return the top-level key a GET, DELETE or QUERY command is about
+        """
+        arguments = command.split()
+        if len(arguments) != 2:
+            return None
+        return arguments[1].split('.')[0]
+
+    def open_pools(self) -> None:
+        for name in self.members:
+            host, port = name.rsplit(':', 1)
+            self.pools[name] = ServerPool(host, int(port), self.pool_size, max_backoff=self.max_backoff)
+            if name not in self.servers:
+                self.pools[name].mark_down() # down since startup, the heartbeat retries it
+        # the connections of the ingest are not needed once the pools take over
+        for server in self.active_servers:
+            server.close()
+
+    async def read_owner(self, name: str, command: str) -> tp.Optional[tp.Tuple[str, int]]:
+        """
+        Send a read to one owner
+        :return: the response text and the version of the key, None if the owner failed
+        """
+        pool = self.pools[name]
+        if not pool.healthy:
+            return None
+        started = time.perf_counter()
+        frame = await pool.request(command)
+        self.owner_latency.record(time.perf_counter() - started)
+        if frame[0].startswith(('ERROR', 'EXCEPTION')):
+            return None
+        text, body = frame
+        return text, int(body) if body else 0
+
+    def finish_in_background(self, task: asyncio.Task) -> None:
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        # the result of a losing request is not needed, only retrieved so it is never reported as lost
+        task.add_done_callback(lambda done: done.cancelled() or done.exception())
+
+    async def read_from_owners(self, key: str, command: str) -> tp.Optional[str]:
+        """
+        Read from read_quorum owners of the key in parallel and return the answer with the newest version.
+        A read still waiting after the hedge percentile of recent reads is also sent to the next owner,
+        and a failed owner is replaced by the next one, the first good answers win
+        """
+        # owners the heartbeat found down are only asked when the ones up are not enough
+        owners = sorted(self.ring.owners(key, self.k), key=lambda name: not self.pools[name].healthy)
+        quorum = min(self.read_quorum, len(owners))
+        waiting = list(owners) # owners not asked yet, in ring order
+        pending: tp.Set[asyncio.Task] = set()
+        answers: tp.List[tp.Tuple[str, int]] = []
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+
+        def ask_next_owner() -> None:
+            pending.add(asyncio.ensure_future(self.read_owner(waiting.pop(0), command)))
+
+        for _ in range(quorum):
+            ask_next_owner()
+
+        hedged = not self.hedge_percentile
+        while len(answers) < quorum and pending:
+            timeout = None
+            if not hedged and waiting:
+                hedge_delay = self.owner_latency.percentile(self.hedge_percentile, default=0.05)
+                timeout = max(0.0, started + hedge_delay - loop.time())
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            if not done:
+                hedged = True
+                ask_next_owner()
+                continue
+
+            for task in done:
+                try:
+                    answer = task.result()
+                except (OSError, ProtocolError):
+                    answer = None
+                if answer is not None:
+                    answers.append(answer)
+                elif waiting:
+                    ask_next_owner()
+
+        for task in pending:
+            self.finish_in_background(task)
+
+        if not answers:
+            return None
+        self.read_latency.record(loop.time() - started)
+        text, _ = max(answers, key=lambda answer: answer[1])
+        return text
+
+    def report_latency(self) -> None:
+        latency = self.read_latency
+        print(
+            f'[Client]: read latency over the last {len(latency.samples)} of {latency.count} reads: '
+            f'p50 {latency.percentile(50) * 1000:.2f} ms, p95 {latency.percentile(95) * 1000:.2f} ms, '
+            f'p99 {latency.percentile(99) * 1000:.2f} ms'
+        )
+
+    async def compute(self, command: str):
+        """
+        Resolve every variable of a COMPUTE with a VALUE to the owners of its key, which answers the stored
+        value as JSON, and evaluate the formula locally, since the keys may live on different servers.
+        The errors are printed as a server prints them
+        """
+        if is_aggregate(command):
+            await self.aggregate(command)
+            return
+
+        try:
+            _, variable_keypaths = compile_formula(' '.join(command.split()))
+        except ValueError as error:
+            print(error)
+            return
+
+        values = {}
+        for _, keypath in variable_keypaths:
+            response = await self.read_from_owners(keypath.split('.')[0], f'VALUE {keypath}')
+            if response is None:
+                print(f'[Client]: No owner of {keypath} answered')
+                return
+            values[keypath] = None if response == 'NOT FOUND' else json.loads(response)
 
-        return active_servers
+        try:
+            compiled_expression, bindings = bind_formula(command, values.get)
+        except ValueError as error:
+            print(error)
+            return
+        try:
+            print(compiled_expression.evaluate(bindings))
+        except Exception:
+            print('EXCEPTION ERROR!')
+
+    async def ask_primaries(self, command: str) -> tp.List[tp.Tuple[str, bytes]]:
+        """
+        Send a command to every server that is up with, in the body, the ring hash ranges of the keys
+        it is the first owner up of, so the keys stored on k servers are answered by one server only
+        :return: the (text, body) response of every server that answered
+        """
+        ranges = self.ring.primary_ranges(self.k, set(self.healthy_servers(self.ring.nodes)))
+        if sum(end - start for name_ranges in ranges.values() for start, end in name_ranges) < RING_SIZE:
+            print('[Client]: Every owner of some keys is down, they are left out')
+
+        async def request(name: str) -> tp.Optional[tp.Tuple[str, bytes]]:
+            try:
+                return await self.pools[name].request(command, json.dumps({'ranges': ranges[name]}).encode('utf-8'))
+            except (OSError, ProtocolError) as error:
+                print(f'[Client]: {name} failed: {error}, its keys are left out')
+                return None
+
+        responses = await asyncio.gather(*(request(name) for name in sorted(ranges)))
+        return [response for response in responses if response is not None]
+
+    async def aggregate(self, command: str) -> None:
+        """
+        Run an aggregate COMPUTE on the servers that are up and merge their partial aggregates
+        """
+        try:
+            aggregate, *_ = compile_aggregate(' '.join(command.split()))
+        except ValueError as error:
+            print(error)
+            return
+
+        partials = []
+        for text, body in await self.ask_primaries(command):
+            if not body:
+                print(text)
+                return
+            partials.append(json.loads(body))
+        value = finish(aggregate, merge_partials(partials))
+        print('NOT FOUND' if value is None else value)
+
+    async def find(self, command: str) -> None:
+        """
+        Run a FIND on the servers that are up and merge their ascending matches
+        """
+        try:
+            _, _, _, limit = parse_find(command)
+        except ValueError as error:
+            print(error)
+            return
+
+        bodies = []
+        for text, body in await self.ask_primaries(command):
+            if not text.startswith('OK'):
+                print(text)
+                return
+            bodies.append(body)
+        found = merge_found(bodies, limit)
+        for number, key in found:
+            print(f'“{key}” -> {number}')
+        print(f'[Client]: {len(found)} keys')
 
     async def listen(self):
         """
         Asynchronous method that listens for user input and sends commands to the servers
         """
+        loop = asyncio.get_running_loop()
+        self.open_pools()
+        heartbeat = asyncio.create_task(self.heartbeat())
         try:
             while True:
 
-                command = input(
-                    'Enter command (GET, DELETE, QUERY, COMPUTE or EXIT): '
+                # wait for input in a thread so background reads keep running meanwhile
+                command = await loop.run_in_executor(
+                    None,
+                    input,
+                    'Enter command (GET, DELETE, QUERY, SCAN, FIND, COMPUTE, STATS, LOAD, REPAIR, ADD, REMOVE or EXIT): '
                 )
-                if command.lower().startswith('get'):
-                    servers = await self.validate_active_servers(self.active_servers)
-
-                    await asyncio.gather(
-                        *[
-                            self.communication(server, command) # call the communication method for each server with the given command
-                            for server in servers # iterate over the list of connections
-                        ]
-                    )
+                if command.lower().startswith(('get', 'query')):
+                    # only the owners of the key are asked
+                    key = self.command_key(command)
+                    if key is None:
+                        print('ERROR')
+                        continue
+                    response = await self.read_from_owners(key, command)
+                    print(response if response is not None else f'[Client]: No owner of {key} answered')
 
                 elif command.lower().startswith('delete'):
-                    servers = await self.validate_active_servers(self.active_servers)
-                    if len(servers) != len(self.active_servers):
+                    key = self.command_key(command)
+                    if key is None:
+                        print('ERROR')
+                        continue
+                    # every owner versions the delete the same, so it wins over older writes on each of them
+                    version = time.time_ns()
+                    owners = self.write_owners(key)
+                    up = self.healthy_servers()
+                    requests = []
+                    for name in owners:
+                        if name in up:
+                            requests.append((name, f'{command.strip()} {version}', b''))
+                            continue
+                        # an owner that is down gets the delete when it is back
+                        holder = self.hint_holder(key, up)
+                        if holder is not None:
+                            record = json.dumps(['delete', key, version]).encode('utf-8')
+                            requests.append((holder, f'HINT {name}', record))
+                    if len(requests) != len(owners):
                         print('Delete can not be executed!')
                         continue
-                    await asyncio.gather(
-                        *[
-                            self.communication(server, command)
-                            for server in servers
-                        ]
-                    )
+                    await asyncio.gather(*(self.send_command(*request) for request in requests))
 
-                elif command.lower().startswith('query'): 
-                    servers = await self.validate_active_servers(self.active_servers)
-                    await asyncio.gather(
-                        *[
-                            self.communication(server, command)
-                            for server in servers
-                        ]
-                    )
+                elif command.lower().startswith('scan'): 
+                    servers = self.healthy_servers()
+                    if not servers:
+                        print('[Client]: All servers are down')
+                        continue
+                    down = len(self.pools) - len(servers)
+                    if down >= self.k:
+                        # with k replicas only k servers down at once can hide a key
+                        print(f'[Client]: {down} servers are down, SCAN may miss keys')
+                    await self.scan(servers, command)
+
+                elif command.lower().startswith('stats'): 
+                    await self.broadcast(command)
+                    self.report_latency()
 
                 elif command.lower().startswith('compute'): 
-                    await asyncio.gather(
-                        *[
-                            self.communication(server, command)
-                            for server in self.active_servers
-                        ]
-                    )
+                    await self.compute(command)
+
+                elif command.lower().startswith('find'):
+                    await self.find(command)
+
+                elif command.lower().startswith('load'):
+                    # every server reads the key file from its own disk
+                    await self.broadcast(command)
+
+                elif command.lower().startswith('repair'):
+                    # every server repairs the keys it shares with its peers
+                    await self.broadcast(command)
+
+                elif command.lower().startswith(('add', 'remove')):
+                    await self.change_membership(command)
 
                 elif command.lower().startswith('exit'):
-                    await asyncio.gather(
-                        *[
-                            self.communication(server, command)
-                            for server in self.active_servers
-                        ]
-                    )
+                    await self.broadcast(command)
                     break
 
                 else:
                     print(
-                        'Your command must be one of the following: GET, DELETE, QUERY, COMPUTE or EXIT'
+                        'Your command must be one of the following: GET, DELETE, QUERY, SCAN, FIND, COMPUTE, STATS, LOAD, REPAIR, ADD, REMOVE or EXIT'
                     )
 
         except (KeyboardInterrupt, Exception) as error:
-            server = await self.validate_active_servers(self.active_servers)
-            
-            await asyncio.gather(
-                *[
-                    self.communication(server, 'exit')
-                    for server in server
-                ]
-            )
+            await self.broadcast('exit')
 
-    def get_online_servers(self) -> tp.List[socket.socket]:
+        finally:
+            heartbeat.cancel()
+            for pool in self.pools.values():
+                pool.close()
+
+    def read_server_file(self) -> tp.List[str]:
         """
-        Method for getting the online servers
-        :param path: file path of the servers
-        :return: list of online servers
+        Method for reading the servers file
+        :return: the "ip:port" name of every server of the file
         """
-        servers = [] 
-        down_servers = [] 
         with open(self.servers_files_path, 'r') as f:
-            server_file_lines = [line.rstrip('\n') for line in f] 
+            server_file_lines = [line.rstrip('\n') for line in f if line.strip()] 
 
+        names = []
         for line in server_file_lines:
             ip, port = line.split(' ') 
+            names.append(f'{ip}:{port}')
+        return names
+
+    def get_online_servers(self) -> tp.Dict[str, FramedConnection]:
+        """
+        Method for getting the online servers
+        :return: the connection to every server that answered by its "ip:port" name
+        """
+        servers = {} 
+        down_servers = [] 
+        for name in self.members:
+            ip, port = name.rsplit(':', 1)
             try:
                 connection = self.connect_server(ip, int(port)) 
-                servers.append(connection) 
+                servers[name] = connection
 
             except (socket.error, ValueError):
-                down_servers.append((ip, port))
+                down_servers.append(name)
 
+        if not servers:
+            raise OSError(f'All servers are down: {down_servers}')
         if down_servers:
-            raise OSError(f'Following servers are down: {down_servers}')
+            # the cluster keeps taking writes, other servers hold them until these are back
+            print(f'[Client]: Following servers are down, their writes are kept as hints: {down_servers}')
 
         return servers 
 
-    def connect_server(self, host: str, port: int) -> socket.socket:
+    def connect_server(self, host: str, port: int) -> FramedConnection:
         """
         Method for connecting to a server
         :param server: the server to connect to
-        :return: the socket used to connect to the server
+        :return: the framed connection used to talk to the server
         """
         client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM) 
         client_socket.connect((host, port))
-        return client_socket 
+        return FramedConnection(client_socket)
 
-    def get_data(self, path: str) -> tp.List[tp.Dict[str, tp.Any]]:
+    def get_data(self, path: str) -> tp.Iterator[tp.Tuple[str, bytes]]:
         """
-        Method for reading data from a file
+        Method for streaming data from a file one line at a time
         :param path: file path of the data
-        :return: the data as a dictionary
+        :return: an iterator over the keys of the file and their JSON documents,
+            a line with a single key is validated but not re-encoded
         """
-        with open(path, 'r') as f: 
-            server_file_lines = [json.loads(line.rstrip('\n')) for line in f] 
-        return server_file_lines
+        with open(path, 'rb') as f: 
+            for line_number, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    document = json.loads(line)
+                except json.JSONDecodeError as error:
+                    raise ValueError(f'Line {line_number} of {path} is not valid JSON: {error}')
+                if not isinstance(document, dict):
+                    raise ValueError(f'Line {line_number} of {path} is not a JSON object')
+
+                if len(document) == 1:
+                    yield next(iter(document)), line
+                    continue
+                # keys of one line may belong to different servers
+                for key, value in document.items():
+                    yield key, json.dumps({key: value}).encode('utf-8')
+
+    def get_batches(self, data: tp.Iterator[tp.Tuple[str, bytes]]) -> tp.Iterator[tp.Tuple[str, str, int, bytes]]:
+        """
+        Method for grouping the data into one MPUT body per server without reading ahead of the next batch.
+        Every document is added to the batches of the k owners of its key. The documents of an owner
+        that is down become put records in a HINT batch of the server that holds its hints
+        :param data: the keys and JSON documents to send
+        :return: the server name, the command, the number of records and the body of newline separated records of each batch
+        """
+        batches: tp.Dict[tp.Tuple[str, str], tp.List[bytes]] = {}
+        for key, record in data:
+            for owner in self.ring.owners(key, self.k):
+                if owner in self.servers:
+                    name, command, line = owner, f'MPUT {self.ingest_version}', record
+                else:
+                    name = self.hint_holder(key, self.servers)
+                    if name is None:
+                        continue
+                    command = f'HINT {owner}'
+                    line = json.dumps(['put', key, json.loads(record)[key], self.ingest_version]).encode('utf-8')
+                batch = batches.setdefault((name, command), [])
+                batch.append(line)
+                if len(batch) == self.batch_size:
+                    yield name, command, len(batch), b'\n'.join(batch)
+                    batches[(name, command)] = []
+        for (name, command), batch in batches.items():
+            if batch:
+                yield name, command, len(batch), b'\n'.join(batch)
+
+    async def put_batches(self, server: FramedConnection, batches: asyncio.Queue) -> bool:
+        """
+        Asynchronous method that streams the MPUT and HINT batches of its queue to one server over its own connection.
+        Up to pipeline_depth batches are sent before their OK arrives
+        :return: True if the server stored every batch
+        """
+        in_flight = asyncio.Semaphore(self.pipeline_depth)
+        sent = asyncio.Queue()
+        batch = ()
+
+        async def read_acknowledgements() -> bool:
+            stored = True
+            try:
+                while await sent.get():
+                    frame = await read_frame(reader)
+                    in_flight.release()
+                    if frame is None:
+                        return False
+                    if not frame[0].lower().startswith('ok'):
+                        stored = False
+                return stored
+            finally:
+                # never leave the sender waiting for an acknowledgement that will not come
+                for _ in range(self.pipeline_depth):
+                    in_flight.release()
+
+        try:
+            reader, writer = await asyncio.open_connection(*server.socket.getpeername())
+        except OSError:
+            reader = writer = None
+
+        if writer is None:
+            # keep draining the queue so an unreachable server never blocks the reader
+            while await batches.get() is not None:
+                pass
+            return False
+
+        acknowledgements = asyncio.create_task(read_acknowledgements())
+        try:
+            while True:
+                batch = await batches.get()
+                if batch is None:
+                    break
+                await in_flight.acquire()
+                if acknowledgements.done():
+                    break
+                writer.write(encode_frame(*batch))
+                sent.put_nowait(True)
+                await writer.drain()
+            sent.put_nowait(False)
+            stored = await acknowledgements
+
+            writer.write(encode_frame('exit'))
+            await writer.drain()
+            await read_frame(reader)
+        except (OSError, ProtocolError):
+            stored = False
+        finally:
+            acknowledgements.cancel()
+            writer.close()
+
+        # keep draining the queue so a failed server never blocks the reader
+        while batch is not None:
+            batch = await batches.get()
+
+        return stored
+
+    async def read_batches(self, queues: tp.Dict[str, asyncio.Queue]) -> None:
+        """
+        Asynchronous method that reads and parses the data file in a worker thread
+        and hands every batch to the queue of its server.
+        The queues are bounded, so reading pauses while the slowest server catches up
+        """
+        loop = asyncio.get_running_loop()
+        batches = self.get_batches(self.get_data(self.server_data))
+        started = time.perf_counter()
+        last_report = started
+        records = 0
+        size = 0
+        try:
+            while True:
+                batch = await loop.run_in_executor(None, next, batches, None)
+                if batch is None:
+                    break
+                name, command, count, body = batch
+                await queues[name].put((command, body))
+
+                records += count
+                size += len(body)
+                now = time.perf_counter()
+                if now - last_report >= self.progress_interval:
+                    last_report = now
+                    self.report_progress(records, size, now - started)
+        finally:
+            for queue in queues.values():
+                await queue.put(None)
+
+        self.report_progress(records, size, time.perf_counter() - started)
+
+    def report_progress(self, records: int, size: int, elapsed: float) -> None:
+        megabytes = size / (1024 * 1024)
+        elapsed = max(elapsed, 1e-9)
+        print(
+            f'[Client]: sent {records} records ({megabytes:.1f} MB) '
+            f'at {records / elapsed:.0f} records/s, {megabytes / elapsed:.1f} MB/s'
+        )
 
     async def put_request(self):
         """
-        Asynchronous method that puts the data to random k selected servers
+        Asynchronous method that puts every key to the k servers that own it on the hash ring.
+        The data file is read, batched and sent at the same time
+        and all servers receive their batches concurrently
         """
             
-        self.servers_with_data = random.sample(self.active_servers, k=self.k) 
-        for server in self.servers_with_data:
-            for data in self.data:
-                msg = 'PUT ' + json.dumps(data)
-                server.send(msg.encode('utf-8')) 
-                response = server.recv(5000).decode('utf-8') 
-                if response.lower() != 'ok': 
-                    await asyncio.gather(
-                        *[
-                            self.communication(server, 'exit')
-                            for server in self.active_servers
-                        ]
-                    )
-                    raise OSError('Failed to send the data') 
+        self.servers_with_data = self.active_servers
+        # one version for the whole file, so every replica of a key holds the same version
+        # and a key repeated later in the file still overwrites the earlier line
+        self.ingest_version = time.time_ns()
+        queues = {
+            name: asyncio.Queue(maxsize=self.queue_depth)
+            for name in self.servers
+        }
+        reader = asyncio.create_task(self.read_batches(queues))
+        results = await asyncio.gather(
+            *[
+                self.put_batches(self.servers[name], queue)
+                for name, queue in queues.items()
+            ]
+        )
+        await reader
+        if not all(results): 
+            await asyncio.gather(
+                *[
+                    self.communication(server, 'exit')
+                    for server in self.active_servers
+                ]
+            )
+            raise OSError('Failed to send the data') 
 
 
 def run_client_arguments():
@@ -221,6 +871,72 @@ def run_client_arguments():
         type=int_type,
         required=True
     ) 
+    parser.add_argument(
+        '-b',
+        help='records per MPUT batch',
+        type=int_type,
+        default=1000
+    ) 
+    parser.add_argument(
+        '--pipeline',
+        help='MPUT batches in flight per server',
+        type=int_type,
+        default=8
+    ) 
+    parser.add_argument(
+        '--queue-depth',
+        help='batches read ahead of the slowest server',
+        type=int_type,
+        default=4
+    ) 
+    parser.add_argument(
+        '--progress-interval',
+        help='seconds between ingest progress reports',
+        type=int_type,
+        default=5
+    ) 
+    parser.add_argument(
+        '--virtual-nodes',
+        help='positions of every server on the consistent hash ring',
+        type=int_type,
+        default=128
+    ) 
+    parser.add_argument(
+        '-r',
+        help='owners that must answer a GET or QUERY, the newest version wins',
+        type=int_type,
+        default=1
+    ) 
+    parser.add_argument(
+        '--hedge-percentile',
+        help='latency percentile after which a read is also sent to another owner, 0 disables hedging',
+        type=int_type,
+        default=95
+    ) 
+    parser.add_argument(
+        '--heartbeat-interval',
+        help='seconds between two pings of every server',
+        type=int_type,
+        default=1
+    ) 
+    parser.add_argument(
+        '--pool-size',
+        help='connections kept open to every server',
+        type=int_type,
+        default=4
+    ) 
+    parser.add_argument(
+        '--max-backoff',
+        help='longest wait in seconds between two reconnect attempts to a server that is down',
+        type=int_type,
+        default=30
+    ) 
+    parser.add_argument(
+        '--dead-after',
+        help='seconds a server is down before it is taken off the ring, 0 never',
+        type=int_type,
+        default=600
+    ) 
     args = parser.parse_args() 
     return args
 
@@ -244,7 +960,22 @@ def int_type(arg):
 
 def main():
     args = run_client_arguments() 
-    client = Client(args.s, args.i, args.k) 
+    client = Client(
+        args.s,
+        args.i,
+        args.k,
+        batch_size=args.b,
+        pipeline_depth=args.pipeline,
+        queue_depth=args.queue_depth,
+        progress_interval=args.progress_interval,
+        virtual_nodes=args.virtual_nodes,
+        read_quorum=args.r,
+        hedge_percentile=args.hedge_percentile,
+        heartbeat_interval=args.heartbeat_interval,
+        pool_size=args.pool_size,
+        max_backoff=args.max_backoff,
+        dead_after=args.dead_after
+    ) 
     asyncio.run(client.listen())
 
 
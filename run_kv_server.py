@@ -1,12 +1,55 @@
+import os
 import json
+import time
+import sys
+import signal
 import socket
+import asyncio
 import argparse
 import threading
 import typing as tp
-from KVServer import KVServer
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from KVServer import ENGINES, KVServer
+from hash_ring import HashRing, ring_hash
+from aggregates import HashRanges, compile_aggregate, finish, is_aggregate, merge_partials
+from anti_entropy import MerkleIndex, repair_with
+from hinted_handoff import HintStore, deliver, parse_records, ping
+from resharding import Migration
+from keypath_index import KeypathIndex
+from response_cache import ResponseCache
+from secondary_index import FieldIndexes, encode_entries, merge_found, parse_find
+from compute_pool import ComputeBusy, ComputePool
+from sharding import Shard, gather_compute, merge_scans, merge_stats, scatter_puts
+from wire_protocol import FramedConnection, ProtocolError, encode_frame, read_frame
 
 class Server:
-    def __init__(self, port: int, host: str) -> None:
+    def __init__(
+        self,
+        port: int,
+        host: str,
+        executor_workers: int = 4,
+        engine: str = 'trie',
+        tombstone_retention: float = 60.0,
+        compaction_interval: float = 1.0,
+        data_dir: tp.Optional[str] = None,
+        snapshot_interval: float = 300.0,
+        commit_delay: float = 0.0,
+        snapshot_format: str = 'jsonl',
+        peers_path: tp.Optional[str] = None,
+        replication: int = 1,
+        virtual_nodes: int = 128,
+        anti_entropy_interval: float = 60.0,
+        handoff_interval: float = 5.0,
+        dead_after: float = 600.0,
+        migration_rate: float = 10 * 1024 * 1024,
+        shard: tp.Optional[Shard] = None,
+        compute_processes: int = 0,
+        compute_queue: int = 16,
+        keypath_prefixes: tp.Optional[tp.List[str]] = None,
+        field_indexes: tp.Optional[tp.List[str]] = None,
+        cache_bytes: int = 0
+    ) -> None:
         """
         Constructor method for the Server class
         param
@@ -15,133 +58,841 @@ class Server:
 
         self.host = host
         self.port = port
-        # Set the format for encoding and decoding messages to 'utf-8'
+        # Set the format for encoding and decoding message bodies to 'utf-8'
         self.format = 'utf-8'
-        # Set the maximum size of messages to 10000 bytes
-        self.head = 10000
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Allow a restarted server to bind while old connections are in TIME_WAIT
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # The workers of a sharded server all listen on the same port, the kernel spreads the connections
+        self.shard = shard
+        if shard is not None:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         # Bind the socket to the given host and port
         self.server_socket.bind((self.host, self.port))
         # Listen for client connections
         self.server_socket.listen(1)
         # Initialize an empty list to store client threads
         self.threads: tp.List[threading.Thread] = []
+        # One store for the whole process, shared by every client connection
+        # With a data directory it is recovered from the latest snapshot and the WAL
+        # With a peers file the servers of the cluster keep Merkle trees of the keys they share
+        merkle = self.merkle_index(peers_path, replication, virtual_nodes) if peers_path else None
+        # With keypath prefixes every keypath of the keys under them is indexed for QUERY, * indexes every key
+        keypaths = None
+        if keypath_prefixes:
+            # a mapped snapshot decodes a new copy of a value on every read, which the index then holds
+            keypaths = KeypathIndex(
+                ('' if prefix == '*' else prefix for prefix in keypath_prefixes), copies=snapshot_format == 'mmap'
+            )
+        # With field paths the numbers at each of them are kept in a sorted index that FIND reads ranges of
+        indexes = FieldIndexes(field_indexes) if field_indexes else None
+        # With a cache budget the encoded GET and QUERY responses are kept until their key is written
+        cache = ResponseCache(cache_bytes) if cache_bytes else None
+        self.kv_server = KVServer(
+            engine, tombstone_retention, data_dir, commit_delay, snapshot_format, merkle, keypaths, indexes, cache
+        )
+        # Number of pairs sent in one SCAN chunk
+        self.scan_chunk_size = 1000
+        # Background thread that unlinks expired tombstones a batch at a time
+        self.compaction_interval = compaction_interval
+        self.compaction_thread = threading.Thread(target=self.compact_forever, daemon=True)
+        # Background thread that writes periodic snapshots when the store is durable
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_thread = threading.Thread(target=self.snapshot_forever, daemon=True)
+        # Background thread that repairs the keys shared with the peers
+        self.anti_entropy_interval = anti_entropy_interval
+        self.anti_entropy_thread = threading.Thread(target=self.anti_entropy_forever, daemon=True)
+        # Writes held for servers that were down, handed off by a background thread once they are back.
+        # With peers a server down for longer than dead_after is taken off the ring for good
+        self.hints = HintStore(data_dir)
+        self.handoff_interval = handoff_interval
+        self.dead_after = dead_after
+        self.handoff_thread = threading.Thread(target=self.handoff_forever, daemon=True)
+        # The latest membership change, its keys move in the background at most migration_rate bytes/s
+        self.migration: tp.Optional[Migration] = None
+        self.migration_rate = migration_rate
+        # Bounded pool for CPU heavy commands when the server runs an event loop
+        self.executor = ThreadPoolExecutor(max_workers=executor_workers)
+        # COMPUTE arithmetic runs on a bounded process pool and is refused with BUSY once it is full,
+        # without one it runs on the connection thread
+        self.compute_pool = ComputePool(compute_processes, compute_queue) if compute_processes else None
+        # Background thread that serves the commands the other workers forward to this one
+        self.internal_thread = threading.Thread(target=self.serve_internal, daemon=True)
 
-    def handle_client(self, conn: socket.socket, addr: tp.Tuple[tp.Any, ...], running):
+    def merkle_index(self, peers_path: str, replication: int, virtual_nodes: int) -> MerkleIndex:
         """
-        Handle a client connection by processing messages and performing appropriate actions
+        Place the servers of the peers file, one "ip port" per line as for the client,
+        on the same hash ring as the client so every server knows which keys it shares with which peer
         """
+        with open(peers_path, 'r') as f:
+            names = [':'.join(line.split()) for line in f if line.strip()]
+        return MerkleIndex(f'{self.host}:{self.port}', HashRing(names, virtual_nodes), replication)
 
-        # Print a message indicating that a new connection has been established
-        print(f'[Server Thread]: New connection {addr} connected')
-        # Set a variable to indicate that the client is connected
-        connected = True
-        kv_server = KVServer()
-        # Enter a loop that continues as long as the client is connected and the server is running
-        while connected and running:
-            # Receive a message from the client
-            msg = conn.recv(self.head).decode(self.format)
-            
-            if not msg:
-                continue
-
-            if msg.lower().startswith('exit'):
-                connected = False
-                conn.send('OK'.encode(self.format))
-                continue
-            
-            # if the message starts with 'ping', send back a 'PONG' message
-            if msg.lower().startswith('ping'):
-                conn.send('PONG'.encode(self.format))
+    def respond(self, msg: str, body: bytes = b'', local: bool = False) -> tp.Tuple[str, bytes]:
+        """
+        Process one command and return the text and the body of the frame to send back.
+        GET, QUERY and VALUE answers carry the version of their key in the body.
+        A worker of a sharded server first sends the command where its keys live, unless it is local,
+        forwarded by another worker
+        """
+        if self.shard is not None and not local:
+            routed = self.route(msg, body)
+            if routed is not None:
+                return routed
+        if msg.lower().startswith(('get', 'query', 'value')):
+            return self.handle_read(msg)
+        if msg.lower().startswith('compute') and is_aggregate(msg):
+            return self.handle_aggregate(msg, body)
+        if msg.lower().startswith('find'):
+            return self.handle_find(msg, body)
+        if msg.lower().startswith(('merkle', 'digest', 'fetch', 'sync')):
+            return self.handle_replication(msg, body)
+        return self.handle_message(msg, body), b''
 
-            if msg.lower().startswith('put'):
-                _, data_str = msg.split(' ', 1)
-                
-                try:
-                    data_to_put = json.loads(data_str)
+    def respond_encoded(self, msg: str, body: bytes = b'', local: bool = False) -> bytes:
+        """
+        Process one command and return the encoded frame to send back.
+        GET and QUERY answers come from the response cache when the server has one,
+        a sharded worker only caches the keys it owns
+        """
+        cache = self.kv_server.cache
+        key = self.read_key(msg) if cache is not None else None
+        if key is None or (self.shard is not None and not local and not self.shard.owns(key)):
+            return encode_frame(*self.respond(msg, body, local))
 
-                    for key, value in data_to_put.items():
-                        kv_server.put_request(key, value)
-                    conn.send('OK'.encode(self.format))
+        frame, lease = cache.lookup(msg, key)
+        if frame is not None:
+            return frame
+        cached = None
+        try:
+            text, version_body = self.respond(msg, body, local)
+            frame = encode_frame(text, version_body)
+            # errors are answered again every time
+            if not text.startswith(('ERROR', 'EXCEPTION')):
+                cached = frame
+        finally:
+            # without a frame to cache the lease is given back, also when respond raised
+            cache.fill(msg, key, lease, cached)
+        return frame
 
-                except json.JSONDecodeError:
-                    conn.send('ERROR'.encode(self.format))
+    def read_key(self, msg: str) -> tp.Optional[str]:
+        """
+        Return the top-level key a GET or QUERY reads, parsed as handle_read does, None for other commands
+        """
+        command = msg[:6].lower()
+        if command.startswith('get '):
+            return msg.split(' ', 1)[1]
+        if command.startswith('query '):
+            return msg.split(' ', 1)[1].split('.')[0]
+        return None
 
-                except Exception as error:
-                    print("[Server Thread]:", error)
-                    conn.send('ERROR'.encode(self.format))
+    def route(self, msg: str, body: bytes) -> tp.Optional[tp.Tuple[str, bytes]]:
+        """
+        Run a command on the workers that own its keys: a single key command on its owner,
+        the pairs of PUT and MPUT on their owners, STATS, COMPUTE and LOAD gathered from every worker.
+        :return: the response, None when the command is for this worker alone
+        """
+        shard = self.shard
+        command, *arguments = msg.split() or ['']
+        command = command.lower()
+        key = None
+        if command in ('get', 'delete') and arguments:
+            key = arguments[0]
+        elif command in ('query', 'value') and arguments:
+            key = arguments[0].split('.')[0]
 
-            elif msg.lower().startswith('get'):
-                print("[Server Thread]: GET", msg)
+        try:
+            if key is not None:
+                return None if shard.owns(key) else shard.request(shard.owner(key), msg, body)
 
+            if command in ('put', 'mput'):
                 try:
-                    _, key = msg.split(' ', 1)
-                    get_result = kv_server.get_request(key)
+                    items = self.parse_puts(msg, body)
+                except (ValueError, AttributeError):
+                    return None # this worker answers the malformed command with its ERROR
+                version = f' {arguments[0]}' if body and arguments else ''
+                responses = scatter_puts(shard, f'MPUT{version}', items, self.handle_message)
+                failed = [response for response in responses if not response.startswith('OK')]
+                if failed:
+                    return failed[0], b''
+                return ('OK' if command == 'put' else f'OK {len(items)}'), b''
 
-                    if get_result is None:
-                        conn.send('NOT FOUND'.encode(self.format))
-                        continue
-                    
-                    conn.send(f"“{key}” -> {get_result}".encode(self.format))
+            if command == 'stats':
+                responses = [self.handle_message(msg)]
+                responses += [shard.request(other, msg)[0] for other in shard.others()]
+                return json.dumps(merge_stats(responses)), b''
 
-                except (ValueError, TypeError) as error:
-                    print("[Server Thread]: Server-Error:",  error)
+            if command == 'find':
+                responses = [self.handle_find(msg, body)]
+                responses += [shard.request(other, msg, body) for other in shard.others()]
+                failed = [text for text, _ in responses if not text.startswith('OK')]
+                if failed:
+                    return failed[0], b''
+                _, _, _, limit = parse_find(msg)
+                found = merge_found([found for _, found in responses], limit)
+                return f'OK {len(found)}', encode_entries(found)
 
-            elif msg.lower().startswith('delete'):
-                _, key = msg.split(' ')
+            if command == 'compute' and is_aggregate(msg):
+                responses = [self.handle_aggregate(msg, body)]
+                responses += [shard.request(other, msg, body) for other in shard.others()]
+                failed = [text for text, partial in responses if not partial]
+                if failed:
+                    return failed[0], b''
+                aggregate, *_ = compile_aggregate(' '.join(msg.split()))
+                return self.aggregate_response(aggregate, merge_partials([json.loads(partial) for _, partial in responses]))
 
+            if command == 'compute':
                 try:
-                    kv_server.delete_request(key)
+                    computed_result = gather_compute(shard, msg, self.kv_server.query_request, self.evaluator())
+                except ComputeBusy:
+                    return 'BUSY', b''
+                except Exception:
+                    return 'EXCEPTION ERROR!', b''
+                return ('NOT FOUND' if computed_result is None else str(computed_result)), b''
 
-                except:
-                    conn.send('ERROR'.encode(self.format))
+            if command == 'load':
+                responses = [self.handle_message(msg)]
+                responses += [shard.request(other, msg)[0] for other in shard.others()]
+                failed = [response for response in responses if not response.startswith('OK')]
+                if failed:
+                    return failed[0], b''
+                return f'OK {sum(int(response.split()[1]) for response in responses)}', b''
 
-                conn.send('OK'.encode(self.format))
+        except OSError as error:
+            print("[Server Thread]: Forwarding failed:", error)
+            return 'ERROR a worker of the server is down', b''
 
-            elif msg.lower().startswith('query'):
-                _, keypath = msg.split(' ')
-                
-                try:
-                    query_result = kv_server.query_request(keypath)
+        return None
 
-                except Exception:
-                    conn.send('EXCEPTION ERROR'.encode(self.format))
-                    continue
+    def parse_puts(self, msg: str, body: bytes) -> tp.List[tp.Tuple[str, tp.Any]]:
+        """
+        Return the key-value pairs of a PUT, whose document travels in the body or inline in the text,
+        or of an MPUT with one document per body line
+        """
+        if not body:
+            _, data_str = msg.split(' ', 1)
+            return list(json.loads(data_str).items())
+        return [
+            item
+            for line in body.decode(self.format).splitlines() if line
+            for item in json.loads(line).items()
+        ]
+
+    def handle_aggregate(self, msg: str, body: bytes) -> tp.Tuple[str, bytes]:
+        """
+        COMPUTE <aggregate>(<expression>) OVER <prefix> WHERE <variable> = FIELD <path> [AND ...].
+        The body may hold {"ranges": [[start, end], ...]}, the ring hash ranges of the keys to aggregate,
+        so a key stored on several servers is counted by one of them only
+        """
+        try:
+            keep = None
+            if body:
+                ranges = HashRanges(json.loads(body.decode(self.format))['ranges'])
+                keep = lambda key: ring_hash(key) in ranges
+            aggregate, partial = self.kv_server.aggregate_request(msg, keep)
+
+        except ValueError as error:
+            return str(error), b''
+
+        except Exception as error:
+            print("[Server Thread]:", error)
+            return 'EXCEPTION ERROR!', b''
+
+        return self.aggregate_response(aggregate, partial)
+
+    def handle_find(self, msg: str, body: bytes) -> tp.Tuple[str, bytes]:
+        """
+        FIND <path> BETWEEN <low> AND <high> [LIMIT n], answered with `OK <count>` and one [number, key]
+        JSON line per match in ascending order. As for an aggregate COMPUTE the body may hold
+        the ring hash ranges of the keys to answer for
+        """
+        try:
+            path, low, high, limit = parse_find(msg)
+            keep = None
+            if body:
+                ranges = HashRanges(json.loads(body.decode(self.format))['ranges'])
+                keep = lambda key: ring_hash(key) in ranges
+            found = self.kv_server.find_request(path, low, high, limit, keep)
+
+        except ValueError as error:
+            return f'ERROR {error}', b''
+
+        except Exception as error:
+            print("[Server Thread]:", error)
+            return 'ERROR', b''
+
+        return f'OK {len(found)}', encode_entries(found)
+
+    def aggregate_response(self, aggregate: str, partial: tp.Dict[str, tp.Any]) -> tp.Tuple[str, bytes]:
+        """
+        Answer the value of the aggregate over the keys of this server,
+        with the partial aggregate the client merges with the other servers in the body
+        """
+        value = finish(aggregate, partial)
+        return ('NOT FOUND' if value is None else str(value)), json.dumps(partial).encode(self.format)
+
+    def handle_replication(self, msg: str, body: bytes) -> tp.Tuple[str, bytes]:
+        """
+        Answer the anti-entropy requests of a peer, their arguments and answers travel as JSON bodies:
+        `MERKLE <peer> <level>` hashes of tree nodes, `DIGEST <peer>` key versions of some buckets
+        and whole records of others, `FETCH` current records of keys and `SYNC` records to apply
+        """
+        kv_server = self.kv_server
+        if kv_server.merkle is None:
+            return 'ERROR the server was started without peers', b''
+
+        try:
+            command, *arguments = msg.split()
+            payload = json.loads(body)
+            command = command.lower()
+            if command == 'merkle':
+                peer, level = arguments
+                result = kv_server.merkle_request(peer, int(level), payload)
+            elif command == 'digest':
+                versions = kv_server.digest_request(arguments[0], payload['versions'])
+                records = kv_server.bucket_records_request(arguments[0], payload['records'])
+                result = {'versions': versions, 'records': records}
+            elif command == 'fetch':
+                result = kv_server.fetch_request(payload)
+            elif command == 'sync':
+                result = kv_server.sync_request(payload)
+            else:
+                return 'ERROR', b''
+
+        except Exception as error:
+            print("[Server Thread]: Server-Error:", error)
+            return 'ERROR', b''
+
+        return 'OK', json.dumps(result).encode(self.format)
+
+    def handle_read(self, msg: str) -> tp.Tuple[str, bytes]:
+        """
+        Answer a GET, QUERY or VALUE with its response text and the version of the key as the frame body,
+        the body is empty when the key has no version.
+        VALUE answers with the stored value of the keypath as JSON instead of its display text,
+        so the variables of a COMPUTE evaluated elsewhere are bound exactly as on this server
+        """
+        kv_server = self.kv_server
+
+        if msg.lower().startswith('get'):
+            print("[Server Thread]: GET", msg)
+
+            try:
+                _, key = msg.split(' ', 1)
+                get_result, version = kv_server.get_versioned_request(key)
+
+            except (ValueError, TypeError) as error:
+                print("[Server Thread]: Server-Error:",  error)
+                return 'ERROR', b''
+
+            version_body = str(version).encode(self.format) if version else b''
+            if get_result is None:
+                return 'NOT FOUND', version_body
+
+            return f"“{key}” -> {get_result}", version_body
+
+        try:
+            _, keypath = msg.split(' ')
+            query_result, version = kv_server.query_versioned_request(keypath)
+
+        except Exception:
+            return 'EXCEPTION ERROR', b''
+
+        version_body = str(version).encode(self.format) if version else b''
+        if query_result is None:
+            return 'NOT FOUND', version_body
+
+        if msg.lower().startswith('value'):
+            return json.dumps(query_result), version_body
+
+        return f"“{keypath}” -> {query_result}", version_body
+
+    def handle_message(self, msg: str, body: bytes = b'') -> str:
+        """
+        Process one command received from a client and return the response to send back
+        """
+        kv_server = self.kv_server
+
+        # if the message starts with 'ping', send back a 'PONG' message
+        if msg.lower().startswith('ping'):
+            return 'PONG'
+
+        if msg.lower().startswith('put'):
+            try:
+                # the document travels in the frame body after `PUT [version]`,
+                # older clients inline it in the text
+                version = None
+                if body:
+                    data_str = body.decode(self.format)
+                    arguments = msg.split()
+                    if len(arguments) > 1:
+                        version = int(arguments[1])
+                else:
+                    _, data_str = msg.split(' ', 1)
+
+                data_to_put = json.loads(data_str)
+
+                for key, value in data_to_put.items():
+                    kv_server.put_request(key, value, version)
+                return 'OK'
+
+            except json.JSONDecodeError:
+                return 'ERROR'
+
+            except Exception as error:
+                print("[Server Thread]:", error)
+                return 'ERROR'
+
+        elif msg.lower().startswith('mput'):
+            # `MPUT [version]`, the body holds one JSON document per line,
+            # the whole batch is parsed before anything is stored
+            try:
+                arguments = msg.split()
+                version = int(arguments[1]) if len(arguments) > 1 else None
+                items = [
+                    item
+                    for line in body.decode(self.format).splitlines() if line
+                    for item in json.loads(line).items()
+                ]
+                kv_server.put_many_request(items, version)
+                return f'OK {len(items)}'
+
+            except Exception as error:
+                print("[Server Thread]:", error)
+                return 'ERROR'
+
+        elif msg.lower().startswith(('get', 'query')):
+            response, _ = self.handle_read(msg)
+            return response
+
+        elif msg.lower().startswith('delete'):
+            # DELETE key [version]
+            try:
+                _, key, *version = msg.split(' ')
+                kv_server.delete_request(key, int(version[0]) if version else None)
+
+            except:
+                return 'ERROR'
+
+            return 'OK'
+
+        elif msg.lower().startswith('stats'):
+            stats = kv_server.stats_request()
+            stats['hints'] = len(self.hints)
+            if self.compute_pool is not None:
+                stats.update(self.compute_pool.stats())
+            return json.dumps(stats)
+
+        elif msg.lower().startswith('compute'):
+            
+            try:
+                computed_result = kv_server.compute_request(msg, self.evaluator())
+
+            except ComputeBusy:
+                return 'BUSY'
+
+            except Exception:
+                return 'EXCEPTION ERROR!'
+
+            if computed_result is None:
+                return 'NOT FOUND'
+
+            return str(computed_result)
+
+        elif msg.lower().startswith('hint'):
+            # HINT <ip:port>, the body holds one JSON record per line for a server that is down
+            try:
+                _, target = msg.split()
+                records = parse_records(body)
+                self.hints.add(target, records)
+                return f'OK {len(records)}'
+
+            except Exception as error:
+                print("[Server Thread]:", error)
+                return 'ERROR'
+
+        elif msg.lower().startswith('migrate'):
+            # MIGRATE ADD|REMOVE <ip:port>, MIGRATE STATUS or MIGRATE FINISH
+            if kv_server.merkle is None:
+                return 'ERROR the server was started without peers'
+            try:
+                return self.handle_migration(msg.split()[1:])
+
+            except Exception as error:
+                print("[Server Thread]:", error)
+                return f'ERROR {error}'
+
+        elif msg.lower().startswith('repair'):
+            # REPAIR [peer], an anti-entropy round with one peer or with all of them
+            if kv_server.merkle is None:
+                return 'ERROR the server was started without peers'
+            peers = msg.split()[1:] or sorted(kv_server.merkle.trees)
+            return json.dumps(self.repair_peers(peers))
+
+        elif msg.lower().startswith('load'):
+            # LOAD <path>, a key file sorted by key on the server's own disk
+            try:
+                _, path = msg.split(' ', 1)
+                # every worker of a sharded server keeps only its own keys of the file
+                loaded = kv_server.load_request(path.strip(), self.shard.owns if self.shard is not None else None)
+                return f'OK {loaded}'
+
+            except Exception as error:
+                print("[Server Thread]:", error)
+                return f'ERROR {error}'
+
+        return 'ERROR'
+
+    def evaluator(self) -> tp.Optional[tp.Callable[..., tp.Any]]:
+        """
+        Return what evaluates a bound COMPUTE formula, the process pool if the server has one
+        """
+        return self.compute_pool.evaluate if self.compute_pool is not None else None
+
+    def handle_migration(self, arguments: tp.List[str]) -> str:
+        """
+        Start, report or finish the key moves of a membership change
+        """
+        action = arguments[0].lower()
+        if action in ('add', 'remove'):
+            if self.migration is not None and self.migration.state in ('moving', 'cleaning'):
+                raise ValueError('Another membership change is still running')
+            _, node = arguments
+            self.migration = Migration(self.kv_server, action, node, self.migration_rate)
+            self.migration.thread.start()
+            return 'OK'
+
+        if self.migration is None:
+            raise ValueError('No membership change was started')
+        if action == 'status':
+            return json.dumps(self.migration.status())
+        if action == 'finish':
+            self.migration.finish()
+            return 'OK'
+        raise ValueError(f'Unknown MIGRATE action {action}')
+
+    def parse_scan(self, msg: str) -> tp.Tuple[str, tp.Optional[int], tp.Optional[str]]:
+        """
+        Parse `SCAN [prefix] [LIMIT n] [AFTER key]` into its prefix, limit and cursor
+        """
+        tokens = msg.split()[1:]
+        prefix = ''
+        limit = None
+        start_after = None
+        if tokens and tokens[0].upper() not in ('LIMIT', 'AFTER'):
+            prefix = tokens.pop(0)
+        while tokens:
+            option = tokens.pop(0).upper()
+            if option == 'LIMIT':
+                limit = int(tokens.pop(0))
+            elif option == 'AFTER':
+                start_after = tokens.pop(0)
+            else:
+                raise ValueError(f'Unknown SCAN option {option}')
+        return prefix, limit, start_after
+
+    def handle_scan(self, msg: str, local: bool = False) -> tp.Iterator[tp.Tuple[str, bytes]]:
+        """
+        Stream the result of a SCAN as CHUNK frames of at most scan_chunk_size pairs,
+        one JSON [key, value] pair per body line, followed by one END frame.
+        The END body holds the cursor for the next page when LIMIT stopped the scan early
+        and is empty once the prefix is exhausted
+        """
+        try:
+            prefix, limit, cursor = self.parse_scan(msg)
+        except (ValueError, IndexError) as error:
+            print("[Server Thread]: Server-Error:", error)
+            yield 'ERROR', b''
+            return
+
+        if self.shard is not None and not local:
+            # every worker scans its own keys, the key ordered streams are merged here
+            streams = [self.handle_scan(msg, local=True)]
+            streams += [self.shard.stream(other, msg) for other in self.shard.others()]
+            try:
+                yield from merge_scans(streams, limit, self.scan_chunk_size)
+            except OSError as error:
+                print("[Server Thread]: Forwarding failed:", error)
+                yield 'ERROR a worker of the server is down', b''
+            return
+
+        remaining = limit
+        while True:
+            size = self.scan_chunk_size if remaining is None else min(self.scan_chunk_size, remaining)
+            items = self.kv_server.scan_request(prefix, size, cursor)
+            if items:
+                cursor = items[-1][0]
+                yield 'CHUNK', '\n'.join(json.dumps(item) for item in items).encode(self.format)
+            if len(items) < size:
+                yield 'END', b''
+                return
+            if remaining is not None:
+                remaining -= len(items)
+                if not remaining:
+                    yield 'END', cursor.encode(self.format)
+                    return
+
+    def compact_forever(self) -> None:
+        """
+        Unlink expired tombstones in small batches so writers never wait long for the lock
+        """
+        batch = 1000
+        while True:
+            time.sleep(self.compaction_interval)
+            while self.kv_server.compact_request(batch) == batch:
+                pass
+
+    def snapshot_forever(self) -> None:
+        """
+        Snapshot the store every snapshot_interval seconds so recovery only replays a short WAL tail
+        """
+        while True:
+            time.sleep(self.snapshot_interval)
+            try:
+                self.kv_server.snapshot_request()
+            except OSError as error:
+                print("[Server]: Snapshot failed:", error)
+
+    def repair_peers(self, peers: tp.List[str]) -> tp.Dict[str, tp.Any]:
+        """
+        Run one repair with every peer in turn
+        :return: the repair counters of every peer, or the error that stopped its repair
+        """
+        results: tp.Dict[str, tp.Any] = {}
+        for peer in peers:
+            try:
+                stats = repair_with(self.kv_server, peer)
+            except (OSError, ProtocolError, ValueError) as error:
+                print(f"[Server]: Repair with {peer} failed:", error)
+                results[peer] = str(error)
+                continue
+            if stats['buckets']:
+                print(
+                    f"[Server]: Repaired {stats['buckets']} buckets with {peer}, "
+                    f"{stats['pushed']} records sent and {stats['pulled']} received"
+                )
+            results[peer] = stats
+        return results
+
+    def anti_entropy_forever(self) -> None:
+        """
+        Repair the keys shared with every peer every anti_entropy_interval seconds.
+        One repair brings both sides up to date, so a server only starts the repairs
+        with the peers whose name sorts after its own
+        """
+        merkle = self.kv_server.merkle
+        while True:
+            time.sleep(self.anti_entropy_interval)
+            self.repair_peers([peer for peer in sorted(merkle.trees) if peer > merkle.name])
+
+    def hand_off(self, target: str) -> None:
+        """
+        Send the hints of a server that is back to it and forget them once it stored them
+        """
+        records = self.hints.pending(target)
+        if not records:
+            return
+        try:
+            deliver(target, records)
+        except (OSError, ProtocolError) as error:
+            print(f"[Server]: Handoff to {target} failed:", error)
+            return
+        self.hints.remove(target, len(records))
+        print(f'[Server]: Handed {len(records)} hints off to {target}')
+
+    def reroute_hints(self, target: str) -> None:
+        """
+        Send the hints of a server that left the ring to the current owners of their keys
+        """
+        records = self.hints.pending(target)
+        if not records:
+            return
+        merkle = self.kv_server.merkle
+        by_owner: tp.Dict[str, tp.List[tp.Any]] = {}
+        for record in records:
+            for owner in merkle.ring.owners(record[1], merkle.k):
+                by_owner.setdefault(owner, []).append(record)
+
+        for owner, owner_records in by_owner.items():
+            if owner == merkle.name:
+                self.kv_server.write(owner_records)
+                continue
+            try:
+                deliver(owner, owner_records)
+            except (OSError, ProtocolError):
+                self.hints.add(owner, owner_records)
+        self.hints.remove(target, len(records))
+
+    def forget_peer(self, peer: str) -> None:
+        """
+        Re-replicate after a permanent loss: take the peer off the ring, so each key it owned
+        gets the next server on the ring as its new owner, and repair with every peer left,
+        which copies those keys from the replicas that survived to their new owners
+        """
+        print(f'[Server]: {peer} is down for more than {self.dead_after:.0f}s, taking it off the ring')
+        self.kv_server.forget_request(peer)
+        self.reroute_hints(peer)
+        self.repair_peers(sorted(self.kv_server.merkle.trees))
+
+    def handoff_forever(self) -> None:
+        """
+        Every handoff_interval seconds hand the hints of every server that is back to it.
+        With peers the servers of the ring are watched as well, and one that stays down
+        for dead_after seconds is forgotten
+        """
+        down_since: tp.Dict[str, float] = {}
+        while True:
+            time.sleep(self.handoff_interval)
+            merkle = self.kv_server.merkle
+            targets = set(self.hints.targets())
+            if merkle is not None:
+                targets |= set(merkle.trees)
 
-                if query_result is None:
-                    conn.send('NOT FOUND'.encode(self.format))
+            for target in sorted(targets):
+                if merkle is not None and target not in merkle.ring:
+                    self.reroute_hints(target) # hinted by a client that still had the old ring
                     continue
-                
-                if isinstance(query_result, str):
-                    conn.send(f'“{keypath}” -> {query_result}'.encode(self.format))
+                if ping(target):
+                    down_since.pop(target, None)
+                    self.hand_off(target)
                     continue
-                
-                conn.send(f"“{keypath}” -> {query_result}".encode(self.format))
+                since = down_since.setdefault(target, time.monotonic())
+                if merkle is not None and self.dead_after and time.monotonic() - since >= self.dead_after:
+                    down_since.pop(target)
+                    self.forget_peer(target)
 
-            elif msg.lower().startswith('compute'):
-                
-                try:
-                    computed_result = kv_server.compute_request(msg)
-                    
+    def start_background_threads(self) -> None:
+        self.compaction_thread.start()
+        if self.kv_server.wal is not None:
+            self.snapshot_thread.start()
+        if self.kv_server.merkle is not None and self.anti_entropy_interval:
+            self.anti_entropy_thread.start()
+        self.handoff_thread.start()
+        if self.shard is not None:
+            self.internal_thread.start()
 
-                except Exception:
-                    conn.send(('EXCEPTION ERROR!').encode(self.format))
-                    continue
+    def serve_internal(self) -> None:
+        """
+        Accept the connections of the other workers, their commands only touch the keys of this worker
+        """
+        while True:
+            conn, addr = self.shard.internal_socket.accept()
+            running = threading.Event()
+            running.set()
+            threading.Thread(target=self.handle_client, args=(conn, addr, running, True), daemon=True).start()
 
-                if computed_result is None:
-                    conn.send('NOT FOUND'.encode())
-                    continue
+    def handle_client(self, conn: socket.socket, addr: tp.Tuple[tp.Any, ...], running, local: bool = False):
+        """
+        Handle a client connection by processing messages and performing appropriate actions,
+        local connections come from the other workers of a sharded server
+        """
 
-                conn.send(str(computed_result).encode(self.format))
+        # Print a message indicating that a new connection has been established
+        print(f'[Server Thread]: New connection {addr} connected')
+        connection = FramedConnection(conn)
+        # Enter a loop that continues as long as the client is connected and the server is running
+        while running.is_set():
+            # Receive a whole frame from the client
+            try:
+                frame = connection.recv()
+            except (ProtocolError, OSError) as error:
+                print("[Server Thread]:", error)
+                break
+
+            # the client closed the connection
+            if frame is None:
+                break
+
+            msg, body = frame
+
+            if msg.lower().startswith('exit'):
+                connection.send('OK')
+                break
+
+            if msg.lower().startswith('scan'):
+                for text, chunk in self.handle_scan(msg, local):
+                    connection.send(text, chunk)
+                continue
+
+            connection.send_frame(self.respond_encoded(msg, body, local))
 
         print("[Server Thread]: Client disconnected!")
-        conn.close()
+        connection.close()
+
+    async def handle_client_async(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter
+    ) -> None:
+        """
+        Serve one client connection from the event loop.
+        Cheap commands run inline, COMPUTE, LOAD and the writes of a durable store run on the bounded executor
+        """
+        addr = writer.get_extra_info('peername')
+        print(f'[Server Loop]: New connection {addr} connected')
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                frame = await read_frame(reader)
+
+                # the client closed the connection
+                if frame is None:
+                    break
+
+                msg, body = frame
+
+                if msg.lower().startswith('exit'):
+                    writer.write(encode_frame('OK'))
+                    await writer.drain()
+                    break
+
+                if msg.lower().startswith('scan'):
+                    # yield to other connections between chunks,
+                    # a sharded scan waits for the other workers on the executor
+                    frames = self.handle_scan(msg)
+                    while True:
+                        if self.shard is not None:
+                            frame = await loop.run_in_executor(self.executor, next, frames, None)
+                        else:
+                            frame = next(frames, None)
+                        if frame is None:
+                            break
+                        writer.write(encode_frame(*frame))
+                        await writer.drain()
+                    continue
+
+                # commands a sharded server may forward to another worker wait on the executor as well,
+                # and so do writes waiting for the WAL fsync, which can join the same group commit there
+                blocking = ('compute', 'load', 'repair', 'migrate finish')
+                if self.kv_server.wal is not None:
+                    blocking += ('put', 'mput', 'delete', 'sync', 'hint', 'migrate')
+                if self.shard is not None or msg.lower().startswith(blocking):
+                    response = await loop.run_in_executor(
+                        self.executor, self.respond_encoded, msg, body
+                    )
+                else:
+                    response = self.respond_encoded(msg, body)
+
+                writer.write(response)
+                await writer.drain()
+
+        except (ProtocolError, OSError) as error:
+            print("[Server Loop]:", error)
+
+        finally:
+            print("[Server Loop]: Client disconnected!")
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
 
     def start(self):
         """
         Start the server and listen for client connections
         """
         self.server_socket.listen()
+        self.start_background_threads()
 
         # enter an infinite loop to listen for client connections
         try:
@@ -156,6 +907,11 @@ class Server:
                     args=(conn, addr, running)
                 )
 
+                # forget the threads of clients that already disconnected
+                self.threads = [
+                    client_thread for client_thread in self.threads
+                    if client_thread.is_alive()
+                ]
                 # append the thread to the list of threads
                 self.threads.append(thread)
                 # start the thread
@@ -170,6 +926,41 @@ class Server:
             self.server_socket.close()
             for thread in self.threads:
                 thread.join(timeout=2)
+            if self.shard is not None:
+                self.shard.close()
+            if self.compute_pool is not None:
+                self.compute_pool.close()
+            self.kv_server.close()
+
+    async def serve_async(self) -> None:
+        """
+        Multiplex every client connection on one asyncio event loop
+        """
+        self.server_socket.setblocking(False)
+        server = await asyncio.start_server(self.handle_client_async, sock=self.server_socket)
+        async with server:
+            await server.serve_forever()
+
+    def start_async(self):
+        """
+        Start the server in event loop mode
+        """
+        self.start_background_threads()
+        try:
+            asyncio.run(self.serve_async())
+
+        # if the server is stopped by the user using Ctrl+C
+        except KeyboardInterrupt:
+            print("[Server]: Stopped by Ctrl+C")
+
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.server_socket.close()
+            if self.shard is not None:
+                self.shard.close()
+            if self.compute_pool is not None:
+                self.compute_pool.close()
+            self.kv_server.close()
 
 def run_server_arguments():
     parser = argparse.ArgumentParser()
@@ -185,7 +976,146 @@ def run_server_arguments():
         type=str,
         required=True
     )
+    parser.add_argument(
+        '-m',
+        help='Server engine: a thread per connection or one asyncio event loop',
+        choices=['threaded', 'async'],
+        default='threaded'
+    )
+    parser.add_argument(
+        '--executor-workers',
+        help='Threads available to CPU heavy commands in async mode',
+        type=int_type,
+        default=4
+    )
+    parser.add_argument(
+        '-e',
+        help='Trie engine that stores the data',
+        choices=sorted(ENGINES),
+        default='trie'
+    )
+    parser.add_argument(
+        '--tombstone-ttl',
+        help='Seconds a deleted key is kept as a tombstone before its nodes are unlinked',
+        type=int_type,
+        default=60
+    )
+    parser.add_argument(
+        '--compaction-interval',
+        help='Seconds between two background tombstone compaction passes',
+        type=int_type,
+        default=1
+    )
+    parser.add_argument(
+        '--data-dir',
+        help='Directory for the write-ahead log and snapshots, the store is in-memory only without it',
+        type=str,
+        default=None
+    )
+    parser.add_argument(
+        '--snapshot-interval',
+        help='Seconds between two snapshots of the store',
+        type=int_type,
+        default=300
+    )
+    parser.add_argument(
+        '--commit-delay',
+        help='Milliseconds the WAL waits before an fsync so more writes share it',
+        type=int_type,
+        default=0
+    )
+    parser.add_argument(
+        '--snapshot-format',
+        help='jsonl snapshots are loaded into memory on startup, mmap snapshots are served from a memory-mapped file',
+        choices=['jsonl', 'mmap'],
+        default='jsonl'
+    )
+    parser.add_argument(
+        '--peers',
+        help='Server file of the cluster, the same as the client uses, enables anti-entropy repair between its servers',
+        type=str,
+        default=None
+    )
+    parser.add_argument(
+        '-k',
+        help='Replication factor the client writes with, needed with --peers',
+        type=int_type,
+        default=1
+    )
+    parser.add_argument(
+        '--virtual-nodes',
+        help='Positions of every server on the consistent hash ring, the same as the client uses',
+        type=int_type,
+        default=128
+    )
+    parser.add_argument(
+        '--anti-entropy-interval',
+        help='Seconds between two repairs with the peers, 0 only repairs on REPAIR',
+        type=int_type,
+        default=60
+    )
+    parser.add_argument(
+        '--handoff-interval',
+        help='Seconds between two attempts to hand the hints of servers that were down back to them',
+        type=int_type,
+        default=5
+    )
+    parser.add_argument(
+        '--dead-after',
+        help='Seconds a peer is down before it is taken off the ring and its keys are re-replicated, 0 never',
+        type=int_type,
+        default=600
+    )
+    parser.add_argument(
+        '--migration-rate',
+        help='Kilobytes per second a server sends to new owners while servers are added or removed',
+        type=int_type,
+        default=10240
+    )
+    parser.add_argument(
+        '--keypath-index',
+        help='Key prefixes whose keypaths are indexed so QUERY is one lookup, * for every key',
+        type=str,
+        nargs='+',
+        default=None
+    )
+    parser.add_argument(
+        '--field-index',
+        help='Nested field paths, e.g. person.age, whose numbers are kept in sorted indexes for FIND',
+        type=str,
+        nargs='+',
+        default=None
+    )
+    parser.add_argument(
+        '--cache-bytes',
+        help='Memory budget in bytes of the cache of GET and QUERY responses, 0 disables it',
+        type=int_type,
+        default=0
+    )
+    parser.add_argument(
+        '--compute-processes',
+        help='Processes that evaluate COMPUTE formulas sent to the server, 0 evaluates them on the connection thread. '
+             'The bundled client evaluates COMPUTE itself, only clients speaking the protocol directly use them',
+        type=int_type,
+        default=0
+    )
+    parser.add_argument(
+        '--compute-queue',
+        help='COMPUTE formulas that may wait for a compute process, more are answered with BUSY',
+        type=int_type,
+        default=16
+    )
+    parser.add_argument(
+        '-w',
+        help='Worker processes, each one owns the keys that hash to it and they share the port',
+        type=int_type,
+        default=1
+    )
     args = parser.parse_args()
+    if args.w < 1:
+        parser.error('-w needs at least one worker')
+    if args.w > 1 and args.peers:
+        parser.error('-w can not be combined with --peers, run one server per core instead')
     return args
 
 
@@ -196,10 +1126,96 @@ def int_type(arg):
     return int(arg)
 
 
+def build_server(args, shard: tp.Optional[Shard] = None, data_dir: tp.Optional[str] = None) -> Server:
+    return Server(
+        args.p,
+        args.a,
+        executor_workers=args.executor_workers,
+        engine=args.e,
+        tombstone_retention=args.tombstone_ttl,
+        compaction_interval=args.compaction_interval,
+        data_dir=data_dir,
+        snapshot_interval=args.snapshot_interval,
+        commit_delay=args.commit_delay / 1000,
+        snapshot_format=args.snapshot_format,
+        peers_path=args.peers,
+        replication=args.k,
+        virtual_nodes=args.virtual_nodes,
+        anti_entropy_interval=args.anti_entropy_interval,
+        handoff_interval=args.handoff_interval,
+        dead_after=args.dead_after,
+        migration_rate=args.migration_rate * 1024,
+        shard=shard,
+        compute_processes=args.compute_processes,
+        compute_queue=args.compute_queue,
+        keypath_prefixes=args.keypath_index,
+        field_indexes=args.field_index,
+        # the workers of a sharded server share the cache budget
+        cache_bytes=args.cache_bytes // (len(shard) if shard is not None else 1)
+    )
+
+
+def run(server: Server, mode: str) -> None:
+    if mode == 'async':
+        server.start_async()
+    else:
+        server.start()
+
+
+def run_worker(args, index: int, addresses: tp.List[tp.Tuple[str, int]], internal_socket: socket.socket) -> None:
+    """
+    Serve one shard of the keys, with its own WAL and snapshots in a worker-<index> subdirectory
+    """
+    data_dir = os.path.join(args.data_dir, f'worker-{index}') if args.data_dir is not None else None
+    run(build_server(args, Shard(index, addresses, internal_socket), data_dir), args.m)
+
+
+def run_workers(args) -> None:
+    """
+    Start args.w worker processes on the same port, every one owning the keys that hash to it.
+    The internal sockets the workers forward commands on are bound before the fork,
+    so every worker knows where the others listen from the start
+    """
+    internal_sockets = []
+    for _ in range(args.w):
+        internal_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        internal_socket.bind(('127.0.0.1', 0))
+        internal_socket.listen()
+        internal_sockets.append(internal_socket)
+    addresses = [internal_socket.getsockname() for internal_socket in internal_sockets]
+
+    context = multiprocessing.get_context('fork')
+    workers = [
+        context.Process(target=run_worker, args=(args, index, addresses, internal_sockets[index]))
+        for index in range(args.w)
+    ]
+    # stopping the parent stops the workers as well
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    for worker in workers:
+        worker.start()
+    print(f'[Server]: Started {args.w} workers on {args.a}:{args.p}')
+    try:
+        for worker in workers:
+            worker.join()
+
+    except KeyboardInterrupt:
+        print("[Server]: Stopped by Ctrl+C")
+        for worker in workers:
+            worker.join(timeout=2) # the workers got the Ctrl+C as well
+
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+
 def main():
     args = run_server_arguments()
-    server = Server(args.p, args.a)
-    server.start()
+    if args.w > 1:
+        run_workers(args)
+    else:
+        run(build_server(args, data_dir=args.data_dir), args.m)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,197 @@
+import re
+import sys
+import json
+import math
+import heapq
+import bisect
+import typing as tp
+from aggregates import field
+
+# FIND <field path> BETWEEN <low> AND <high> [LIMIT n]
+FIND = re.compile(
+    r'find\s+(?P<path>\S+)\s+between\s+(?P<low>\S+)\s+and\s+(?P<high>\S+)(?:\s+limit\s+(?P<limit>\d+))?',
+    re.IGNORECASE
+)
+
+Entry = tp.Tuple[tp.Any, str] # (number, key)
+
+
+def parse_find(msg: str) -> tp.Tuple[str, float, float, tp.Optional[int]]:
+    """
+    Split a FIND command into its field path, its inclusive bounds and its limit
+    """
+    find_match = FIND.fullmatch(' '.join(msg.split()))
+    if not find_match:
+        raise ValueError('Invalid FIND, expected FIND <path> BETWEEN <low> AND <high> [LIMIT n]')
+    try:
+        low, high = float(find_match.group('low')), float(find_match.group('high'))
+    except ValueError:
+        raise ValueError('The bounds of FIND must be numbers')
+    limit = find_match.group('limit')
+    return find_match.group('path'), low, high, int(limit) if limit is not None else None
+
+
+class SortedIndex:
+    """
+    The (number, key) entries of one field in ascending order, split into chunks of a few hundred
+    entries like a B-tree with a single level. A range starts with a binary search over the last entry
+    of every chunk and one inside the chunk, then reads the entries in order, so it costs O(log n + k).
+    An insert or a removal only shifts the entries of one chunk
+    """
+    chunk_size = 512
+
+    def __init__(self) -> None:
+        self.chunks: tp.List[tp.List[Entry]] = []
+        self.maxes: tp.List[Entry] = [] # the last entry of every chunk
+        self.numbers: tp.Dict[str, tp.Any] = {} # key -> its indexed number
+
+    def __len__(self) -> int:
+        return len(self.numbers)
+
+    def add(self, key: str, number: tp.Any) -> None:
+        if key in self.numbers and self.numbers[key] == number:
+            return # the field did not change
+        self.remove(key)
+        self.numbers[key] = number
+        entry = (number, key)
+        if not self.chunks:
+            self.chunks.append([entry])
+            self.maxes.append(entry)
+            return
+
+        index = min(bisect.bisect_left(self.maxes, entry), len(self.chunks) - 1)
+        chunk = self.chunks[index]
+        bisect.insort(chunk, entry)
+        self.maxes[index] = chunk[-1]
+        if len(chunk) > 2 * self.chunk_size:
+            # split a full chunk in two halves
+            half = chunk[self.chunk_size:]
+            del chunk[self.chunk_size:]
+            self.chunks.insert(index + 1, half)
+            self.maxes[index] = chunk[-1]
+            self.maxes.insert(index + 1, half[-1])
+
+    def remove(self, key: str) -> None:
+        if key not in self.numbers:
+            return
+        entry = (self.numbers.pop(key), key)
+        index = bisect.bisect_left(self.maxes, entry)
+        chunk = self.chunks[index]
+        del chunk[bisect.bisect_left(chunk, entry)]
+        if chunk:
+            self.maxes[index] = chunk[-1]
+        else:
+            del self.chunks[index]
+            del self.maxes[index]
+
+    def range(self, low: float, high: float) -> tp.Iterator[Entry]:
+        """
+        Yield the entries with low <= number <= high in ascending order
+        """
+        # (low,) sorts before every entry whose number is low
+        index = bisect.bisect_left(self.maxes, (low,))
+        if index == len(self.chunks):
+            return
+        position = bisect.bisect_left(self.chunks[index], (low,))
+        for chunk in self.chunks[index:]:
+            for entry in chunk[position:]:
+                if entry[0] > high:
+                    return
+                yield entry
+            position = 0
+
+    def memory(self) -> int:
+        """
+        Estimate the bytes held by the index besides the keys and numbers shared with the trie
+        """
+        return (
+            sys.getsizeof(self.chunks) + sys.getsizeof(self.maxes) + sys.getsizeof(self.numbers)
+            + sum(sys.getsizeof(chunk) for chunk in self.chunks)
+            + len(self.numbers) * sys.getsizeof((0, ''))
+        )
+
+
+class FieldIndexes:
+    """
+    Declared secondary indexes, one SortedIndex per nested field path such as `person.age`,
+    over the finite numbers found at that path in the values of the store.
+    They follow every record the store applies, a key is indexed again from the trie after each
+    """
+
+    def __init__(self, paths: tp.Iterable[str]) -> None:
+        self.indexes = {path: SortedIndex() for path in paths}
+        self.fields = {path: tuple(path.split('.')) for path in self.indexes}
+
+    def index(self, key: str, value: tp.Any) -> None:
+        for path, index in self.indexes.items():
+            number = field(value, self.fields[path])
+            if number is None or (isinstance(number, float) and not math.isfinite(number)):
+                index.remove(key)
+            else:
+                index.add(key, number)
+
+    def apply(self, record: tp.List[tp.Any], trie: tp.Any) -> None:
+        """
+        Follow one record the trie has just been given. A deleted key reads back as a message,
+        which has no fields, so it leaves every index
+        """
+        self.index(record[1], trie.get(record[1]))
+
+    def rebuild(self, items: tp.Iterable[tp.Sequence[tp.Any]]) -> None:
+        """
+        Index the (key, value) items of a whole store
+        """
+        self.indexes = {path: SortedIndex() for path in self.indexes}
+        for key, value, *_ in items:
+            self.index(key, value)
+
+    def find(
+        self,
+        path: str,
+        low: float,
+        high: float,
+        limit: tp.Optional[int] = None,
+        keep: tp.Optional[tp.Callable[[str], bool]] = None
+    ) -> tp.List[Entry]:
+        """
+        Return the (number, key) entries of the field between low and high, in ascending order,
+        at most limit of them and only those whose key keep accepts when it is given
+        """
+        if path not in self.indexes:
+            raise ValueError(f'No index on {path}')
+        found = []
+        for entry in self.indexes[path].range(low, high):
+            if keep is not None and not keep(entry[1]):
+                continue
+            if limit is not None and len(found) == limit:
+                break
+            found.append(entry)
+        return found
+
+    def stats(self) -> tp.Dict[str, int]:
+        return {
+            'field_index_entries': sum(len(index) for index in self.indexes.values()),
+            'field_index_bytes': sum(index.memory() for index in self.indexes.values()),
+        }
+
+
+def encode_entries(entries: tp.Iterable[Entry]) -> bytes:
+    return '\n'.join(json.dumps([number, key]) for number, key in entries).encode('utf-8')
+
+
+def merge_found(bodies: tp.Iterable[bytes], limit: tp.Optional[int]) -> tp.List[Entry]:
+    """
+    Merge the ascending FIND answers of several servers or workers, a key answered by several
+    of them is kept once
+    """
+    streams = [[tuple(json.loads(line)) for line in body.splitlines() if line] for body in bodies]
+    merged: tp.List[Entry] = []
+    seen = set()
+    for number, key in heapq.merge(*streams):
+        if key in seen:
+            continue
+        if limit is not None and len(merged) == limit:
+            break
+        seen.add(key)
+        merged.append((number, key))
+    return merged
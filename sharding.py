@@ -0,0 +1,209 @@
+import json
+import heapq
+import queue
+import socket
+import typing as tp
+from hash_ring import ring_hash
+from trie_structure import bind_formula
+from wire_protocol import Frame, FramedConnection
+
+
+def shard_of(key: str, count: int) -> int:
+    """
+    Return the worker that owns the key when a server runs count workers
+    """
+    return ring_hash(key) % count
+
+
+class Shard:
+    """
+    One worker process of a server started with several workers.
+    Every worker accepts client connections on the shared port and owns the keys that hash to it.
+    A command for a key of another worker is forwarded to that worker over its internal socket,
+    and commands that span every key (SCAN, STATS, COMPUTE, LOAD) are gathered from all of them
+    """
+
+    def __init__(self, index: int, addresses: tp.List[tp.Tuple[str, int]], internal_socket: socket.socket) -> None:
+        self.index = index
+        self.addresses = addresses # internal (host, port) of every worker
+        self.internal_socket = internal_socket
+        self.idle: tp.Dict[int, queue.SimpleQueue] = {shard: queue.SimpleQueue() for shard in range(len(addresses))}
+
+    def __len__(self) -> int:
+        return len(self.addresses)
+
+    def owner(self, key: str) -> int:
+        return shard_of(key, len(self.addresses))
+
+    def owns(self, key: str) -> bool:
+        return self.owner(key) == self.index
+
+    def others(self) -> tp.List[int]:
+        return [shard for shard in range(len(self.addresses)) if shard != self.index]
+
+    def acquire(self, shard: int) -> FramedConnection:
+        try:
+            return self.idle[shard].get_nowait()
+        except queue.Empty:
+            return FramedConnection(socket.create_connection(self.addresses[shard]))
+
+    def request(self, shard: int, text: str, body: bytes = b'') -> Frame:
+        """
+        Send one command to another worker on a pooled connection and return its response
+        """
+        connection = self.acquire(shard)
+        try:
+            connection.send(text, body)
+            frame = connection.recv()
+        except OSError:
+            connection.close()
+            raise
+        if frame is None:
+            connection.close()
+            raise OSError(f'Worker {shard} closed the connection')
+        self.idle[shard].put(connection)
+        return frame
+
+    def stream(self, shard: int, text: str) -> tp.Iterator[Frame]:
+        """
+        Send a SCAN to another worker and yield its frames up to and including the END frame
+        """
+        connection = self.acquire(shard)
+        try:
+            connection.send(text)
+            while True:
+                frame = connection.recv()
+                if frame is None:
+                    raise OSError(f'Worker {shard} closed the connection')
+                yield frame
+                if frame[0] != 'CHUNK':
+                    self.idle[shard].put(connection)
+                    return
+        except BaseException:
+            # a stream left half read can not go back to the pool
+            connection.close()
+            raise
+
+    def close(self) -> None:
+        for connections in self.idle.values():
+            while not connections.empty():
+                connections.get_nowait().close()
+
+
+def group_by_shard(shard: Shard, items: tp.Iterable[tp.Tuple[str, tp.Any]]) -> tp.Dict[int, tp.List[tp.Tuple[str, tp.Any]]]:
+    groups: tp.Dict[int, tp.List[tp.Tuple[str, tp.Any]]] = {}
+    for key, value in items:
+        groups.setdefault(shard.owner(key), []).append((key, value))
+    return groups
+
+
+def scatter_puts(
+    shard: Shard,
+    command: str,
+    items: tp.List[tp.Tuple[str, tp.Any]],
+    local: tp.Callable[[str, bytes], str]
+) -> tp.List[str]:
+    """
+    Split the pairs of a PUT or MPUT by worker, run the own part with local and forward the rest
+    :return: the response of every worker the pairs went to
+    """
+    responses = []
+    for owner, pairs in group_by_shard(shard, items).items():
+        body = b'\n'.join(json.dumps({key: value}).encode('utf-8') for key, value in pairs)
+        if owner == shard.index:
+            responses.append(local(command, body))
+        else:
+            responses.append(shard.request(owner, command, body)[0])
+    return responses
+
+
+def merge_stats(responses: tp.List[str]) -> tp.Dict[str, tp.Any]:
+    """
+    Add up the STATS counters of every worker, the largest value wins for WAL positions
+    """
+    merged: tp.Dict[str, tp.Any] = {}
+    for response in responses:
+        for name, value in json.loads(response).items():
+            if name.endswith('_sequence'):
+                merged[name] = max(merged.get(name, 0), value)
+            else:
+                merged[name] = merged.get(name, 0) + value
+    merged['workers'] = len(responses)
+    return merged
+
+
+def parse_value(response: str) -> tp.Any:
+    """
+    Turn the answer of a VALUE back into the stored value, None when the keypath has no value
+    """
+    if response == 'NOT FOUND' or response.startswith(('ERROR', 'EXCEPTION')):
+        return None
+    return json.loads(response)
+
+
+def gather_compute(
+    shard: Shard,
+    formula: str,
+    query: tp.Callable[[str], tp.Any],
+    evaluate: tp.Optional[tp.Callable[..., tp.Any]] = None
+) -> tp.Any:
+    """
+    Evaluate a COMPUTE whose variables may live on several workers, every keypath is queried
+    on the worker that owns its key: with query on this worker and over the internal socket on the others.
+    With evaluate the formula and its bindings are handed to it, as KVServer.compute_request does
+    """
+    def lookup(keypath: str) -> tp.Any:
+        key = keypath.split('.')[0]
+        if shard.owns(key):
+            return query(keypath)
+        return parse_value(shard.request(shard.owner(key), f'VALUE {keypath}')[0])
+
+    try:
+        compiled_expression, bindings = bind_formula(formula, lookup)
+    except ValueError as error:
+        return str(error)
+    if evaluate is not None:
+        return evaluate(formula, bindings)
+    return compiled_expression.evaluate(bindings)
+
+
+def merge_scans(streams: tp.List[tp.Iterator[Frame]], limit: tp.Optional[int], chunk_size: int) -> tp.Iterator[Frame]:
+    """
+    Merge the key ordered SCAN streams of every worker into CHUNK frames of at most chunk_size pairs
+    and one END frame, whose body holds the cursor of the next page when the limit stopped the merge
+    """
+    failed = []
+
+    def pairs(stream: tp.Iterator[Frame]) -> tp.Iterator[tp.Tuple[str, str]]:
+        for text, body in stream:
+            if text == 'CHUNK':
+                for line in body.splitlines():
+                    yield json.loads(line)[0], line.decode('utf-8')
+            elif text != 'END':
+                failed.append(text)
+
+    chunk: tp.List[str] = []
+    sent = 0
+    cursor = None
+    for key, line in heapq.merge(*(pairs(stream) for stream in streams), key=lambda pair: pair[0]):
+        if limit is not None and sent == limit:
+            if chunk:
+                yield 'CHUNK', '\n'.join(chunk).encode('utf-8')
+            yield 'END', cursor.encode('utf-8')
+            for stream in streams:
+                for _ in stream: # read every stream to its END so its connection goes back to the pool
+                    pass
+            return
+        chunk.append(line)
+        sent += 1
+        cursor = key
+        if len(chunk) == chunk_size:
+            yield 'CHUNK', '\n'.join(chunk).encode('utf-8')
+            chunk = []
+
+    if failed:
+        yield failed[0], b''
+        return
+    if chunk:
+        yield 'CHUNK', '\n'.join(chunk).encode('utf-8')
+    yield 'END', b''
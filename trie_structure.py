@@ -1,7 +1,104 @@
+import gc
 import re
+import sys
+import time
+import contextlib
 import numbers
+import functools
 import typing as tp
-from MathExpressionEvaluator import MathExpressionEvaluator
+from collections import deque
+from MathExpressionEvaluator import CompiledExpression, MathExpressionEvaluator
+
+OPERATORS = {'+':1, '-':1, '*':2, '/':2, '^':3}
+FUNCTIONS = {'sin':1, 'cos':1, 'tan':1, 'log':1, 'log10':1}
+LEFT_ASSOCIATIVE_OPERATORS = ['+', '-', '*', '/']
+
+# COMPUTE <expression> WHERE <variable> = QUERY <keypath> [AND <variable> = QUERY <keypath> ...]
+FORMULA = re.compile(r'compute\s+(?P<expression>.+?)\s+where\s+(?P<bindings>.+)', re.IGNORECASE)
+BINDING = re.compile(r'(?P<variable>\w+)\s*=\s*query\s+(?P<keypath>\S+)', re.IGNORECASE)
+BINDING_SEPARATOR = re.compile(r'\s+and\s+', re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_formula(formula: str) -> tp.Tuple[CompiledExpression, tp.Tuple[tp.Tuple[str, str], ...]]:
+    """
+    Parse a whitespace normalized COMPUTE formula into its compiled expression
+    and its (variable, keypath) bindings.
+    Formulas are cached, so a repeated COMPUTE only looks up and binds its variables
+    """
+    formula_match = FORMULA.fullmatch(formula)
+    if not formula_match:
+        raise ValueError("Invalid computation formula")
+
+    bindings = []
+    for binding in BINDING_SEPARATOR.split(formula_match.group('bindings')):
+        binding_match = BINDING.fullmatch(binding)
+        if not binding_match:
+            raise ValueError("Invalid value formula")
+        bindings.append((binding_match.group('variable'), binding_match.group('keypath')))
+
+    try:
+        compiled_expression = MathExpressionEvaluator().compile(
+            formula_match.group('expression'),
+            OPERATORS,
+            FUNCTIONS,
+            LEFT_ASSOCIATIVE_OPERATORS
+        )
+    except (ValueError, KeyError):
+        raise ValueError("Invalid computation formula")
+
+    return compiled_expression, tuple(bindings)
+
+
+def common_prefix_length(first: str, second: str) -> int:
+    """
+    Return the length of the longest common prefix of two strings
+    """
+    limit = min(len(first), len(second))
+    length = 0
+    while length < limit and first[length] == second[length]:
+        length += 1
+    return length
+
+
+def bind_formula(
+    formula: str,
+    query: tp.Callable[[str], tp.Any]
+) -> tp.Tuple[CompiledExpression, tp.Dict[str, numbers.Number]]:
+    """
+    Compile a COMPUTE formula and bind each of its variables to the number query returns for its keypath
+    """
+    compiled_expression, variable_keypaths = compile_formula(' '.join(formula.split()))
+
+    bindings = {}
+    for variable_name, variable_value_keypath in variable_keypaths:
+        variable_value = query(variable_value_keypath)
+        if not isinstance(variable_value, numbers.Number) or isinstance(variable_value, bool):
+            raise ValueError("Variable is not a number")
+        bindings[variable_name] = variable_value
+
+    missing = compiled_expression.variables - bindings.keys()
+    if missing:
+        raise ValueError(f"Variable {', '.join(sorted(missing))} has no value")
+
+    return compiled_expression, bindings
+
+
+@contextlib.contextmanager
+def gc_paused() -> tp.Iterator[None]:
+    """
+    Pause the cyclic garbage collector while millions of nodes are allocated.
+    Trie nodes never form reference cycles, so the collections it would trigger
+    on every few hundred allocations only rescan the growing trie
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
 
 class TrieNode:
     
@@ -10,35 +107,83 @@ class TrieNode:
         self.value = None # the value stored at this node (if any)
         self.is_leaf = False # a boolean attribute that indicates whether the currnet node is a leaf node in the trie or not
         self.is_deleted = False # a flag indicating whether the node has been deleted
-
-    def remove_if_unused(self) -> None:
-        # remove the node if it has no children and is marked as deleted
-        if self.is_deleted and not self.children:
-            del self
+        self.version = 0 # version of the last put or delete of the key, the newest version wins
 
 class Trie:
     
-    def __init__(self) -> None:
+    def __init__(self, tombstone_retention: float = 60.0) -> None:
         self.root = TrieNode() 
-        self.variables = {} 
-        self.operators = {'+':1, '-':1, '*':2, '/':2, '^':3}
-        self.functions = {'sin':1, 'cos':1, 'tan':1, 'log':1}
-        self.left_associative_operators = ['+', '-', '*', '/']
-        self.computed_value = None
-        self.operators_and_variables = []
-
-    def put(self, key: str, value:str) -> None:
+        # deleted keys stay as tombstones for tombstone_retention seconds,
+        # afterwards compact() unlinks their nodes. 0 unlinks them on delete
+        self.tombstone_retention = tombstone_retention
+        self.tombstones: tp.Deque[tp.Tuple[float, str]] = deque() # (deletion time, key) oldest first
+        self.deleted_at: tp.Dict[str, float] = {} # key -> time of its latest delete, the entry compaction acts on
+        self.node_count = 1 # nodes currently linked into the trie, including the root
+        self.key_count = 0 # live keys
+        self.bytes_reclaimed = 0 # estimated bytes freed by deletes and compaction
+        self.operators = OPERATORS
+        self.functions = FUNCTIONS
+        self.left_associative_operators = LEFT_ASSOCIATIVE_OPERATORS
+
+    def put(self, key: str, value:str, version: int = 0) -> None:
         current_root = self.root # start at the root of the trie
         # follow the path of the key in the trie, creating new nodes as needed
         for char in key:
             if char not in current_root.children:
                 current_root.children[char] = TrieNode()
+                self.node_count += 1
             current_root = current_root.children[char]
         
+        # a replica may receive writes out of order, an older version never overwrites a newer one
+        if current_root.is_leaf and version < current_root.version:
+            return
+        if not current_root.is_leaf or current_root.is_deleted:
+            self.key_count += 1
         current_root.is_leaf = True
+        current_root.is_deleted = False
         current_root.value = value #store the value at the final node
+        current_root.version = version
 
    
+    def load_sorted(self, items: tp.Iterable[tp.Sequence[tp.Any]]) -> int:
+        """
+        Build an empty trie bottom-up from (key, value) or (key, value, version) items in ascending key order.
+        The nodes of the previous key stay on a stack, so a key only creates the nodes
+        below its common prefix with the previous key instead of walking down from the root.
+        When a key repeats the last value wins
+        :return: the number of pairs loaded
+        """
+        if self.node_count != 1:
+            raise ValueError('Only an empty trie can be bulk loaded')
+
+        path = [self.root] # path[depth] is the node of the previous key at that depth
+        previous_key = ''
+        loaded = 0
+        with gc_paused():
+            for item in items:
+                key, value = item[0], item[1]
+                if key < previous_key:
+                    raise ValueError(f'Keys must be in ascending order, {key!r} came after {previous_key!r}')
+                common = common_prefix_length(previous_key, key)
+                del path[common + 1:]
+
+                current_root = path[-1]
+                for char in key[common:]:
+                    child = TrieNode()
+                    current_root.children[char] = child
+                    path.append(child)
+                    current_root = child
+                self.node_count += len(key) - common
+
+                if not current_root.is_leaf:
+                    self.key_count += 1
+                current_root.is_leaf = True
+                current_root.value = value
+                current_root.version = item[2] if len(item) > 2 else 0
+                previous_key = key
+                loaded += 1
+        return loaded
+
     def get(self, key: str) -> str:
         current_root = self.root
         for char in key:
@@ -57,21 +202,175 @@ class Trie:
         
 
 
-    def delete(self, key:str) -> str:
+    def delete(self, key:str, version: int = 0) -> None:
+        current_root = self.find_node(key)
+        if current_root is None or not current_root.is_leaf:
+            if version and self.tombstone_retention:
+                # a replica can get a versioned delete before the write it deletes, e.g. while the key
+                # is still being moved to it, the tombstone keeps that older write out when it comes
+                self.put(key, None, version)
+                self.key_count -= 1
+                current_root = self.find_node(key)
+                current_root.is_deleted = True
+                self.add_tombstone(key)
+            return # the key is not in the trie
+        if current_root.is_deleted:
+            return # the key is deleted already
+        if version < current_root.version:
+            return # the key was put again after this delete
+
+        self.key_count -= 1
+        if not self.tombstone_retention:
+            self.unlink(key)
+            return
+
+        # keep a tombstone without the value until compaction unlinks it
+        self.bytes_reclaimed += sys.getsizeof(current_root.value)
+        current_root.value = None
+        current_root.is_deleted = True
+        current_root.version = version
+        self.add_tombstone(key)
+
+    def add_tombstone(self, key: str) -> None:
+        """
+        Queue the tombstone of a key for compaction. A key deleted, put and deleted again has an entry
+        for every delete, only the one of its latest delete may unlink it
+        """
+        deleted_at = time.monotonic()
+        self.deleted_at[key] = deleted_at
+        self.tombstones.append((deleted_at, key))
+
+    def version(self, key: str) -> int:
+        """
+        Return the version of the last put or delete of the key, 0 when the trie has no trace of it
+        """
+        node = self.find_node(key)
+        if node is None or not node.is_leaf:
+            return 0
+        return node.version
+
+    def node_size(self, node: TrieNode) -> int:
+        """
+        Estimate the memory held by a node, without its value
+        """
+        return sys.getsizeof(node) + sys.getsizeof(node.__dict__) + sys.getsizeof(node.children)
+
+    def unlink(self, key: str) -> None:
+        """
+        Remove the key and every node on its path that no longer leads to another key
+        """
         current_root = self.root
-        path: tp.List[TrieNode] = []
+        path: tp.List[tp.Tuple[TrieNode, str]] = []
         for char in key:
             if char not in current_root.children:
                 return # the key is not in the trie
-            path.append(current_root)
+            path.append((current_root, char))
             current_root = current_root.children[char]
 
-        # mark the note at the end of the path as deleted
-        current_root.is_deleted = True
-        path.append(current_root)
-        # remove all nodes that are no longer being used
-        for node in path:
-            node.remove_if_unused()
+        self.bytes_reclaimed += sys.getsizeof(current_root.value)
+        current_root.value = None
+        current_root.is_leaf = False
+        current_root.is_deleted = False
+
+        # walk back towards the root and drop nodes that hold no key and have no children
+        for parent, char in reversed(path):
+            node = parent.children[char]
+            if node.is_leaf or node.children:
+                break
+            del parent.children[char]
+            self.node_count -= 1
+            self.bytes_reclaimed += self.node_size(node)
+
+    def compact(self, limit: int = 1000, unlinked: tp.Optional[tp.Callable[[str], None]] = None) -> int:
+        """
+        Unlink at most `limit` tombstones older than the retention period,
+        unlinked is called with every key that is unlinked when it is given
+        :return: the number of tombstones processed
+        """
+        processed = 0
+        expired = time.monotonic() - self.tombstone_retention
+        while self.tombstones and processed < limit and self.tombstones[0][0] <= expired:
+            deleted_at, key = self.tombstones.popleft()
+            processed += 1
+            if self.deleted_at.get(key) != deleted_at:
+                continue # the key was deleted again later, that tombstone keeps its full retention
+            del self.deleted_at[key]
+            node = self.find_node(key)
+            # the key may have been put again since it was deleted
+            if node is not None and node.is_leaf and node.is_deleted:
+                self.unlink(key)
+                if unlinked is not None:
+                    unlinked(key)
+        return processed
+
+    def find_node(self, key: str) -> tp.Optional[TrieNode]:
+        """
+        Return the node at which the key ends, or None if the path does not exist
+        """
+        current_root = self.root
+        for char in key:
+            if char not in current_root.children:
+                return None
+            current_root = current_root.children[char]
+        return current_root
+
+    def prefix_node(self, prefix: str) -> tp.Optional[tp.Tuple[str, TrieNode]]:
+        """
+        Return the node under which every key starting with the prefix lives, together with its path
+        """
+        node = self.find_node(prefix)
+        if node is None:
+            return None
+        return prefix, node
+
+    def child_edges(self, node: TrieNode) -> tp.Iterable[tp.Tuple[str, TrieNode]]:
+        """
+        Return the (edge label, child) pairs of a node
+        """
+        return node.children.items()
+
+    def scan(
+        self,
+        prefix: str = '',
+        limit: tp.Optional[int] = None,
+        start_after: tp.Optional[str] = None,
+        versions: bool = False
+    ) -> tp.Iterator[tp.Tuple[tp.Any, ...]]:
+        """
+        Lazily yield the live (key, value) pairs whose key starts with prefix, in key order,
+        or (key, value, version) triples with versions.
+        Keys up to and including start_after are skipped without visiting their subtrees,
+        so the last key of one page is the cursor of the next page
+        """
+        found = self.prefix_node(prefix)
+        if found is None or limit == 0:
+            return
+
+        count = 0
+        stack = [found]
+        while stack:
+            path, node = stack.pop()
+            if node.is_leaf and not node.is_deleted and (start_after is None or path > start_after):
+                yield (path, node.value, node.version) if versions else (path, node.value)
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+
+            # push the children in reverse order so the smallest label is visited first
+            for label, child in sorted(self.child_edges(node), key=lambda edge: edge[0], reverse=True):
+                child_path = path + label
+                # every key below this child sorts before the cursor
+                if start_after is not None and child_path < start_after[:len(child_path)]:
+                    continue
+                stack.append((child_path, child))
+
+    def stats(self) -> tp.Dict[str, int]:
+        return {
+            'keys': self.key_count,
+            'nodes': self.node_count,
+            'tombstones': len(self.tombstones),
+            'bytes_reclaimed': self.bytes_reclaimed,
+        }
 
     def query(self, keypath: str) -> str:
         # split the keypath into individual keys
@@ -80,18 +379,14 @@ class Trie:
         high_level_key = keys[0]
         value_of_high_level_key = self.get(high_level_key)
 
-        keypath_value = self.computed_value
+        keypath_value = None
 
-        def search_dictionary( dic: dict, keys: list):
+        def search_dictionary(dic: dict, keys: list):
+            # walk down one nested dict per subkey, a value that is not a dict has no subkeys
             for key in keys[1:]:
-                if key in dic:
-                    dic = dic[key]
-                else:
+                if not isinstance(dic, dict) or key not in dic:
                     return None
-
-            if isinstance(dic, dict):
-                search_dictionary(dic, keys)
-            
+                dic = dic[key]
             return dic
 
         if isinstance(value_of_high_level_key, dict):
@@ -99,74 +394,19 @@ class Trie:
             
         return keypath_value
 
-    def compute(self, formula):
-        # Extract the formula and keypath
-        computation, variable_keypath = formula.split("where")
-
-        computation_formula = re.search(r"compute (.*)", computation)
-        if not computation_formula:
-            return "Invalid computation formula"
-        
-        variables = self.variables
-        if "and" in variable_keypath:
-            variable_values = variable_keypath.split("and")
-            for variable_value in variable_values:
-
-                match_value_formula = re.search(r"(\w+) = query (.*)", variable_value)          
-                if not match_value_formula:
-                    return "Invalid value formula"
-
-                variable_name = match_value_formula.group(1).strip()
-                variable_value_keypath = match_value_formula.group(2).strip()
-                variable_value = self.query(variable_value_keypath)
-                
-                if isinstance(variable_value, numbers.Number):
-                    variables[variable_name] = variable_value
-
-        else:
-            match_value_formula = re.search(r"(\w+) = query (.*)", variable_keypath)          
-            if not match_value_formula:
-                return "Invalid value formula"
-            
-            variable_name = match_value_formula.group(1).strip()
-            variable_value_keypath = match_value_formula.group(2).strip()
-            variable_value = self.query(variable_value_keypath)
-
-            if isinstance(variable_value, numbers.Number):
-                variables[variable_name] = variable_value
-            else:
-                return "Variable is not a number"  
+    def bind(self, formula: str) -> tp.Tuple[CompiledExpression, tp.Dict[str, numbers.Number]]:
+        """
+        Resolve a COMPUTE formula into its shared compiled expression and a binding
+        of its variables that belongs to this request only.
+        Nothing is stored on the trie, so any number of threads can bind at the same time
+        and the pair can be evaluated anywhere, including another process
+        """
+        return bind_formula(formula, self.query)
 
-        operators = self.operators
-        functions = self.functions
-        left_associative_operators = self.left_associative_operators
-        expression_evaluator = MathExpressionEvaluator()
-        operators_functions_and_variables = self.operators_and_variables
-
-        # Replace the variables with their values in the formula
-        for variable, value in variables.items():
-            computation = computation.replace(variable, str(value))
-
-        variables = re.findall("(\d+(?:\.\d+)?)", computation)
-        operators_functions_and_variables.extend(variables)
-
-        operators_and_functions = re.findall("[+-/*^()]|sin|cos|tan|log10", computation)
-        operators_functions_and_variables.extend(operators_and_functions)
-
-        dot = "."
-        if dot in operators_functions_and_variables:
-            operators_functions_and_variables.remove(dot)
+    def compute(self, formula):
+        try:
+            compiled_expression, bindings = self.bind(formula)
+        except ValueError as error:
+            return str(error)
 
-        evaluated_expression = expression_evaluator.evaluate_expression(
-            operators_functions_and_variables, 
-            operators, 
-            functions, 
-            left_associative_operators
-        )
-        computed_result = expression_evaluator.compute_expression(
-            evaluated_expression, 
-            operators, 
-            functions
-        )
-        
-        return(computed_result)
+        return compiled_expression.evaluate(bindings)
@@ -0,0 +1,175 @@
+import socket
+import asyncio
+import struct
+import typing as tp
+
+# Every message is a frame: an 8 byte header holding the length of the utf-8 command text
+# and the length of an optional binary body, followed by the text and then the body
+HEADER = struct.Struct('!II')
+# Refuse frames larger than this instead of buffering them forever
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+# Size of the buffer every connection reuses for its reads
+RECV_CHUNK_SIZE = 64 * 1024
+
+Frame = tp.Tuple[str, bytes]
+
+
+class ProtocolError(Exception):
+    """
+    Raised when the peer sends bytes that are not a valid frame
+    """
+
+
+def encode_frame(text: str, body: bytes = b'') -> bytes:
+    """
+    Encode a command text and an optional binary body into one frame
+    """
+    encoded_text = text.encode('utf-8')
+    if len(encoded_text) + len(body) > MAX_FRAME_SIZE:
+        raise ProtocolError(f'Frame of {len(encoded_text) + len(body)} bytes is too large')
+    return HEADER.pack(len(encoded_text), len(body)) + encoded_text + body
+
+
+class FrameDecoder:
+    """
+    Streaming decoder that turns an arbitrary sequence of received chunks back into frames.
+    A frame split over several reads is buffered until it is complete
+    and several frames that arrive in one read are returned one by one.
+    """
+
+    def __init__(self, chunk_size: int = RECV_CHUNK_SIZE) -> None:
+        self.buffer = bytearray() # bytes received but not yet returned as a frame
+        self.chunk = bytearray(chunk_size) # reused for every read of the connection
+        self.chunk_view = memoryview(self.chunk)
+
+    def feed(self, data: tp.Union[bytes, bytearray, memoryview]) -> None:
+        self.buffer += data
+
+    def next_frame(self) -> tp.Optional[Frame]:
+        """
+        Return the next complete frame or None if more bytes are needed
+        """
+        if len(self.buffer) < HEADER.size:
+            return None
+
+        text_length, body_length = HEADER.unpack_from(self.buffer)
+        if text_length + body_length > MAX_FRAME_SIZE:
+            raise ProtocolError(f'Frame of {text_length + body_length} bytes is too large')
+
+        frame_end = HEADER.size + text_length + body_length
+        if len(self.buffer) < frame_end:
+            return None
+
+        text_end = HEADER.size + text_length
+        text = self.buffer[HEADER.size:text_end].decode('utf-8')
+        body = bytes(self.buffer[text_end:frame_end])
+        del self.buffer[:frame_end]
+        return text, body
+
+    def __iter__(self) -> tp.Iterator[Frame]:
+        frame = self.next_frame()
+        while frame is not None:
+            yield frame
+            frame = self.next_frame()
+
+    def receive(self, sock: socket.socket) -> bool:
+        """
+        Read whatever the socket has available into the decoder.
+        Returns False once the peer has closed the connection
+        """
+        received = sock.recv_into(self.chunk)
+        if not received:
+            return False
+        self.feed(self.chunk_view[:received])
+        return True
+
+
+class FramedConnection:
+    """
+    A blocking socket that sends and receives whole frames
+    """
+
+    def __init__(self, sock: socket.socket) -> None:
+        self.socket = sock
+        self.decoder = FrameDecoder()
+
+    def send(self, text: str, body: bytes = b'') -> None:
+        self.socket.sendall(encode_frame(text, body))
+
+    def send_frame(self, frame: bytes) -> None:
+        """
+        Send a frame encoded beforehand, e.g. a cached response
+        """
+        self.socket.sendall(frame)
+
+    def recv(self) -> tp.Optional[Frame]:
+        """
+        Block until a whole frame has arrived.
+        Returns None if the peer closed the connection
+        """
+        frame = self.decoder.next_frame()
+        while frame is None:
+            if not self.decoder.receive(self.socket):
+                return None
+            frame = self.decoder.next_frame()
+        return frame
+
+    def fileno(self) -> int:
+        return self.socket.fileno()
+
+    def close(self) -> None:
+        self.socket.close()
+
+
+async def read_frame(reader: asyncio.StreamReader) -> tp.Optional[Frame]:
+    """
+    Read one frame from an asyncio stream.
+    Returns None if the peer closed the connection between frames
+    """
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as error:
+        if error.partial:
+            raise ProtocolError('Connection closed in the middle of a frame header')
+        return None
+
+    text_length, body_length = HEADER.unpack(header)
+    if text_length + body_length > MAX_FRAME_SIZE:
+        raise ProtocolError(f'Frame of {text_length + body_length} bytes is too large')
+
+    try:
+        payload = await reader.readexactly(text_length + body_length)
+    except asyncio.IncompleteReadError:
+        raise ProtocolError('Connection closed in the middle of a frame')
+
+    return payload[:text_length].decode('utf-8'), payload[text_length:]
+
+
+class AsyncFramedConnection:
+    """
+    An asyncio connection that sends a request frame and reads its response frame.
+    Responses carry no request id, so requests on one connection are strictly one at a time
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.lock = asyncio.Lock()
+
+    @classmethod
+    async def open(cls, host: str, port: int) -> 'AsyncFramedConnection':
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def request(self, text: str, body: bytes = b'') -> tp.Optional[Frame]:
+        """
+        Send one frame and wait for the response.
+        Returns None if the peer closed the connection
+        """
+        async with self.lock:
+            self.writer.write(encode_frame(text, body))
+            await self.writer.drain()
+            return await read_frame(self.reader)
+
+    def close(self) -> None:
+        self.writer.close()